@@ -0,0 +1,157 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import subprocess
+import threading
+import time
+
+class KdcAdminError(Exception):
+    pass
+
+#kadmin.local is an ss (subsystem) shell, when it is given no -q it
+#reads one request per line from stdin until it gets EOF or 'quit'.
+#Each request written to the session is followed by a sentinel request
+#that kadmin.local doesn't know.  The "Unknown request" complaint about
+#the sentinel marks the end of the output for the real request.
+#
+#kadmin.local's stdout is fully buffered when it isn't a tty, so it is
+#run under stdbuf to get each line out as soon as it is printed, and
+#stderr is merged into the same pipe to keep the errors in order.
+class KdcAdminSession:
+    PROMPT = 'kadmin.local:'
+    SENTINEL = 'csmake_kadmin_sentinel_%d'
+    RESTARTS = 1
+
+    def __init__(self, manager, kadminlocal, realm, stdbuf='stdbuf'):
+        self.manager = manager
+        self.log = manager.log
+        self.kadminlocal = kadminlocal
+        self.stdbuf = stdbuf
+        self.realm = realm
+        self.process = None
+        self.requestCount = 0
+        self.lock = threading.Lock()
+
+    def _start(self):
+        command = self.manager.kdcCommand([
+            self.stdbuf, '-oL', '-eL',
+            self.kadminlocal, '-r', self.realm, '-p', 'K/M' ])
+        self.log.devdebug("Starting kadmin.local session: %s", ' '.join(command))
+        self.process = self.manager.shellout(
+            subprocess.Popen,
+            command,
+            with_user_env=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True )
+        #kadmin.local says who it is authenticating as before it reads
+        #any request, that output belongs to no request
+        for line in self._exchange(None):
+            self.log.devdebug("kadmin.local: %s", line)
+
+    def _isRunning(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _stripPrompt(self, line):
+        line = line.strip()
+        while line.startswith(self.PROMPT):
+            line = line[len(self.PROMPT):].strip()
+        return line
+
+    def _exchange(self, command):
+        """Sends command (None for only the sentinel) and returns the
+           lines printed before the sentinel's complaint"""
+        self.requestCount += 1
+        sentinel = self.SENTINEL % self.requestCount
+        if command is not None:
+            self.process.stdin.write("%s\n" % command)
+        self.process.stdin.write("%s\n" % sentinel)
+        self.process.stdin.flush()
+        result = []
+        while True:
+            line = self.process.stdout.readline()
+            if len(line) == 0:
+                raise EOFError("kadmin.local session ended unexpectedly")
+            line = self._stripPrompt(line)
+            if sentinel in line:
+                return result
+            if len(line) != 0:
+                result.append(line)
+
+    def request(self, command):
+        """Execute a single kadmin request in the session and return
+           the lines it printed.  A KdcAdminError is raised if kadmin
+           reported an error for the request."""
+        verb = command.split(None, 1)[0]
+        with self.lock:
+            attempt = 0
+            while True:
+                try:
+                    if not self._isRunning():
+                        if self.process is not None:
+                            self.log.warning(
+                                "kadmin.local session for '%s' exited (%s), restarting",
+                                self.realm,
+                                str(self.process.poll()) )
+                        self._start()
+                    result = self._exchange(command)
+                    break
+                except (IOError, OSError, EOFError, ValueError) as e:
+                    self.log.devdebug(
+                        "kadmin.local session failed: %s: %s",
+                        e.__class__.__name__,
+                        str(e) )
+                    self._kill()
+                    attempt += 1
+                    if attempt > self.RESTARTS:
+                        raise KdcAdminError(
+                            "kadmin.local could not execute '%s': %s" % (
+                                verb, str(e) ) )
+        errors = [ line for line in result if line.startswith(verb + ':') ]
+        if len(errors) != 0:
+            raise KdcAdminError('\n'.join(errors))
+        return result
+
+    def _kill(self):
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+        except Exception as e:
+            self.log.devdebug(
+                "kadmin.local session could not be killed: %s: %s",
+                e.__class__.__name__,
+                str(e) )
+        self.process = None
+
+    def close(self, timeout=2.0):
+        with self.lock:
+            if not self._isRunning():
+                self.process = None
+                return
+            try:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.close()
+                self.process.stdout.read()
+            except (IOError, OSError, ValueError):
+                pass
+            deadline = time.time() + timeout
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(.01)
+            self._kill()
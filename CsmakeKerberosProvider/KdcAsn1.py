@@ -0,0 +1,314 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import calendar
+import struct
+import time
+
+#Just enough DER to speak to a kdc (and, for the python backend, to be
+#one), see RFC 4120 section 5 for the definitions of the kerberos
+#messages built and parsed here.
+
+#Kerberos message types (also the APPLICATION tag numbers)
+AS_REQ = 10
+AS_REP = 11
+TGS_REQ = 12
+TGS_REP = 13
+AP_REQ = 14
+KRB_ERROR = 30
+
+#Other APPLICATION tags
+TICKET = 1
+AUTHENTICATOR = 2
+ENC_TICKET_PART = 3
+ENC_AS_REP_PART = 25
+ENC_TGS_REP_PART = 26
+
+#Pre-authentication data types
+PA_TGS_REQ = 1
+
+#Principal name types
+NT_PRINCIPAL = 1
+NT_SRV_INST = 2
+
+#Universal tags
+TAG_INTEGER = 0x02
+TAG_BIT_STRING = 0x03
+TAG_OCTET_STRING = 0x04
+TAG_SEQUENCE = 0x30
+TAG_GENERALIZED_TIME = 0x18
+TAG_GENERAL_STRING = 0x1b
+
+class Asn1Error(Exception):
+    pass
+
+def _bytes(values):
+    return bytes(bytearray(values))
+
+def length(size):
+    if size < 0x80:
+        return _bytes([size])
+    encoded = bytearray()
+    while size > 0:
+        encoded.insert(0, size & 0xff)
+        size >>= 8
+    return _bytes([0x80 | len(encoded)]) + bytes(encoded)
+
+def tlv(tag, content):
+    return _bytes([tag]) + length(len(content)) + content
+
+def integer(value):
+    encoded = bytearray()
+    while True:
+        encoded.insert(0, value & 0xff)
+        value >>= 8
+        if value == 0 and not encoded[0] & 0x80:
+            break
+        if value == -1 and encoded[0] & 0x80:
+            break
+    return tlv(TAG_INTEGER, bytes(encoded))
+
+def octetString(value):
+    return tlv(TAG_OCTET_STRING, value)
+
+def generalString(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return tlv(TAG_GENERAL_STRING, value)
+
+def generalizedTime(seconds):
+    return tlv(
+        TAG_GENERALIZED_TIME,
+        time.strftime('%Y%m%d%H%M%SZ', time.gmtime(seconds)).encode('ascii') )
+
+def bitString(flags, bits=32):
+    return tlv(
+        TAG_BIT_STRING,
+        b'\0' + struct.pack('>I', flags)[:bits//8] )
+
+def sequence(*items):
+    return tlv(TAG_SEQUENCE, b''.join(items))
+
+def context(number, content):
+    return tlv(0xa0 | number, content)
+
+def application(number, content):
+    return tlv(0x60 | number, content)
+
+def principalName(nameType, components):
+    return sequence(
+        context(0, integer(nameType)),
+        context(1, sequence(*[ generalString(c) for c in components ])) )
+
+def asReq(realm, cname, sname=None, etypes=(18, 17), nonce=None, till=None, kdcOptions=0):
+    """Builds an AS-REQ for cname@realm, cname and sname are lists
+       of the principal name's components.  The etypes default to
+       aes256-cts and aes128-cts, the kdc's default enctypes"""
+    if sname is None:
+        sname = ['krbtgt', realm]
+    if nonce is None:
+        nonce = int(time.time() * 1000) & 0x7fffffff
+    if till is None:
+        till = time.time() + 86400
+    body = sequence(
+        context(0, bitString(kdcOptions)),
+        context(1, principalName(NT_PRINCIPAL, cname)),
+        context(2, generalString(realm)),
+        context(3, principalName(NT_SRV_INST, sname)),
+        context(5, generalizedTime(till)),
+        context(7, integer(nonce)),
+        context(8, sequence(*[ integer(etype) for etype in etypes ])) )
+    return application(AS_REQ, sequence(
+        context(1, integer(5)),
+        context(2, integer(AS_REQ)),
+        context(4, body) ) )
+
+def messageType(data):
+    """Returns the kerberos message type for an encoded message or None"""
+    if len(data) == 0:
+        return None
+    tag = bytearray(data[:1])[0]
+    if tag & 0xe0 != 0x60:
+        return None
+    return tag & 0x1f
+
+def tcpFrame(message):
+    return struct.pack('>I', len(message)) + message
+
+#Parsing, each function takes the encoding of one value (the whole TLV)
+
+def parse(data, offset=0):
+    """Returns (tag, content, offset of the next value)"""
+    data = bytearray(data)
+    if offset + 2 > len(data):
+        raise Asn1Error("Truncated value")
+    tag = data[offset]
+    size = data[offset + 1]
+    offset += 2
+    if size & 0x80:
+        count = size & 0x7f
+        if count == 0 or count > 4 or offset + count > len(data):
+            raise Asn1Error("Unsupported length")
+        size = 0
+        for byte in data[offset:offset + count]:
+            size = (size << 8) | byte
+        offset += count
+    if offset + size > len(data):
+        raise Asn1Error("Truncated value")
+    return tag, bytes(data[offset:offset + size]), offset + size
+
+def unwrap(data, tag):
+    """The content of a value that must have the given tag"""
+    actual, content, end = parse(data)
+    if actual != tag:
+        raise Asn1Error("Expected tag 0x%02x, got 0x%02x" % (tag, actual))
+    return content
+
+def items(content):
+    """The encodings of the values in a SEQUENCE's content"""
+    result = []
+    offset = 0
+    while offset < len(content):
+        tag, inner, end = parse(content, offset)
+        result.append(content[offset:end])
+        offset = end
+    return result
+
+def fields(data, applicationTag=None):
+    """context number -> the encoding in it, for a SEQUENCE (optionally
+       inside an APPLICATION tag)"""
+    if applicationTag is not None:
+        data = unwrap(data, 0x60 | applicationTag)
+    result = {}
+    for item in items(unwrap(data, TAG_SEQUENCE)):
+        tag, content, end = parse(item)
+        if tag & 0xe0 != 0xa0:
+            raise Asn1Error("Expected a context tag, got 0x%02x" % tag)
+        result[tag & 0x1f] = content
+    return result
+
+def toInteger(data):
+    content = bytearray(unwrap(data, TAG_INTEGER))
+    value = 0
+    for byte in content:
+        value = (value << 8) | byte
+    if len(content) != 0 and content[0] & 0x80:
+        value -= 1 << (8 * len(content))
+    return value
+
+def toOctetString(data):
+    return unwrap(data, TAG_OCTET_STRING)
+
+def toString(data):
+    return unwrap(data, TAG_GENERAL_STRING).decode('utf-8')
+
+def toTime(data):
+    text = unwrap(data, TAG_GENERALIZED_TIME).decode('ascii')
+    return calendar.timegm(time.strptime(text, '%Y%m%d%H%M%SZ'))
+
+def toBitString(data):
+    content = unwrap(data, TAG_BIT_STRING)[1:]
+    return struct.unpack('>I', (content + b'\0' * 4)[:4])[0]
+
+def toPrincipalName(data):
+    """(name type, [components])"""
+    parts = fields(data)
+    return (
+        toInteger(parts[0]),
+        [ toString(item) for item in items(unwrap(parts[1], TAG_SEQUENCE)) ] )
+
+def toEncryptedData(data):
+    """(etype, kvno or None, cipher)"""
+    parts = fields(data)
+    kvno = None
+    if 1 in parts:
+        kvno = toInteger(parts[1])
+    return toInteger(parts[0]), kvno, toOctetString(parts[2])
+
+def toEncryptionKey(data):
+    """(keytype, key)"""
+    parts = fields(data)
+    return toInteger(parts[0]), toOctetString(parts[1])
+
+#The kerberos structures the python kdc answers with
+
+def encryptedData(etype, cipher, kvno=None):
+    parts = [ context(0, integer(etype)) ]
+    if kvno is not None:
+        parts.append(context(1, integer(kvno)))
+    parts.append(context(2, octetString(cipher)))
+    return sequence(*parts)
+
+def encryptionKey(keytype, key):
+    return sequence(
+        context(0, integer(keytype)),
+        context(1, octetString(key)) )
+
+def ticket(realm, sname, encPart):
+    return application(TICKET, sequence(
+        context(0, integer(5)),
+        context(1, generalString(realm)),
+        context(2, sname),
+        context(3, encPart) ) )
+
+def encTicketPart(flags, key, crealm, cname, authtime, endtime):
+    return application(ENC_TICKET_PART, sequence(
+        context(0, bitString(flags)),
+        context(1, key),
+        context(2, generalString(crealm)),
+        context(3, cname),
+        context(4, sequence(
+            context(0, integer(1)),
+            context(1, octetString(b'')) ) ),
+        context(5, generalizedTime(authtime)),
+        context(7, generalizedTime(endtime)) ) )
+
+def encKdcRepPart(applicationTag, key, nonce, flags, authtime, endtime, srealm, sname):
+    return application(applicationTag, sequence(
+        context(0, key),
+        context(1, sequence(sequence(
+            context(0, integer(0)),
+            context(1, generalizedTime(authtime)) ) ) ),
+        context(2, integer(nonce)),
+        context(4, bitString(flags)),
+        context(5, generalizedTime(authtime)),
+        context(7, generalizedTime(endtime)),
+        context(9, generalString(srealm)),
+        context(10, sname) ) )
+
+def kdcRep(messageType, crealm, cname, ticketData, encPart):
+    return application(messageType, sequence(
+        context(0, integer(5)),
+        context(1, integer(messageType)),
+        context(3, generalString(crealm)),
+        context(4, cname),
+        context(5, ticketData),
+        context(6, encPart) ) )
+
+def krbError(code, realm, sname, text=None, now=None):
+    if now is None:
+        now = time.time()
+    parts = [
+        context(0, integer(5)),
+        context(1, integer(KRB_ERROR)),
+        context(4, generalizedTime(now)),
+        context(5, integer(0)),
+        context(6, integer(code)),
+        context(9, generalString(realm)),
+        context(10, sname) ]
+    if text is not None:
+        parts.append(context(11, generalString(text)))
+    return application(KRB_ERROR, sequence(*parts))
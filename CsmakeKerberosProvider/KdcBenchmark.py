@@ -0,0 +1,382 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import json
+import multiprocessing
+import os
+import re
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+from CsmakeKerberosProvider import KdcAsn1
+from CsmakeKerberosProvider import KdcCrypto
+
+#Benchmarks for the kdc provider.
+#
+#asreq measures how quickly a kdc answers AS-REQs.
+#The kdc and realm are taken from the krb5.conf that KdcService writes
+#(i.e., $KRB5_CONFIG) unless they are given explicitly, so this can be
+#run from a Shell section decorated by KdcService, e.g.:
+#   python -m CsmakeKerberosProvider.KdcBenchmark asreq --principal bob
+#
+#--transport picks how each AS-REQ is sent: udp, tcp (a new connection
+#for each request, as a client does) or udp+tcp (UDP and then TCP, the
+#two round trips a client makes when the kdc answers UDP with
+#RESPONSE_TOO_BIG).
+#
+#The enctypes requested are the krb5.conf's permitted_enctypes unless
+#--etypes is given.  Running asreq against kdcs set up with different
+#'enctypes' compares how quickly each issues tickets, e.g., the
+#csmakefile's bench-enctypes command.
+#
+#kinit measures how long kinit takes to get a TGT with the krb5.conf
+#(and environment) KdcService sets up, so it includes everything the
+#client library does around the AS exchange: DNS lookups, the credential
+#cache and the replay cache.  The csmakefile's bench-client-profile
+#command compares the standard and offline client-profiles.
+#
+#lifecycle runs the csmakefile's 'benchmark' command, which uses the
+#KdcBenchmark module to time each phase of a KdcServiceProvider's life,
+#principal churn and AS-REQ load, and prints the JSON it produces.
+
+def percentile(ordered, fraction):
+    if len(ordered) == 0:
+        return None
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+def readClientConfig(path):
+    """Returns (default realm, {realm : (host, port)}) from a krb5.conf"""
+    realm, kdcs, enctypes = _readClientConfig(path)
+    return realm, kdcs
+
+def readPermittedEnctypes(path):
+    """Returns the enctype numbers permitted by a krb5.conf"""
+    return enctypeNumbers(_readClientConfig(path)[2])
+
+def enctypeNumbers(names):
+    return [ KdcCrypto.enctypeNumber(name) for name in names ]
+
+def _readClientConfig(path):
+    realm = None
+    kdcs = {}
+    enctypes = []
+    section = None
+    current = None
+    with open(path) as config:
+        for line in config:
+            line = line.strip()
+            match = re.match(r'^\[(\w+)\]$', line)
+            if match is not None:
+                section = match.group(1)
+                continue
+            if section == 'libdefaults':
+                match = re.match(r'^default_realm\s*=\s*(\S+)$', line)
+                if match is not None:
+                    realm = match.group(1)
+                match = re.match(r'^permitted_enctypes\s*=\s*(.*)$', line)
+                if match is not None:
+                    enctypes = re.split(r'[\s,]+', match.group(1).strip())
+            elif section == 'realms':
+                match = re.match(r'^(\S+)\s*=\s*\{$', line)
+                if match is not None:
+                    current = match.group(1)
+                    continue
+                match = re.match(r'^kdc\s*=\s*(?:\w+/)?(\S+):(\d+)$', line)
+                if match is not None and current not in kdcs:
+                    kdcs[current] = (match.group(1), int(match.group(2)))
+    return realm, kdcs, enctypes
+
+class AsReqLoad:
+    """Sends AS-REQs from 'concurrency' threads for 'duration' seconds,
+       each thread waits for the answer to a request before sending
+       the next one."""
+
+    TRANSPORTS = ['udp', 'tcp', 'udp+tcp']
+
+    def __init__(self, address, realm, principal, etypes=(KdcCrypto.AES256_CTS_HMAC_SHA1_96,), timeout=1.0, transport='udp'):
+        self.address = address
+        self.realm = realm
+        self.principal = principal.split('/')
+        self.etypes = etypes
+        self.timeout = timeout
+        if transport not in self.TRANSPORTS:
+            raise ValueError("transport must be one of: %s" % ', '.join(self.TRANSPORTS))
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.family = socket.getaddrinfo(self.address[0], self.address[1])[0][0]
+
+    def _receive(self, sock, size):
+        result = b''
+        while len(result) < size:
+            chunk = sock.recv(size - len(result))
+            if len(chunk) == 0:
+                raise socket.error("Connection closed by the kdc")
+            result += chunk
+        return result
+
+    def _sendTcp(self, request):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+            sock.sendall(KdcAsn1.tcpFrame(request))
+            size = struct.unpack('>I', self._receive(sock, 4))[0]
+            return self._receive(sock, size)
+        finally:
+            sock.close()
+
+    def _send(self, sock, request):
+        if self.transport == 'tcp':
+            return self._sendTcp(request)
+        sock.send(request)
+        reply = sock.recv(65536)
+        if self.transport == 'udp+tcp':
+            return self._sendTcp(request)
+        return reply
+
+    def _worker(self, stop, results):
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        completed = 0
+        errors = 0
+        tickets = 0
+        latencies = []
+        nonce = threading.current_thread().ident & 0xffff
+        try:
+            while not stop.is_set():
+                nonce += 1
+                request = KdcAsn1.asReq(
+                    self.realm,
+                    self.principal,
+                    etypes=self.etypes,
+                    nonce=nonce & 0x7fffffff )
+                try:
+                    sent = time.time()
+                    reply = self._send(sock, request)
+                    messageType = KdcAsn1.messageType(reply)
+                    if messageType in (KdcAsn1.AS_REP, KdcAsn1.KRB_ERROR):
+                        latencies.append(time.time() - sent)
+                        completed += 1
+                        if messageType == KdcAsn1.AS_REP:
+                            tickets += 1
+                    else:
+                        errors += 1
+                except (socket.error, socket.timeout, struct.error):
+                    errors += 1
+        finally:
+            sock.close()
+        with self.lock:
+            results['completed'] += completed
+            results['errors'] += errors
+            results['tickets'] += tickets
+            self.latencies.extend(latencies)
+
+    def run(self, concurrency, duration):
+        results = { 'completed' : 0, 'errors' : 0, 'tickets' : 0 }
+        self.latencies = []
+        stop = threading.Event()
+        threads = [ threading.Thread(target=self._worker, args=(stop, results))
+                    for x in range(concurrency) ]
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        results['seconds'] = elapsed
+        results['concurrency'] = concurrency
+        results['transport'] = self.transport
+        results['requests_per_second'] = results['completed'] / elapsed
+        self.latencies.sort()
+        results['p50_seconds'] = percentile(self.latencies, .5)
+        results['p99_seconds'] = percentile(self.latencies, .99)
+        return results
+
+class KinitLatency:
+    """Runs kinit for principal 'count' times, one after the other"""
+
+    def __init__(self, principal, password='csmake', kinit='kinit', config=None):
+        self.principal = principal
+        self.password = password
+        self.kinit = kinit
+        self.env = None
+        if config is not None:
+            self.env = dict(os.environ)
+            self.env['KRB5_CONFIG'] = config
+
+    def run(self, count):
+        results = { 'completed' : 0, 'errors' : 0 }
+        latencies = []
+        start = time.time()
+        for x in range(count):
+            sent = time.time()
+            process = subprocess.Popen(
+                [self.kinit, self.principal],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=self.env )
+            process.communicate((self.password + '\n').encode('utf-8'))
+            if process.returncode == 0:
+                latencies.append(time.time() - sent)
+                results['completed'] += 1
+            else:
+                results['errors'] += 1
+        results['seconds'] = time.time() - start
+        latencies.sort()
+        results['mean_seconds'] = None
+        if len(latencies) != 0:
+            results['mean_seconds'] = sum(latencies) / len(latencies)
+        results['p50_seconds'] = percentile(latencies, .5)
+        results['p99_seconds'] = percentile(latencies, .99)
+        return results
+
+def _clientConfig(options):
+    config = options.config
+    if config is None:
+        config = os.environ.get('KRB5_CONFIG')
+    return config
+
+def _kdcFromOptions(options):
+    realm = options.realm
+    address = None
+    if options.kdc is not None:
+        host, port = options.kdc.rsplit(':', 1)
+        address = (host, int(port))
+    if realm is None or address is None:
+        config = _clientConfig(options)
+        if config is None:
+            raise ValueError("--kdc and --realm are needed without KRB5_CONFIG")
+        defaultRealm, kdcs = readClientConfig(config)
+        if realm is None:
+            realm = defaultRealm
+        if address is None:
+            address = kdcs[realm]
+    return realm, address
+
+def _etypesFromOptions(options):
+    if options.etypes is not None:
+        return [ int(etype) for etype in options.etypes.split(',') ]
+    config = _clientConfig(options)
+    if config is not None:
+        etypes = readPermittedEnctypes(config)
+        if len(etypes) != 0:
+            return etypes
+    return [KdcCrypto.AES256_CTS_HMAC_SHA1_96]
+
+def lifecycle(options):
+    """Runs the csmakefile's benchmark command and returns its results"""
+    output = os.path.abspath(options.output)
+    env = dict(os.environ)
+    env['KDC_BENCHMARK_OUTPUT'] = output
+    result = subprocess.call(
+        ['csmake', '--command=benchmark', 'test'],
+        env=env )
+    if result != 0:
+        raise RuntimeError("csmake benchmark failed with %d" % result)
+    with open(output) as results:
+        return json.load(results)
+
+def main(argv):
+    parser = OptionParser(usage="%prog asreq|kinit|lifecycle [options]")
+    parser.add_option('--kdc', help="host:port of the kdc")
+    parser.add_option('--realm', help="The realm to request tickets in")
+    parser.add_option('--config', help="krb5.conf to find the kdc in")
+    parser.add_option('--principal', default='csmake/probe',
+        help="The principal to request a ticket for")
+    parser.add_option('--etypes',
+        help="Comma separated enctype numbers to request"
+             " (default: the krb5.conf's permitted_enctypes)")
+    parser.add_option('--transport', default='udp',
+        help="udp, tcp or udp+tcp (a UDP request retried over TCP)")
+    parser.add_option('--password', default='csmake',
+        help="The principal's password (kinit)")
+    parser.add_option('--count', type='int', default=50,
+        help="The number of kinits to time")
+    parser.add_option('--concurrency', type='int', default=8)
+    parser.add_option('--duration', type='float', default=5.0)
+    parser.add_option('--label', help="A name for the results")
+    parser.add_option('--save', help="Also write the asreq results to this file")
+    parser.add_option('--baseline',
+        help="asreq results (from --save) to compare the throughput with")
+    parser.add_option('--min-scaling', type='float',
+        help="Fail if the throughput is less than this times the baseline's")
+    parser.add_option('--output', default='kdc-benchmark.json',
+        help="Where lifecycle results are written")
+    options, args = parser.parse_args(argv)
+    if args == ['lifecycle']:
+        print(json.dumps(lifecycle(options), sort_keys=True, indent=4))
+        return 0
+    if args == ['kinit']:
+        results = KinitLatency(
+            options.principal,
+            options.password,
+            config=options.config ).run(options.count)
+        results['benchmark'] = 'kinit'
+        results['label'] = options.label
+        results['krb5_config'] = _clientConfig(options)
+        print(json.dumps(results, sort_keys=True))
+        return 0 if results['errors'] == 0 else 1
+    if args != ['asreq']:
+        parser.error("A benchmark must be given: asreq, kinit or lifecycle")
+    realm, address = _kdcFromOptions(options)
+    etypes = _etypesFromOptions(options)
+    results = AsReqLoad(
+        address,
+        realm,
+        options.principal,
+        etypes,
+        transport=options.transport ).run(
+        options.concurrency,
+        options.duration )
+    results['benchmark'] = 'asreq'
+    results['label'] = options.label
+    results['etypes'] = etypes
+    if options.baseline is not None:
+        with open(options.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        results['baseline_label'] = baseline.get('label')
+        results['scaling'] = None
+        if baseline['requests_per_second']:
+            results['scaling'] = \
+                results['requests_per_second'] / baseline['requests_per_second']
+    print(json.dumps(results, sort_keys=True))
+    if options.save is not None:
+        with open(options.save, 'w') as saveFile:
+            json.dump(results, saveFile, sort_keys=True)
+    #Absolute throughput depends on the machine, only the scaling
+    #against a baseline from the same machine is checked, and only
+    #where there is more than one cpu to scale to
+    if options.min_scaling is not None and multiprocessing.cpu_count() < 2:
+        sys.stderr.write("Only one cpu, the scaling isn't checked\n")
+    elif options.min_scaling is not None and results.get('scaling') is not None \
+        and results['scaling'] < options.min_scaling:
+        sys.stderr.write("%0.2fx the baseline's throughput is less than %0.2fx\n" % (
+            results['scaling'], options.min_scaling ) )
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,113 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import struct
+
+#Just enough of the MIT FILE credential cache format (versions 3 and 4)
+#to find out when the tickets in a cache kinit wrote expire, without
+#running klist.
+#
+#   version (2) [v4: header length (2), header]
+#   default principal
+#   credential*: client, server, keyblock, authtime, starttime,
+#                endtime, renew_till, is_skey (1), ticket_flags (4),
+#                addresses, authdata, ticket, second_ticket
+#
+#A principal is name type (4), component count (4), realm, components,
+#all strings are a 4 byte length followed by the bytes.  Everything is
+#big endian.
+
+class CcacheFormatError(Exception):
+    pass
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def remaining(self):
+        return len(self.data) - self.offset
+
+    def take(self, count):
+        if self.remaining() < count:
+            raise CcacheFormatError("The credential cache is truncated")
+        result = self.data[self.offset:self.offset+count]
+        self.offset += count
+        return result
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.take(struct.calcsize(fmt)))
+
+    def counted(self):
+        length, = self.unpack('>I')
+        return self.take(length)
+
+    def principal(self):
+        nameType, count = self.unpack('>II')
+        realm = self.counted().decode('utf-8')
+        components = [ self.counted().decode('utf-8') for x in range(count) ]
+        return '%s@%s' % ('/'.join(components), realm)
+
+def readCredentials(data):
+    """Returns (default principal, [credential, ...]) where each
+       credential is a dict with client, server, authtime, starttime,
+       endtime and renew_till"""
+    reader = _Reader(data)
+    version, = reader.unpack('>H')
+    if version not in (0x0503, 0x0504):
+        raise CcacheFormatError("Unsupported credential cache version %x" % version)
+    if version == 0x0504:
+        headerLength, = reader.unpack('>H')
+        reader.take(headerLength)
+    default = reader.principal()
+    credentials = []
+    while reader.remaining() > 0:
+        credential = {}
+        credential['client'] = reader.principal()
+        credential['server'] = reader.principal()
+        reader.unpack('>H')
+        if version == 0x0503:
+            reader.unpack('>H')
+        reader.counted()
+        (credential['authtime'], credential['starttime'],
+         credential['endtime'], credential['renew_till']) = reader.unpack('>IIII')
+        reader.unpack('>BI')
+        for name in ('addresses', 'authdata'):
+            count, = reader.unpack('>I')
+            for x in range(count):
+                reader.unpack('>H')
+                reader.counted()
+        reader.counted()
+        reader.counted()
+        credentials.append(credential)
+    return default, credentials
+
+def tgtExpiry(path, principal):
+    """When the principal's TGT in the cache at path expires (seconds
+       since the epoch) or None if the cache doesn't hold one"""
+    try:
+        with open(path, 'rb') as ccache:
+            default, credentials = readCredentials(ccache.read())
+    except (IOError, OSError, CcacheFormatError):
+        return None
+    if default != principal:
+        return None
+    realm = principal.rsplit('@', 1)[1]
+    tgt = 'krbtgt/%s@%s' % (realm, realm)
+    for credential in credentials:
+        if credential['client'] == principal and credential['server'] == tgt:
+            return credential['endtime']
+    return None
@@ -0,0 +1,420 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import hashlib
+import hmac
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+#The kerberos crypto the provider needs to make keys without the kdc
+#tools, e.g., to write principals straight into a kdb5_util dump.
+#
+#The enctypes are aes256-cts-hmac-sha1-96 and aes128-cts-hmac-sha1-96
+#(RFC 3961/3962) and rc4-hmac (RFC 4757).  Nothing outside of the
+#standard library is needed: MD4 isn't always available from hashlib
+#(OpenSSL 3 drops it) and there's no AES in the standard library, so
+#there are small implementations of both here.  They are only used on
+#keys, which are a few blocks long.
+
+AES128_CTS_HMAC_SHA1_96 = 17
+AES256_CTS_HMAC_SHA1_96 = 18
+RC4_HMAC = 23
+
+#The enctypes whose string to key doesn't use the salt
+SALTLESS = (RC4_HMAC,)
+
+#enctype -> key length in bytes
+KEY_LENGTHS = {
+    AES128_CTS_HMAC_SHA1_96 : 16,
+    AES256_CTS_HMAC_SHA1_96 : 32,
+    RC4_HMAC : 16 }
+
+ENCTYPE_NAMES = {
+    'aes256-cts-hmac-sha1-96' : AES256_CTS_HMAC_SHA1_96,
+    'aes256-cts' : AES256_CTS_HMAC_SHA1_96,
+    'aes256-sha1' : AES256_CTS_HMAC_SHA1_96,
+    'aes128-cts-hmac-sha1-96' : AES128_CTS_HMAC_SHA1_96,
+    'aes128-cts' : AES128_CTS_HMAC_SHA1_96,
+    'aes128-sha1' : AES128_CTS_HMAC_SHA1_96,
+    'rc4-hmac' : RC4_HMAC,
+    'arcfour-hmac' : RC4_HMAC,
+    'arcfour-hmac-md5' : RC4_HMAC }
+
+AES_ITERATIONS = 4096
+AES_CHECKSUM_LENGTH = 12
+
+class KdcCryptoError(Exception):
+    pass
+
+def enctypeNumber(name):
+    try:
+        return ENCTYPE_NAMES[name.split(':', 1)[0].lower()]
+    except KeyError:
+        raise KdcCryptoError("Unsupported enctype '%s'" % name)
+
+#AES (FIPS 197), the tables are made when the module is loaded
+def _makeAesTables():
+    sbox = [0] * 256
+    inverse = [0] * 256
+    p = q = 1
+    sbox[0] = 0x63
+    while True:
+        #p is multiplied by 3 and q divided by 3 in GF(2^8)
+        p = p ^ ((p << 1) & 0xff) ^ (0x1b if p & 0x80 else 0)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xff
+        if q & 0x80:
+            q ^= 0x09
+        value = q ^ (((q << 1) | (q >> 7)) & 0xff) ^ (((q << 2) | (q >> 6)) & 0xff) \
+            ^ (((q << 3) | (q >> 5)) & 0xff) ^ (((q << 4) | (q >> 4)) & 0xff) ^ 0x63
+        sbox[p] = value
+        if p == 1:
+            break
+    for index, value in enumerate(sbox):
+        inverse[value] = index
+    return sbox, inverse
+
+_AES_SBOX, _AES_INVERSE_SBOX = _makeAesTables()
+
+def _xtime(value):
+    value <<= 1
+    if value & 0x100:
+        value ^= 0x11b
+    return value
+
+def _multiply(a, b):
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a = _xtime(a)
+        b >>= 1
+    return result
+
+_MULTIPLY = dict([ (factor, [ _multiply(value, factor) for value in range(256) ])
+                   for factor in (2, 3, 9, 11, 13, 14) ])
+
+def _aesExpandKey(key):
+    key = bytearray(key)
+    words = len(key) // 4
+    rounds = words + 6
+    schedule = [ list(key[i*4:i*4+4]) for i in range(words) ]
+    rcon = 1
+    for i in range(words, 4 * (rounds + 1)):
+        word = list(schedule[i - 1])
+        if i % words == 0:
+            word = word[1:] + word[:1]
+            word = [ _AES_SBOX[value] for value in word ]
+            word[0] ^= rcon
+            rcon = _xtime(rcon)
+        elif words > 6 and i % words == 4:
+            word = [ _AES_SBOX[value] for value in word ]
+        schedule.append([ a ^ b for a, b in zip(schedule[i - words], word) ])
+    return [ sum(schedule[r*4:r*4+4], []) for r in range(rounds + 1) ]
+
+def _aesEncryptBlock(schedule, block):
+    state = [ a ^ b for a, b in zip(bytearray(block), schedule[0]) ]
+    m2 = _MULTIPLY[2]
+    m3 = _MULTIPLY[3]
+    for round in range(1, len(schedule)):
+        state = [ _AES_SBOX[value] for value in state ]
+        #state is column major, row r of column c is state[c*4+r]
+        state = [ state[((c + r) % 4) * 4 + r] for c in range(4) for r in range(4) ]
+        if round != len(schedule) - 1:
+            mixed = []
+            for c in range(4):
+                a0, a1, a2, a3 = state[c*4:c*4+4]
+                mixed.extend([
+                    m2[a0] ^ m3[a1] ^ a2 ^ a3,
+                    a0 ^ m2[a1] ^ m3[a2] ^ a3,
+                    a0 ^ a1 ^ m2[a2] ^ m3[a3],
+                    m3[a0] ^ a1 ^ a2 ^ m2[a3] ])
+            state = mixed
+        state = [ a ^ b for a, b in zip(state, schedule[round]) ]
+    return bytes(bytearray(state))
+
+def _aesDecryptBlock(schedule, block):
+    state = [ a ^ b for a, b in zip(bytearray(block), schedule[-1]) ]
+    m9 = _MULTIPLY[9]
+    m11 = _MULTIPLY[11]
+    m13 = _MULTIPLY[13]
+    m14 = _MULTIPLY[14]
+    for round in range(len(schedule) - 2, -1, -1):
+        state = [ state[((c - r) % 4) * 4 + r] for c in range(4) for r in range(4) ]
+        state = [ _AES_INVERSE_SBOX[value] for value in state ]
+        state = [ a ^ b for a, b in zip(state, schedule[round]) ]
+        if round != 0:
+            mixed = []
+            for c in range(4):
+                a0, a1, a2, a3 = state[c*4:c*4+4]
+                mixed.extend([
+                    m14[a0] ^ m11[a1] ^ m13[a2] ^ m9[a3],
+                    m9[a0] ^ m14[a1] ^ m11[a2] ^ m13[a3],
+                    m13[a0] ^ m9[a1] ^ m14[a2] ^ m11[a3],
+                    m11[a0] ^ m13[a1] ^ m9[a2] ^ m14[a3] ])
+            state = mixed
+    return bytes(bytearray(state))
+
+def _xor(a, b):
+    return bytes(bytearray([ x ^ y for x, y in zip(bytearray(a), bytearray(b)) ]))
+
+def _ctsEncrypt(key, plaintext):
+    """AES in CBC mode with ciphertext stealing and a zero IV (RFC 3962)"""
+    schedule = _aesExpandKey(key)
+    if len(plaintext) == 16:
+        return _aesEncryptBlock(schedule, plaintext)
+    blocks = []
+    previous = b'\0' * 16
+    padded = plaintext + b'\0' * (-len(plaintext) % 16)
+    for offset in range(0, len(padded), 16):
+        previous = _aesEncryptBlock(schedule, _xor(padded[offset:offset+16], previous))
+        blocks.append(previous)
+    #The last two blocks are swapped and the (new) last one is truncated
+    last = len(plaintext) - 16 * (len(blocks) - 1)
+    blocks[-2], blocks[-1] = blocks[-1], blocks[-2][:last]
+    return b''.join(blocks)
+
+def _ctsDecrypt(key, ciphertext):
+    schedule = _aesExpandKey(key)
+    if len(ciphertext) == 16:
+        return _aesDecryptBlock(schedule, ciphertext)
+    count = (len(ciphertext) + 15) // 16
+    blocks = [ ciphertext[i*16:i*16+16] for i in range(count) ]
+    last = len(blocks[-1])
+    #Undo the swap: decrypting the second to last block gives the
+    #last plaintext (xor'ed with the stolen ciphertext)
+    decrypted = _aesDecryptBlock(schedule, blocks[-2])
+    lastPlain = _xor(decrypted[:last], blocks[-1])
+    stolen = blocks[-1] + decrypted[last:]
+    blocks = blocks[:-2] + [stolen]
+    result = []
+    previous = b'\0' * 16
+    for block in blocks:
+        result.append(_xor(_aesDecryptBlock(schedule, block), previous))
+        previous = block
+    return b''.join(result) + lastPlain
+
+def nfold(data, size):
+    """RFC 3961 n-fold of data to size bytes"""
+    data = bytearray(data)
+    length = len(data)
+    def gcd(a, b):
+        while b:
+            a, b = b, a % b
+        return a
+    lcm = size * length // gcd(size, length)
+    bits = length * 8
+    value = 0
+    for byte in data:
+        value = (value << 8) | byte
+    copies = []
+    for i in range(lcm // length):
+        rotation = (13 * i) % bits
+        rotated = ((value >> rotation) | (value << (bits - rotation))) & ((1 << bits) - 1)
+        copies.append(rotated)
+    #Concatenate the rotated copies and add them in size chunks with
+    #ones' complement addition
+    joined = 0
+    for copy in copies:
+        joined = (joined << bits) | copy
+    chunkBits = size * 8
+    mask = (1 << chunkBits) - 1
+    total = 0
+    for i in range(lcm // size):
+        total += (joined >> (chunkBits * i)) & mask
+    while total > mask:
+        total = (total & mask) + (total >> chunkBits)
+    return bytes(bytearray([ (total >> (8 * i)) & 0xff for i in range(size - 1, -1, -1) ]))
+
+def _derive(key, constant):
+    """DK(key, constant) for the aes enctypes"""
+    block = nfold(constant, 16)
+    result = b''
+    schedule = _aesExpandKey(key)
+    while len(result) < len(key):
+        block = _aesEncryptBlock(schedule, block)
+        result += block
+    return result[:len(key)]
+
+_derived = {}
+_derivedLock = threading.Lock()
+
+def _usageKeys(key, usage):
+    """(Ke, Ki) for the aes enctypes, the derivations are remembered
+       because the same keys are used over and over (e.g., the master key)"""
+    memo = (key, usage)
+    with _derivedLock:
+        if memo in _derived:
+            return _derived[memo]
+    result = (
+        _derive(key, struct.pack('>IB', usage, 0xaa)),
+        _derive(key, struct.pack('>IB', usage, 0x55)) )
+    with _derivedLock:
+        if len(_derived) > 256:
+            _derived.clear()
+        _derived[memo] = result
+    return result
+
+def _md4(data):
+    """RFC 1320"""
+    def rotate(value, count):
+        value &= 0xffffffff
+        return ((value << count) | (value >> (32 - count))) & 0xffffffff
+    length = len(data)
+    data = bytearray(data) + bytearray(b'\x80')
+    data += bytearray((56 - len(data) % 64) % 64)
+    data += bytearray(struct.pack('<Q', length * 8))
+    state = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+    for offset in range(0, len(data), 64):
+        x = struct.unpack('<16I', bytes(data[offset:offset+64]))
+        a, b, c, d = state
+        f = lambda b, c, d: (b & c) | (~b & d)
+        for i in range(16):
+            k = i
+            s = (3, 7, 11, 19)[i % 4]
+            a, b, c, d = d, rotate(a + f(b, c, d) + x[k], s), b, c
+        g = lambda b, c, d: (b & c) | (b & d) | (c & d)
+        for i in range(16):
+            k = (i % 4) * 4 + i // 4
+            s = (3, 5, 9, 13)[i % 4]
+            a, b, c, d = d, rotate(a + g(b, c, d) + x[k] + 0x5a827999, s), b, c
+        h = lambda b, c, d: b ^ c ^ d
+        for i in range(16):
+            k = (0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15)[i]
+            s = (3, 9, 11, 15)[i % 4]
+            a, b, c, d = d, rotate(a + h(b, c, d) + x[k] + 0x6ed9eba1, s), b, c
+        state = [ (value + new) & 0xffffffff for value, new in
+                  zip(state, [a, b, c, d]) ]
+    return struct.pack('<4I', *state)
+
+def md4(data):
+    try:
+        return hashlib.new('md4', data).digest()
+    except ValueError:
+        return _md4(data)
+
+def rc4(key, data):
+    key = bytearray(key)
+    box = list(range(256))
+    j = 0
+    for i in range(256):
+        j = (j + box[i] + key[i % len(key)]) & 0xff
+        box[i], box[j] = box[j], box[i]
+    result = bytearray(len(data))
+    i = j = 0
+    for index, byte in enumerate(bytearray(data)):
+        i = (i + 1) & 0xff
+        j = (j + box[i]) & 0xff
+        box[i], box[j] = box[j], box[i]
+        result[index] = byte ^ box[(box[i] + box[j]) & 0xff]
+    return bytes(result)
+
+def _hmacMd5(key, data):
+    return hmac.new(key, data, hashlib.md5).digest()
+
+def normalSalt(principal):
+    """The normal salt for name@REALM: the realm followed by the
+       name's components, e.g., EXAMPLE.COMhostmyhost"""
+    name, realm = principal.rsplit('@', 1)
+    return realm + ''.join(name.split('/'))
+
+def stringToKey(enctype, password, salt):
+    if enctype == RC4_HMAC:
+        #The salt isn't used for rc4-hmac
+        return md4(password.encode('utf-16-le'))
+    if enctype in (AES128_CTS_HMAC_SHA1_96, AES256_CTS_HMAC_SHA1_96):
+        seed = hashlib.pbkdf2_hmac(
+            'sha1',
+            password.encode('utf-8'),
+            salt.encode('utf-8'),
+            AES_ITERATIONS,
+            KEY_LENGTHS[enctype] )
+        return _derive(seed, b'kerberos')
+    raise KdcCryptoError("Unsupported enctype %d" % enctype)
+
+#rc4-hmac uses the same key usage for some of the messages (RFC 4757)
+RC4_USAGES = { 3 : 8, 9 : 8, 23 : 13 }
+
+def encrypt(enctype, key, usage, plaintext, confounder=None):
+    if enctype in (AES128_CTS_HMAC_SHA1_96, AES256_CTS_HMAC_SHA1_96):
+        if confounder is None:
+            confounder = os.urandom(16)
+        ke, ki = _usageKeys(key, usage)
+        data = confounder + plaintext
+        return _ctsEncrypt(ke, data) + hmac.new(
+            ki, data, hashlib.sha1).digest()[:AES_CHECKSUM_LENGTH]
+    if enctype == RC4_HMAC:
+        if confounder is None:
+            confounder = os.urandom(8)
+        k1 = _hmacMd5(key, struct.pack('<I', RC4_USAGES.get(usage, usage)))
+        checksum = _hmacMd5(k1, confounder + plaintext)
+        k3 = _hmacMd5(k1, checksum)
+        return checksum + rc4(k3, confounder + plaintext)
+    raise KdcCryptoError("Unsupported enctype %d" % enctype)
+
+def decrypt(enctype, key, usage, ciphertext):
+    if enctype in (AES128_CTS_HMAC_SHA1_96, AES256_CTS_HMAC_SHA1_96):
+        if len(ciphertext) < 16 + AES_CHECKSUM_LENGTH:
+            raise KdcCryptoError("The ciphertext is too short")
+        ke, ki = _usageKeys(key, usage)
+        data = _ctsDecrypt(ke, ciphertext[:-AES_CHECKSUM_LENGTH])
+        checksum = hmac.new(ki, data, hashlib.sha1).digest()[:AES_CHECKSUM_LENGTH]
+        if not hmac.compare_digest(checksum, ciphertext[-AES_CHECKSUM_LENGTH:]):
+            raise KdcCryptoError("Integrity check failed")
+        return data[16:]
+    if enctype == RC4_HMAC:
+        if len(ciphertext) < 24:
+            raise KdcCryptoError("The ciphertext is too short")
+        checksum = ciphertext[:16]
+        k1 = _hmacMd5(key, struct.pack('<I', RC4_USAGES.get(usage, usage)))
+        k3 = _hmacMd5(k1, checksum)
+        plaintext = rc4(k3, ciphertext[16:])
+        if not hmac.compare_digest(_hmacMd5(k1, plaintext), checksum):
+            raise KdcCryptoError("Integrity check failed")
+        return plaintext[8:]
+    raise KdcCryptoError("Unsupported enctype %d" % enctype)
+
+class KeyCache:
+    """A bounded, least recently used memo of string to key results"""
+
+    def __init__(self, maxEntries=4096):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, function):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                return value
+        value = function()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return value
+
+    def stringToKey(self, enctype, password, salt):
+        if enctype in SALTLESS:
+            salt = ''
+        return self.get(
+            (enctype, password, salt),
+            lambda: stringToKey(enctype, password, salt) )
@@ -0,0 +1,101 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import binascii
+import struct
+from CsmakeKerberosProvider import KdcCrypto
+
+#Writes principals in the format 'kdb5_util dump' produces so that
+#'kdb5_util load -update' can add any number of principals at once.
+#
+#Each principal is a single tab separated line:
+#   princ, 38 (base length), length of name, tl data count, key count,
+#   extra data length, name, attributes, max life, max renewable life,
+#   expiration, password expiration, last success, last failed,
+#   failed auth count, then for each key:
+#       key data version, kvno, enctype, length, key (hex)
+#       [salt type, length, salt (hex) - only with version 2]
+#   and the extra data (-1 for none) followed by ';'
+#
+#A key is stored as the key's length (2 bytes, little endian) followed
+#by the key encrypted in the realm's master key with key usage 0.
+#Every key uses the normal salt (the realm and the name's components),
+#the same keys kadmin and kinit make for the password.  Deriving an aes
+#key takes 4096 PBKDF2 rounds, which is nearly all of the time spent on
+#a principal, so a bulk load with aes enctypes is bounded by PBKDF2
+#(see KdcServiceConfigManager.loadPrincipals, which derives on several
+#threads).  Each distinct (enctype, password, salt) is only derived and
+#encrypted once, with the per principal salt that only saves anything
+#for rc4-hmac (which isn't salted) and repeated entries.
+class KdcDumpWriter:
+    HEADER = "kdb5_util load_dump version 5\n"
+    BASE_LENGTH = 38
+    MAX_LIFE = 86400
+    MASTER_PRINCIPAL = 'K/M'
+    SALTTYPE_NORMAL = 0
+
+    def __init__(self, realm, masterPassword, masterEnctype, enctypes, keyCache=None):
+        self.realm = realm
+        self.enctypes = [ KdcCrypto.enctypeNumber(enctype) for enctype in enctypes ]
+        self.keyCache = keyCache
+        if self.keyCache is None:
+            self.keyCache = KdcCrypto.KeyCache()
+        self.masterEnctype = KdcCrypto.enctypeNumber(masterEnctype)
+        self.masterKey = self.keyCache.stringToKey(
+            self.masterEnctype,
+            masterPassword,
+            self.salt(self.MASTER_PRINCIPAL) )
+        self.keyData = KdcCrypto.KeyCache(self.keyCache.maxEntries)
+
+    def salt(self, name):
+        """The normal salt, the realm followed by the name's components"""
+        return KdcCrypto.normalSalt('%s@%s' % (name, self.realm))
+
+    def _encryptKey(self, enctype, password, salt):
+        key = self.keyCache.stringToKey(enctype, password, salt)
+        encrypted = struct.pack('<H', len(key)) + KdcCrypto.encrypt(
+            self.masterEnctype,
+            self.masterKey,
+            0,
+            key )
+        key = "%d\t%d\t%s" % (
+            enctype,
+            len(encrypted),
+            binascii.hexlify(encrypted).decode('ascii') )
+        if enctype in KdcCrypto.SALTLESS:
+            return "1\t1\t" + key
+        return "2\t1\t%s\t%d\t0\t-1" % (key, self.SALTTYPE_NORMAL)
+
+    def _keyData(self, enctype, password, salt):
+        if enctype in KdcCrypto.SALTLESS:
+            salt = ''
+        return self.keyData.get(
+            (enctype, password, salt),
+            lambda: self._encryptKey(enctype, password, salt) )
+
+    def principal(self, name, password):
+        """The dump line for name (without the realm)"""
+        fullname = '%s@%s' % (name, self.realm)
+        salt = self.salt(name)
+        keys = [ self._keyData(enctype, password, salt)
+                 for enctype in self.enctypes ]
+        return "princ\t%d\t%d\t0\t%d\t0\t%s\t0\t%d\t0\t0\t0\t0\t0\t0\t%s\t-1;\n" % (
+            self.BASE_LENGTH,
+            len(fullname),
+            len(keys),
+            fullname,
+            self.MAX_LIFE,
+            '\t'.join(keys) )
@@ -0,0 +1,139 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import errno
+import os
+import os.path
+import shutil
+import subprocess
+
+#The file operations the kdc provider needs, done in this process.
+#
+#All paths are as seen from outside the chroot (i.e., the "full" paths
+#the config manager hands out).  The kdc tools may run under sudo and
+#leave files this process isn't allowed to touch, only then is the
+#operation handed to the config manager's shellout, which runs with
+#the privileges the kdc was set up with.
+class KdcFilesystem:
+    PRIVILEGE_ERRORS = (errno.EACCES, errno.EPERM)
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.log = manager.log
+
+    def _privileged(self, command):
+        self.log.devdebug(
+            "Permission denied, using: %s", ' '.join(command) )
+        return self.manager.shellout(
+            subprocess.call,
+            command,
+            in_chroot=False )
+
+    def makedirs(self, path):
+        """mkdir -p, returns True if the directory had to be made"""
+        if os.path.isdir(path):
+            return False
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno == errno.EEXIST and os.path.isdir(path):
+                return False
+            if e.errno not in self.PRIVILEGE_ERRORS:
+                raise
+            if self._privileged(['mkdir', '-p', path]) != 0:
+                raise
+        return True
+
+    def remove(self, paths):
+        """rm -rf, paths that don't exist are ignored"""
+        denied = []
+        for path in paths:
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                if e.errno not in self.PRIVILEGE_ERRORS:
+                    raise
+                denied.append(path)
+        if len(denied) != 0:
+            self._privileged(['rm', '-rf'] + denied)
+
+    def copy(self, source, destination):
+        """Copies source over destination, the copy is a new file
+           (renamed into place) so anything that has destination open
+           keeps seeing the old one"""
+        staging = destination + '.%d' % os.getpid()
+        try:
+            shutil.copyfile(source, staging)
+            os.rename(staging, destination)
+        except (IOError, OSError) as e:
+            if e.errno not in self.PRIVILEGE_ERRORS:
+                raise
+            self.remove([staging])
+            if self._privileged(['cp', source, staging]) != 0 \
+                or self._privileged(['mv', '-f', staging, destination]) != 0:
+                raise
+
+    def overwrite(self, source, destination):
+        """Copies source into destination in place (truncate and write),
+           the file keeps its inode so locks on it and processes that
+           have it open see the new contents"""
+        try:
+            with open(source, 'rb') as sourceFile:
+                with open(destination, 'r+b' if os.path.exists(destination) else 'wb') \
+                    as destinationFile:
+                    destinationFile.truncate(0)
+                    shutil.copyfileobj(sourceFile, destinationFile)
+        except (IOError, OSError) as e:
+            if e.errno not in self.PRIVILEGE_ERRORS:
+                raise
+            #cp writes over an existing file in place too
+            if self._privileged(['cp', source, destination]) != 0:
+                raise
+
+    def touch(self, path):
+        """Sets the file's times to now"""
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno not in self.PRIVILEGE_ERRORS:
+                raise
+            if self._privileged(['touch', path]) != 0:
+                raise
+
+    def removeDirectory(self, path, parents=False):
+        """rmdir (or rmdir -p with parents), returns False if the
+           directory couldn't be removed, e.g., it isn't empty"""
+        try:
+            if parents:
+                os.removedirs(path)
+            else:
+                os.rmdir(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return True
+            if e.errno not in self.PRIVILEGE_ERRORS:
+                return False
+            command = ['rmdir']
+            if parents:
+                command.append('-p')
+            self._privileged(command + [path])
+            return not os.path.exists(path)
+        return True
@@ -0,0 +1,177 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import errno
+import json
+import os
+import os.path
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+#A lease keeps a kdc running after the csmake run that started it
+#so that later runs with the same configuration can attach to it.
+#
+#The lease file lives in the kdc's config-path and holds:
+#   pid, pgid - the kdc process and its process group
+#   kdc-pgids - any other process groups krb5kdc runs in (under sudo)
+#   sudo - False if the kdc was started with no-sudo, it is then never
+#          signalled through sudo
+#   address, port - where the kdc is listening
+#   hash - the hash of the configuration the kdc was started with
+#   expiry - when the kdc should be shut down if nothing attaches
+#   timeout - the idle time each use of the lease extends it by
+#   files - the files to remove when the kdc is shut down
+#   directories - the directories to remove when the kdc is shut down
+#
+#A watcher process (this module run as a script) is started with the
+#lease and shuts the kdc down once the lease expires.
+class KdcLease:
+    LEASE_FILE_NAME = 'csmake.kdc.lease'
+    WATCH_INTERVAL = 5.0
+    STOP_TIMEOUT = 2.0
+
+    def __init__(self, configPath):
+        self.configPath = configPath
+        self.path = os.path.join(configPath, self.LEASE_FILE_NAME)
+
+    def read(self):
+        try:
+            with open(self.path) as leasefile:
+                return json.load(leasefile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write(self, lease):
+        staging = self.path + '.%d' % os.getpid()
+        with open(staging, 'w') as leasefile:
+            json.dump(lease, leasefile)
+        os.rename(staging, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _groupExists(pgid):
+        try:
+            os.killpg(pgid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    @staticmethod
+    def _signalGroup(pgid, signum, sudo=True):
+        try:
+            os.killpg(pgid, signum)
+        except OSError as e:
+            if e.errno == errno.EPERM and sudo:
+                subprocess.call(
+                    ['sudo', '-n', 'kill', '-s', str(signum), '--', '-%d' % pgid] )
+            elif e.errno not in (errno.EPERM, errno.ESRCH):
+                raise
+
+    def valid(self, configHash):
+        """Returns the lease if its kdc is running with configHash
+           and the lease hasn't expired, otherwise None"""
+        lease = self.read()
+        if lease is None:
+            return None
+        if lease.get('hash') != configHash:
+            return None
+        if lease.get('expiry', 0) <= time.time():
+            return None
+        if not self._groupExists(lease['pgid']):
+            return None
+        return lease
+
+    def extend(self):
+        lease = self.read()
+        if lease is None:
+            return None
+        lease['expiry'] = time.time() + lease['timeout']
+        self.write(lease)
+        return lease
+
+    def release(self, lease=None, sudo=None):
+        """Stops the leased kdc and removes its files
+           sudo=False never uses sudo to signal the kdc, by default
+           sudo is used unless the kdc was started with no-sudo"""
+        if lease is None:
+            lease = self.read()
+        if lease is None:
+            return
+        if sudo is None:
+            sudo = lease.get('sudo', True)
+        groups = lease.get('kdc-pgids', []) + [lease['pgid']]
+        for pgid in groups:
+            self._signalGroup(pgid, signal.SIGTERM, sudo)
+        deadline = time.time() + self.STOP_TIMEOUT
+        while any(map(self._groupExists, groups)) and time.time() < deadline:
+            time.sleep(.01)
+        for pgid in groups:
+            if self._groupExists(pgid):
+                self._signalGroup(pgid, signal.SIGKILL, sudo)
+        for path in lease.get('files', []):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        for path in lease.get('directories', []):
+            shutil.rmtree(path, True)
+        self.remove()
+        try:
+            os.rmdir(self.configPath)
+        except OSError:
+            pass
+
+    def startWatcher(self):
+        """Starts a detached process to release the lease when it expires"""
+        packageRoot = os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)) )
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [packageRoot] + [ path for path in [env.get('PYTHONPATH')] if path ] )
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(
+                [sys.executable, '-m', 'CsmakeKerberosProvider.KdcLease', self.configPath],
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull,
+                close_fds=True,
+                preexec_fn=os.setsid,
+                env=env )
+
+    def watch(self):
+        while True:
+            lease = self.read()
+            if lease is None:
+                return
+            if not self._groupExists(lease['pgid']):
+                self.remove()
+                return
+            remaining = lease['expiry'] - time.time()
+            if remaining <= 0:
+                self.release(lease)
+                return
+            time.sleep(min(remaining, self.WATCH_INTERVAL))
+
+if __name__ == '__main__':
+    KdcLease(sys.argv[1]).watch()
@@ -0,0 +1,202 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import re
+import threading
+import time
+from collections import deque
+from CsmakeKerberosProvider.KdcProbe import KdcProbe
+
+#Reads what krb5kdc writes (its log and, with KRB5_TRACE, its trace) on
+#a thread of its own so the kdc never waits on the csmake log.
+#
+#Each request the kdc logs becomes an event:
+#   {'time', 'request' (AS or TGS), 'address', 'status', 'client',
+#    'server', 'enctype'}
+#where status is ISSUE for a ticket that was issued and the error
+#(e.g., CLIENT_NOT_FOUND, NEEDED_PREAUTH) otherwise, e.g., from:
+#   ... krb5kdc[1234](info): AS_REQ (2 etypes {aes256-cts-hmac-sha1-96(18),
+#   aes128-cts-hmac-sha1-96(17)}) 127.0.0.1: ISSUE: authtime 1508342400,
+#   etypes {rep=aes256-cts-hmac-sha1-96(18), tkt=aes256-cts-hmac-sha1-96(18),
+#   ses=aes256-cts-hmac-sha1-96(18)}, bob@CSMAKE.DOMAIN for
+#   krbtgt/CSMAKE.DOMAIN@CSMAKE.DOMAIN
+#
+#The last events and lines are kept in bounded buffers, the counts for
+#each principal are kept for the kdc's life.  The readiness probes
+#(KdcProbe's AS-REQs for a principal that doesn't exist) are only
+#counted as probes, they aren't requests or errors.  Only a summary is logged,
+#at most once every 'interval' seconds.
+class KdcLogReader:
+    REQUEST = re.compile(
+        r'\b(AS|TGS)_REQ \(.*?\}\) (\S+): (\w+): (.*)$' )
+    PRINCIPALS = re.compile(r'(\S+) for (\S+?)(?:,\s|$)')
+    SESSION_ENCTYPE = re.compile(r'\bses=([\w-]+)')
+    PROCESS = re.compile(r'\bkrb5kdc\[(\d+)\]')
+    SUCCESS = 'ISSUE'
+
+    def __init__(self, stream, log, bufferSize=1000, interval=10.0):
+        self.stream = stream
+        self.log = log
+        self.interval = interval
+        self.events = deque(maxlen=bufferSize)
+        self.lines = deque(maxlen=bufferSize)
+        self.principals = {}
+        self.statuses = {}
+        self.lineCount = 0
+        self.probes = 0
+        self.probeServers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.lastSummary = time.time()
+        self.sinceSummary = [0, 0]
+
+    PROBE_CLIENT = '/'.join(KdcProbe.PROBE_PRINCIPAL) + '@'
+
+    @classmethod
+    def isProbe(clazz, event):
+        return event['client'] is not None \
+            and event['client'].startswith(clazz.PROBE_CLIENT)
+
+    @classmethod
+    def parse(clazz, line):
+        """The event for a request line or None for any other line"""
+        match = clazz.REQUEST.search(line)
+        if match is None:
+            return None
+        request, address, status, rest = match.groups()
+        event = {
+            'time' : time.time(),
+            'request' : request,
+            'address' : address,
+            'status' : status,
+            'client' : None,
+            'server' : None,
+            'enctype' : None }
+        principals = clazz.PRINCIPALS.search(rest)
+        if principals is not None:
+            event['client'], event['server'] = principals.groups()
+        enctype = clazz.SESSION_ENCTYPE.search(rest)
+        if enctype is not None:
+            event['enctype'] = enctype.group(1)
+        return event
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._read,
+            name='kdc-log-reader' )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def join(self, timeout=None):
+        """Waits for the kdc to close its output"""
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self._summarize(True)
+
+    def _read(self):
+        try:
+            for line in iter(self.stream.readline, b''):
+                self.record(line.decode('utf-8', 'replace').rstrip())
+        except (IOError, OSError, ValueError):
+            #The stream was closed under the reader
+            pass
+        finally:
+            self.stream.close()
+
+    def record(self, line):
+        event = self.parse(line)
+        with self.lock:
+            self.lineCount += 1
+            self.lines.append(line)
+            if event is not None and self.isProbe(event):
+                self.probes += 1
+                process = self.PROCESS.search(line)
+                if process is not None:
+                    self.probeServers.add(int(process.group(1)))
+            elif event is not None:
+                self.events.append(event)
+                self._count(event)
+        self._summarize()
+
+    def _count(self, event):
+        error = event['status'] != self.SUCCESS
+        key = event['client'] or '<unknown>'
+        counts = self.principals.get(key)
+        if counts is None:
+            counts = { 'AS' : 0, 'TGS' : 0, 'errors' : 0, 'statuses' : {} }
+            self.principals[key] = counts
+        counts[event['request']] += 1
+        counts['statuses'][event['status']] = \
+            counts['statuses'].get(event['status'], 0) + 1
+        self.statuses[event['status']] = self.statuses.get(event['status'], 0) + 1
+        self.sinceSummary[0] += 1
+        if error:
+            counts['errors'] += 1
+            self.sinceSummary[1] += 1
+
+    def _summarize(self, force=False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.lastSummary < self.interval:
+                return
+            requests, errors = self.sinceSummary
+            elapsed = now - self.lastSummary
+            self.sinceSummary = [0, 0]
+            self.lastSummary = now
+        if requests != 0:
+            self.log.info(
+                "kdc: %d requests (%d errors) in %0.1f seconds",
+                requests, errors, elapsed )
+
+    def probedProcesses(self):
+        """The pids of the krb5kdc processes that have answered a probe"""
+        with self.lock:
+            return set(self.probeServers)
+
+    def recentEvents(self):
+        with self.lock:
+            return list(self.events)
+
+    def recentLines(self):
+        with self.lock:
+            return list(self.lines)
+
+    def stats(self):
+        """Returns the request counts and error rates, in total and for
+           each client principal"""
+        with self.lock:
+            principals = {}
+            requests = 0
+            errors = 0
+            for principal, counts in self.principals.items():
+                total = counts['AS'] + counts['TGS']
+                principals[principal] = {
+                    'as_requests' : counts['AS'],
+                    'tgs_requests' : counts['TGS'],
+                    'requests' : total,
+                    'errors' : counts['errors'],
+                    'error_rate' : float(counts['errors']) / total,
+                    'statuses' : dict(counts['statuses']) }
+                requests += total
+                errors += counts['errors']
+            return {
+                'requests' : requests,
+                'errors' : errors,
+                'error_rate' : float(errors) / requests if requests else 0.0,
+                'statuses' : dict(self.statuses),
+                'lines' : self.lineCount,
+                'probes' : self.probes,
+                'principals' : principals }
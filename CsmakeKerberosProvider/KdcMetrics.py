@@ -0,0 +1,102 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import importlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+#Records how long each step of a kdc's life takes and how many
+#subprocesses were launched for it.
+#
+#Each span is {'name', 'start', 'seconds'} where start is relative to
+#when the metrics were created, a step that happens once per realm is
+#named <step>:<realm>, e.g.:
+#   {'name' : 'kdb5_util-create:CSMAKE.DOMAIN', 'start' : 0.012, 'seconds' : 0.184}
+#
+#A span that raised is kept with 'failed' : True.  Spans may nest, e.g., ensure
+#includes the kdb5_util-create spans.
+class KdcMetrics:
+    def __init__(self, tag):
+        self.tag = tag
+        self.created = time.time()
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            entry = {
+                'name' : name,
+                'start' : start - self.created,
+                'seconds' : time.time() - start }
+            if failed:
+                entry['failed'] = True
+            with self.lock:
+                self.spans.append(entry)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def totals(self):
+        """Returns step -> total seconds, the per realm spans are
+           added together under the step's name"""
+        result = {}
+        with self.lock:
+            for span in self.spans:
+                name = span['name'].split(':', 1)[0]
+                result[name] = result.get(name, 0.0) + span['seconds']
+        return result
+
+    def asDict(self):
+        with self.lock:
+            return {
+                'tag' : self.tag,
+                'created' : self.created,
+                'spans' : list(self.spans),
+                'counters' : dict(self.counters) }
+
+    def summary(self):
+        totals = self.totals()
+        steps = [ "%s %0.3fs" % (name, totals[name]) for name in sorted(totals) ]
+        with self.lock:
+            subprocesses = self.counters.get('subprocesses', 0)
+        return "kdc '%s': %s; %d subprocesses" % (
+            self.tag, ', '.join(steps), subprocesses )
+
+    def write(self, path):
+        staging = path + '.%d' % os.getpid()
+        with open(staging, 'w') as metricsfile:
+            json.dump(self.asDict(), metricsfile, sort_keys=True, indent=4)
+        os.rename(staging, path)
+
+    @staticmethod
+    def loadHook(hook):
+        """Returns the callable named by hook, i.e., package.module.function"""
+        moduleName, functionName = hook.rsplit('.', 1)
+        return getattr(importlib.import_module(moduleName), functionName)
+
+    def forward(self, hook):
+        self.loadHook(hook)(self.asDict())
@@ -0,0 +1,118 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import socket
+import struct
+import time
+from CsmakeKerberosProvider import KdcAsn1
+
+class KdcNotReadyError(Exception):
+    pass
+
+#Checks that a kdc is answering kerberos requests by sending it an
+#AS-REQ for a principal that doesn't exist.  Any AS-REP or KRB-ERROR
+#in reply means the kdc is up and processing requests.
+class KdcProbe:
+    PROBE_PRINCIPAL = ['csmake', 'probe']
+    READY_MESSAGES = [KdcAsn1.AS_REP, KdcAsn1.KRB_ERROR]
+
+    INITIAL_DELAY = .005
+    MAXIMUM_DELAY = .25
+    INITIAL_TIMEOUT = .05
+    MAXIMUM_TIMEOUT = .5
+
+    def __init__(self, address, realm, etypes=None):
+        self.address = address
+        self.realm = realm
+        self.etypes = etypes
+
+    def _request(self):
+        if self.etypes is None:
+            return KdcAsn1.asReq(self.realm, self.PROBE_PRINCIPAL)
+        return KdcAsn1.asReq(self.realm, self.PROBE_PRINCIPAL, etypes=self.etypes)
+
+    def _family(self):
+        return socket.getaddrinfo(self.address[0], self.address[1])[0][0]
+
+    def probeUdp(self, timeout):
+        sock = socket.socket(self._family(), socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.address)
+            sock.send(self._request())
+            reply = sock.recv(65536)
+        except (socket.error, socket.timeout):
+            return False
+        finally:
+            sock.close()
+        return KdcAsn1.messageType(reply) in self.READY_MESSAGES
+
+    def _receive(self, sock, size):
+        result = b''
+        while len(result) < size:
+            chunk = sock.recv(size - len(result))
+            if len(chunk) == 0:
+                raise socket.error("Connection closed by the kdc")
+            result += chunk
+        return result
+
+    def probeTcp(self, timeout):
+        sock = socket.socket(self._family(), socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.address)
+            sock.sendall(KdcAsn1.tcpFrame(self._request()))
+            size = struct.unpack('>I', self._receive(sock, 4))[0]
+            reply = self._receive(sock, min(size, 5))
+        except (socket.error, socket.timeout, struct.error):
+            return False
+        finally:
+            sock.close()
+        return KdcAsn1.messageType(reply) in self.READY_MESSAGES
+
+    def probe(self, transport, timeout):
+        if transport == 'tcp':
+            return self.probeTcp(timeout)
+        return self.probeUdp(timeout)
+
+    def waitUntilReady(self, deadline, transports=('udp',), alive=None):
+        """Probes the kdc on each transport with an exponential backoff
+           until it answers or 'deadline' seconds have passed.
+           alive, if given, is called between attempts and should return
+           False when there is no point in waiting any longer.
+           Returns the number of seconds it took the kdc to be ready"""
+        start = time.time()
+        end = start + deadline
+        delay = self.INITIAL_DELAY
+        timeout = self.INITIAL_TIMEOUT
+        pending = list(transports)
+        while True:
+            for transport in list(pending):
+                remaining = max(end - time.time(), .001)
+                if self.probe(transport, min(timeout, remaining)):
+                    pending.remove(transport)
+            if len(pending) == 0:
+                return time.time() - start
+            if alive is not None and not alive():
+                raise KdcNotReadyError("The kdc is not running")
+            now = time.time()
+            if now >= end:
+                raise KdcNotReadyError(
+                    "The kdc didn't answer on %s after %s seconds" % (
+                        ', '.join(pending), str(deadline) ) )
+            time.sleep(min(delay, end - now))
+            delay = min(delay * 2, self.MAXIMUM_DELAY)
+            timeout = min(timeout * 2, self.MAXIMUM_TIMEOUT)
@@ -0,0 +1,587 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import binascii
+import os
+import os.path
+import shlex
+import socket
+import struct
+import threading
+import time
+from CsmakeKerberosProvider import KdcAsn1
+from CsmakeKerberosProvider import KdcCrypto
+from CsmakeKerberosProvider.KdcAdminSession import KdcAdminError
+
+#A kdc in this process for backend=python: no krb5kdc, kdb5_util or
+#kadmin.local, the principals are kept in memory.
+#
+#KdcPythonServer answers AS-REQs and TGS-REQs (RFC 4120) over UDP and
+#TCP well enough for kinit, kvno and GSSAPI clients using the krb5.conf
+#KdcService writes.  It doesn't do preauthentication, renewable,
+#forwarded or postdated tickets, FAST or referrals.
+#
+#KdcPythonAdminSession understands the kadmin.local requests the
+#provider makes, so everything the provider does with principals works
+#the same with either backend.
+
+class KdcPrincipalStore:
+    """The principals of each realm, fullname -> entry where an entry is
+       {'password', 'kvno', 'keys'}.  Keys are derived from the password
+       the first time they are needed."""
+
+    #The principals kdb5_util create makes, K/M and the TGS
+    #get random passwords
+    DEFAULT_PRINCIPALS = ['K/M', 'krbtgt/%(realm)s']
+
+    def __init__(self, realms, enctypes):
+        self.enctypes = [ KdcCrypto.enctypeNumber(enctype) for enctype in enctypes ]
+        self.lock = threading.Lock()
+        self.realms = {}
+        self.snapshots = {}
+        self.keyCache = KdcCrypto.KeyCache()
+        for realm in realms:
+            self.realms[realm] = {}
+            for name in self.DEFAULT_PRINCIPALS:
+                self.add(
+                    realm,
+                    '%s@%s' % (name % { 'realm' : realm }, realm),
+                    binascii.hexlify(os.urandom(16)).decode('ascii') )
+
+    def add(self, realm, fullname, password):
+        """Returns False if the principal already exists"""
+        with self.lock:
+            principals = self.realms[realm]
+            if fullname in principals:
+                return False
+            principals[fullname] = {
+                'password' : password,
+                'kvno' : 1,
+                'keys' : None }
+            return True
+
+    def changePassword(self, realm, fullname, password):
+        with self.lock:
+            entry = self.realms[realm].get(fullname)
+            if entry is None:
+                return False
+            self.realms[realm][fullname] = {
+                'password' : password,
+                'kvno' : entry['kvno'] + 1,
+                'keys' : None }
+            return True
+
+    def delete(self, realm, fullname):
+        """Returns False if the principal doesn't exist"""
+        with self.lock:
+            return self.realms[realm].pop(fullname, None) is not None
+
+    def names(self, realm):
+        with self.lock:
+            return sorted(self.realms[realm].keys())
+
+    def hasRealm(self, realm):
+        return realm in self.realms
+
+    def entry(self, realm, fullname):
+        """(kvno, {enctype : key}) or None if there's no such principal"""
+        with self.lock:
+            entry = self.realms[realm].get(fullname)
+        if entry is None:
+            return None
+        if entry['keys'] is None:
+            salt = KdcCrypto.normalSalt(fullname)
+            #Entries are replaced, not changed, so this is safe
+            #without the lock
+            entry['keys'] = dict([
+                (enctype, self.keyCache.stringToKey(enctype, entry['password'], salt))
+                for enctype in self.enctypes ])
+        return entry['kvno'], entry['keys']
+
+    def snapshot(self, name):
+        with self.lock:
+            self.snapshots[name] = dict([
+                (realm, dict(principals))
+                for realm, principals in self.realms.items() ])
+
+    def restore(self, name):
+        with self.lock:
+            if name not in self.snapshots:
+                raise ValueError("There is no kdc snapshot named '%s'" % name)
+            self.realms = dict([
+                (realm, dict(principals))
+                for realm, principals in self.snapshots[name].items() ])
+
+    def snapshotNames(self):
+        with self.lock:
+            return sorted(self.snapshots.keys())
+
+#Writes MIT keytab files (version 0x502), each entry is:
+#   size (4), component count (2), realm, components, name type (4),
+#   timestamp (4), kvno (1), enctype (2), key, kvno (4)
+#where the strings and the key are a 2 byte length and the bytes.
+def _counted(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return struct.pack('>H', len(data)) + data
+
+def keytabEntry(fullname, kvno, enctype, key, timestamp=None):
+    if timestamp is None:
+        timestamp = int(time.time())
+    name, realm = fullname.rsplit('@', 1)
+    components = name.split('/')
+    entry = struct.pack('>H', len(components)) + _counted(realm) \
+        + b''.join([ _counted(component) for component in components ]) \
+        + struct.pack('>IIBH', KdcAsn1.NT_PRINCIPAL, timestamp, kvno & 0xff, enctype) \
+        + _counted(key) + struct.pack('>I', kvno)
+    return struct.pack('>i', len(entry)) + entry
+
+class KdcPythonAdminSession:
+    """Answers the kadmin.local requests the provider makes for one
+       realm from the principal store, with kadmin.local's output"""
+
+    VERBS = {
+        'add_principal' : 'add_principal',
+        'addprinc' : 'add_principal',
+        'ank' : 'add_principal',
+        'delete_principal' : 'delete_principal',
+        'delprinc' : 'delete_principal',
+        'change_password' : 'change_password',
+        'cpw' : 'change_password',
+        'list_principals' : 'list_principals',
+        'listprincs' : 'list_principals',
+        'get_principals' : 'list_principals',
+        'getprincs' : 'list_principals',
+        'get_principal' : 'get_principal',
+        'getprinc' : 'get_principal',
+        'ktadd' : 'ktadd',
+        'xst' : 'ktadd' }
+
+    def __init__(self, store, realm, root=None):
+        self.store = store
+        self.realm = realm
+        self.root = root
+
+    def _fullname(self, principal):
+        if '@' in principal:
+            return principal
+        return '%s@%s' % (principal, self.realm)
+
+    def _options(self, arguments, withValues):
+        """Splits kadmin style -flag [value] options from the rest"""
+        options = {}
+        rest = []
+        index = 0
+        while index < len(arguments):
+            argument = arguments[index]
+            if argument in withValues and index + 1 < len(arguments):
+                options[argument] = arguments[index + 1]
+                index += 2
+                continue
+            if argument.startswith('-'):
+                options[argument] = True
+            else:
+                rest.append(argument)
+            index += 1
+        return options, rest
+
+    def request(self, command):
+        arguments = shlex.split(command)
+        verb = arguments[0]
+        if verb not in self.VERBS:
+            raise KdcAdminError("%s: Unknown request \"%s\"." % (verb, verb))
+        return getattr(self, '_' + self.VERBS[verb])(verb, arguments[1:])
+
+    def _add_principal(self, verb, arguments):
+        options, rest = self._options(arguments, ['-pw', '-e', '-policy', '-kvno'])
+        fullname = self._fullname(rest[-1])
+        password = options.get('-pw')
+        if password is None:
+            password = binascii.hexlify(os.urandom(16)).decode('ascii')
+        if not self.store.add(self.realm, fullname, password):
+            raise KdcAdminError(
+                '%s: Principal or policy already exists while creating "%s".' % (
+                    verb, fullname ) )
+        return ['Principal "%s" created.' % fullname]
+
+    def _delete_principal(self, verb, arguments):
+        options, rest = self._options(arguments, [])
+        fullname = self._fullname(rest[-1])
+        if not self.store.delete(self.realm, fullname):
+            raise KdcAdminError(
+                '%s: Principal does not exist while deleting principal "%s"' % (
+                    verb, fullname ) )
+        return ['Principal "%s" deleted.' % fullname]
+
+    def _change_password(self, verb, arguments):
+        options, rest = self._options(arguments, ['-pw', '-e'])
+        fullname = self._fullname(rest[-1])
+        password = options.get('-pw')
+        if password is None:
+            password = binascii.hexlify(os.urandom(16)).decode('ascii')
+        if not self.store.changePassword(self.realm, fullname, password):
+            raise KdcAdminError(
+                '%s: Principal does not exist while changing password for "%s".' % (
+                    verb, fullname ) )
+        return ['Password for "%s" changed.' % fullname]
+
+    def _list_principals(self, verb, arguments):
+        return self.store.names(self.realm)
+
+    def _get_principal(self, verb, arguments):
+        fullname = self._fullname(arguments[-1])
+        entry = self.store.entry(self.realm, fullname)
+        if entry is None:
+            raise KdcAdminError(
+                '%s: Principal does not exist while retrieving "%s".' % (
+                    verb, fullname ) )
+        kvno, keys = entry
+        names = dict([ (number, name) for name, number in
+                       KdcCrypto.ENCTYPE_NAMES.items() ])
+        lines = ['Principal: %s' % fullname, 'Number of keys: %d' % len(keys)]
+        for enctype in self.store.enctypes:
+            lines.append('Key: vno %d, %s' % (kvno, names.get(enctype, str(enctype))))
+        return lines
+
+    def _ktadd(self, verb, arguments):
+        options, rest = self._options(arguments, ['-k', '-e', '-keytab'])
+        path = options.get('-k', options.get('-keytab'))
+        if path is None:
+            raise KdcAdminError("%s: A keytab must be given with -k" % verb)
+        if self.root is not None:
+            path = os.path.join(self.root, path.lstrip('/'))
+        if not options.get('-norandkey'):
+            raise KdcAdminError("%s: Only -norandkey is supported" % verb)
+        lines = []
+        entries = []
+        for principal in rest:
+            fullname = self._fullname(principal)
+            entry = self.store.entry(self.realm, fullname)
+            if entry is None:
+                raise KdcAdminError(
+                    '%s: Principal %s does not exist.' % (verb, fullname) )
+            kvno, keys = entry
+            for enctype in self.store.enctypes:
+                entries.append(keytabEntry(fullname, kvno, enctype, keys[enctype]))
+                lines.append(
+                    'Entry for principal %s with kvno %d, encryption type %d '
+                    'added to keytab WRFILE:%s.' % (fullname, kvno, enctype, path) )
+        exists = os.path.exists(path)
+        with open(path, 'ab') as keytab:
+            if not exists:
+                keytab.write(b'\x05\x02')
+            keytab.write(b''.join(entries))
+        return lines
+
+    def close(self, timeout=None):
+        pass
+
+class KdcPythonServer:
+    """Answers AS-REQs and TGS-REQs for the principals in the store.
+       Each request is given to record() as the line krb5kdc would log
+       for it, e.g., to a KdcLogReader."""
+
+    MAX_LIFE = 86400
+    #Ticket flags, bit 0 is the most significant bit
+    FLAG_INITIAL = 1 << (31 - 9)
+    #The error codes (RFC 4120 section 7.5.9) and their log names
+    ERRORS = {
+        'CLIENT_NOT_FOUND' : (6, "Client not found in Kerberos database"),
+        'SERVER_NOT_FOUND' : (7, "Server not found in Kerberos database"),
+        'BAD_ENCRYPTION_TYPE' : (14, "KDC has no support for encryption type"),
+        'PREAUTH_FAILED' : (24, "Pre-authentication failed"),
+        'DECRYPT_INTEGRITY' : (31, "Integrity check on decrypted field failed"),
+        'TICKET_EXPIRED' : (32, "Ticket expired"),
+        'GENERIC' : (60, "Generic error"),
+        'WRONG_REALM' : (68, "Wrong realm") }
+    TCP_TIMEOUT = 5.0
+
+    def __init__(self, store, address, transports, record=None, log=None):
+        self.store = store
+        self.address = address
+        self.transports = transports
+        self.record = record
+        self.log = log
+        self.stop = threading.Event()
+        self.sockets = []
+        self.threads = []
+
+    def start(self):
+        family = socket.getaddrinfo(self.address[0], self.address[1])[0][0]
+        if 'udp' in self.transports:
+            udp = socket.socket(family, socket.SOCK_DGRAM)
+            udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp.bind(self.address)
+            udp.settimeout(.2)
+            self.sockets.append(udp)
+            self._thread(self._serveUdp, udp)
+        if 'tcp' in self.transports:
+            tcp = socket.socket(family, socket.SOCK_STREAM)
+            tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcp.bind(self.address)
+            tcp.listen(64)
+            tcp.settimeout(.2)
+            self.sockets.append(tcp)
+            self._thread(self._serveTcp, tcp)
+
+    def _thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, name='kdc-python')
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def shutdown(self, timeout=1.0):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        for sock in self.sockets:
+            sock.close()
+
+    def _serveUdp(self, sock):
+        while not self.stop.is_set():
+            try:
+                request, peer = sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                if self.stop.is_set():
+                    return
+                continue
+            reply = self.handle(request, peer[0])
+            if reply is not None:
+                try:
+                    sock.sendto(reply, peer)
+                except (socket.error, OSError):
+                    pass
+
+    def _serveTcp(self, sock):
+        while not self.stop.is_set():
+            try:
+                connection, peer = sock.accept()
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                if self.stop.is_set():
+                    return
+                continue
+            self._thread(self._serveConnection, connection, peer[0])
+
+    def _receive(self, connection, size):
+        result = b''
+        while len(result) < size:
+            chunk = connection.recv(size - len(result))
+            if len(chunk) == 0:
+                return None
+            result += chunk
+        return result
+
+    def _serveConnection(self, connection, peer):
+        try:
+            connection.settimeout(self.TCP_TIMEOUT)
+            while not self.stop.is_set():
+                header = self._receive(connection, 4)
+                if header is None:
+                    return
+                request = self._receive(connection, struct.unpack('>I', header)[0])
+                if request is None:
+                    return
+                reply = self.handle(request, peer)
+                if reply is None:
+                    return
+                connection.sendall(KdcAsn1.tcpFrame(reply))
+        except (socket.error, socket.timeout, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def handle(self, request, peer):
+        """The reply to an encoded request, None to ignore it"""
+        messageType = KdcAsn1.messageType(request)
+        if messageType not in (KdcAsn1.AS_REQ, KdcAsn1.TGS_REQ):
+            return None
+        kind = 'AS' if messageType == KdcAsn1.AS_REQ else 'TGS'
+        context = { 'kind' : kind, 'peer' : peer, 'etypes' : [],
+                    'client' : '<unknown client>', 'server' : '<unknown server>' }
+        try:
+            message = KdcAsn1.fields(request, messageType)
+            body = KdcAsn1.fields(message[4])
+            context['realm'] = KdcAsn1.toString(body[2])
+            context['sname'] = body.get(3)
+            context['etypes'] = [ KdcAsn1.toInteger(etype) for etype in
+                KdcAsn1.items(KdcAsn1.unwrap(body[8], KdcAsn1.TAG_SEQUENCE)) ]
+            if kind == 'AS':
+                return self._asReq(context, body)
+            return self._tgsReq(context, message, body)
+        except _KdcError as e:
+            return self._error(context, e.status)
+        except (KdcAsn1.Asn1Error, KeyError, IndexError, ValueError,
+                struct.error, KdcCrypto.KdcCryptoError) as e:
+            context.setdefault('realm', '')
+            return self._error(context, 'GENERIC', str(e))
+
+    def _principal(self, data, realm):
+        nameType, components = KdcAsn1.toPrincipalName(data)
+        return '%s@%s' % ('/'.join(components), realm)
+
+    def _strongest(self, keys, etypes):
+        """The first of etypes there is a key for"""
+        for etype in etypes:
+            if etype in keys:
+                return etype
+        raise _KdcError('BAD_ENCRYPTION_TYPE')
+
+    def _endtime(self, body, now, limit=None):
+        endtime = now + self.MAX_LIFE
+        if limit is not None:
+            endtime = min(endtime, limit)
+        till = KdcAsn1.toTime(body[5])
+        if till > now:
+            endtime = min(endtime, till)
+        return endtime
+
+    def _issue(self, context, crealm, cname, authtime, endtime, flags,
+               replyEtype, replyKey, replyUsage, replyKvno, messageType, encPartTag):
+        realm = context['realm']
+        serverEntry = self.store.entry(realm, context['server'])
+        if serverEntry is None:
+            raise _KdcError('SERVER_NOT_FOUND')
+        serverKvno, serverKeys = serverEntry
+        ticketEtype = self.store.enctypes[0]
+        sessionEtype = self._strongest(
+            dict([ (etype, None) for etype in self.store.enctypes ]),
+            context['etypes'] )
+        sessionKey = KdcAsn1.encryptionKey(
+            sessionEtype,
+            os.urandom(KdcCrypto.KEY_LENGTHS[sessionEtype]) )
+        ticket = KdcAsn1.ticket(
+            realm,
+            context['sname'],
+            KdcAsn1.encryptedData(
+                ticketEtype,
+                KdcCrypto.encrypt(
+                    ticketEtype,
+                    serverKeys[ticketEtype],
+                    2,
+                    KdcAsn1.encTicketPart(
+                        flags, sessionKey, crealm, cname, authtime, endtime ) ),
+                serverKvno ) )
+        encPart = KdcAsn1.encryptedData(
+            replyEtype,
+            KdcCrypto.encrypt(
+                replyEtype,
+                replyKey,
+                replyUsage,
+                KdcAsn1.encKdcRepPart(
+                    encPartTag, sessionKey, context['nonce'], flags,
+                    authtime, endtime, realm, context['sname'] ) ),
+            replyKvno )
+        self._record(
+            context,
+            'ISSUE: authtime %d, etypes {rep=%d tkt=%d ses=%d}' % (
+                authtime, replyEtype, ticketEtype, sessionEtype ) )
+        return KdcAsn1.kdcRep(messageType, crealm, cname, ticket, encPart)
+
+    def _asReq(self, context, body):
+        realm = context['realm']
+        if not self.store.hasRealm(realm):
+            raise _KdcError('WRONG_REALM')
+        context['nonce'] = KdcAsn1.toInteger(body[7])
+        context['client'] = self._principal(body[1], realm)
+        context['server'] = self._principal(body[3], realm)
+        clientEntry = self.store.entry(realm, context['client'])
+        if clientEntry is None:
+            raise _KdcError('CLIENT_NOT_FOUND')
+        clientKvno, clientKeys = clientEntry
+        replyEtype = self._strongest(clientKeys, context['etypes'])
+        now = int(time.time())
+        return self._issue(
+            context, realm, body[1], now, self._endtime(body, now),
+            self.FLAG_INITIAL, replyEtype, clientKeys[replyEtype], 3, clientKvno,
+            KdcAsn1.AS_REP, KdcAsn1.ENC_AS_REP_PART )
+
+    def _tgsReq(self, context, message, body):
+        realm = context['realm']
+        if not self.store.hasRealm(realm):
+            raise _KdcError('WRONG_REALM')
+        context['nonce'] = KdcAsn1.toInteger(body[7])
+        context['server'] = self._principal(body[3], realm)
+        apReq = None
+        for padata in KdcAsn1.items(KdcAsn1.unwrap(message[3], KdcAsn1.TAG_SEQUENCE)):
+            padata = KdcAsn1.fields(padata)
+            if KdcAsn1.toInteger(padata[1]) == KdcAsn1.PA_TGS_REQ:
+                apReq = KdcAsn1.fields(KdcAsn1.toOctetString(padata[2]), KdcAsn1.AP_REQ)
+        if apReq is None:
+            raise _KdcError('GENERIC')
+        tgt = KdcAsn1.fields(apReq[3], KdcAsn1.TICKET)
+        tgtServer = self._principal(tgt[2], KdcAsn1.toString(tgt[1]))
+        tgtEntry = self.store.entry(realm, tgtServer)
+        if tgtEntry is None:
+            raise _KdcError('SERVER_NOT_FOUND')
+        etype, kvno, cipher = KdcAsn1.toEncryptedData(tgt[3])
+        if etype not in tgtEntry[1]:
+            raise _KdcError('BAD_ENCRYPTION_TYPE')
+        try:
+            encTicket = KdcAsn1.fields(
+                KdcCrypto.decrypt(etype, tgtEntry[1][etype], 2, cipher),
+                KdcAsn1.ENC_TICKET_PART )
+            sessionEtype, sessionKey = KdcAsn1.toEncryptionKey(encTicket[1])
+            crealm = KdcAsn1.toString(encTicket[2])
+            context['client'] = self._principal(encTicket[3], crealm)
+            etype, kvno, cipher = KdcAsn1.toEncryptedData(apReq[4])
+            authenticator = KdcAsn1.fields(
+                KdcCrypto.decrypt(sessionEtype, sessionKey, 7, cipher),
+                KdcAsn1.AUTHENTICATOR )
+        except KdcCrypto.KdcCryptoError:
+            raise _KdcError('DECRYPT_INTEGRITY')
+        now = int(time.time())
+        tgtEnd = KdcAsn1.toTime(encTicket[7])
+        if tgtEnd <= now:
+            raise _KdcError('TICKET_EXPIRED')
+        replyEtype, replyKey, replyUsage = sessionEtype, sessionKey, 8
+        if 6 in authenticator:
+            replyEtype, replyKey = KdcAsn1.toEncryptionKey(authenticator[6])
+            replyUsage = 9
+        return self._issue(
+            context, crealm, encTicket[3], KdcAsn1.toTime(encTicket[5]),
+            self._endtime(body, now, tgtEnd), 0,
+            replyEtype, replyKey, replyUsage, None,
+            KdcAsn1.TGS_REP, KdcAsn1.ENC_TGS_REP_PART )
+
+    def _error(self, context, status, text=None):
+        code, message = self.ERRORS[status]
+        self._record(context, '%s: %s for %s, %s' % (
+            status, context['client'], context['server'], text or message ) )
+        sname = context.get('sname')
+        if sname is None:
+            sname = KdcAsn1.principalName(KdcAsn1.NT_SRV_INST, ['krbtgt', context['realm']])
+        return KdcAsn1.krbError(code, context['realm'], sname, text or message)
+
+    def _record(self, context, outcome):
+        if self.record is None:
+            return
+        if outcome.startswith('ISSUE'):
+            outcome = '%s, %s for %s' % (outcome, context['client'], context['server'])
+        self.record("%s_REQ (%d etypes {%s}) %s: %s" % (
+            context['kind'],
+            len(context['etypes']),
+            ' '.join([ str(etype) for etype in context['etypes'] ]),
+            context['peer'],
+            outcome ) )
+
+class _KdcError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
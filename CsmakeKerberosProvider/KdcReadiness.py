@@ -0,0 +1,57 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import threading
+
+class KdcStartTimeout(Exception):
+    pass
+
+#The outcome of starting a kdc, which may still be in progress.
+#
+#A kdc started with start-async comes up on a thread of its own, anything
+#that needs the kdc waits on the provider's readiness first.  result()
+#raises whatever stopped the kdc from starting.
+class KdcReadiness:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exception = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Returns True once the start finished (successfully or not),
+           False if it is still going after timeout seconds"""
+        return self.event.wait(timeout)
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise KdcStartTimeout("The kdc has not finished starting")
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def setResult(self, value=None):
+        self.value = value
+        self._finish()
+
+    def setException(self, exception):
+        self.exception = exception
+        self._finish()
+
+    def _finish(self):
+        self.event.set()
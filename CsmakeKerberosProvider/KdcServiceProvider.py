@@ -16,13 +16,42 @@
 # </copyright>
 import threading
 import subprocess
+import errno
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
 import os.path
+import re
+import signal
 import tempfile
 import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from CsmakeProviders.CsmakeServiceProvider import CsmakeServiceProvider
 from CsmakeProviders.CsmakeServiceProvider import CsmakeServiceDaemon
 from CsmakeProviders.CsmakeServiceProvider import CsmakeServiceConfigManager
 from CsmakeProviders.CsmakeServiceProvider import CsmakeServiceConfig
+from CsmakeKerberosProvider.KdcAdminSession import KdcAdminSession
+from CsmakeKerberosProvider.KdcAdminSession import KdcAdminError
+from CsmakeKerberosProvider.KdcTemplateCache import KdcTemplateCache
+from CsmakeKerberosProvider.KdcProbe import KdcProbe
+from CsmakeKerberosProvider.KdcProbe import KdcNotReadyError
+from CsmakeKerberosProvider.KdcLease import KdcLease
+from CsmakeKerberosProvider.KdcMetrics import KdcMetrics
+from CsmakeKerberosProvider.KdcReadiness import KdcReadiness
+from CsmakeKerberosProvider.KdcLog import KdcLogReader
+from CsmakeKerberosProvider import KdcCcache
+from CsmakeKerberosProvider.KdcFilesystem import KdcFilesystem
+from CsmakeKerberosProvider.KdcDump import KdcDumpWriter
+from CsmakeKerberosProvider.KdcPython import KdcPrincipalStore
+from CsmakeKerberosProvider.KdcPython import KdcPythonAdminSession
+from CsmakeKerberosProvider.KdcPython import KdcPythonServer
+from CsmakeKerberosProvider import KdcCrypto
+
+class KdcBinaryNotFoundError(Exception):
+    pass
 
 class KdcConfigurationHelper:
     @staticmethod
@@ -40,12 +69,134 @@ class KdcConfigurationHelper:
                 loglevel = 'DEBUG3'
         return loglevel
 
+    #The packages that provide the binaries the kdc needs
+    BINARY_PACKAGES = {
+        'kdb5_util' : 'krb5-kdc',
+        'krb5kdc' : 'krb5-kdc',
+        'kadmin.local' : 'krb5-admin-server',
+        'stdbuf' : 'coreutils',
+        'env' : 'coreutils',
+        'kinit' : 'krb5-user' }
+
+    #The binaries that are only needed for some options
+    OPTIONAL_BINARIES = {
+        'kinit' : 'preauth-principals' }
+
+    #The binaries still needed with backend=python
+    PYTHON_BINARIES = ['env', 'kinit']
+
+    #The options that may be used to give an explicit path to a binary
+    BINARY_OPTIONS = {
+        'kdb5_util' : 'kdb5-util-path',
+        'krb5kdc' : 'krb5kdc-path',
+        'kadmin.local' : 'kadmin-local-path' }
+
+    #The kdc tools live in sbin which often isn't on a user's PATH
+    BINARY_SEARCH_PATH = [
+        '/usr/local/sbin', '/usr/local/bin',
+        '/usr/sbin', '/usr/bin', '/sbin', '/bin' ]
+
+    #(chroot, binary) -> path to the binary inside the chroot
+    _binaries = {}
+    _binariesLock = threading.Lock()
+
+    @staticmethod
+    def _isExecutable(root, path):
+        fullpath = os.path.join(root, path.lstrip('/'))
+        return os.path.isfile(fullpath) and os.access(fullpath, os.X_OK)
+
+    @classmethod
+    def resolveBinary(clazz, binary, chroot=None, override=None):
+        """Finds the path to 'binary' as seen inside the chroot
+           The result is remembered for the life of the process"""
+        root = chroot
+        if root is None or len(root) == 0:
+            root = '/'
+        if override is not None:
+            if not clazz._isExecutable(root, override):
+                raise KdcBinaryNotFoundError(
+                    "'%s' (given for %s) is not an executable in '%s'" % (
+                        override, binary, root ) )
+            return override
+        key = (root, binary)
+        with clazz._binariesLock:
+            if key in clazz._binaries:
+                return clazz._binaries[key]
+            searchPath = os.environ.get('PATH', '').split(os.pathsep)
+            searchPath.extend(clazz.BINARY_SEARCH_PATH)
+            for directory in searchPath:
+                if len(directory) == 0 or not directory.startswith('/'):
+                    continue
+                path = os.path.join(directory, binary)
+                if clazz._isExecutable(root, path):
+                    clazz._binaries[key] = path
+                    return path
+        message = "'%s' could not be found in '%s'" % (binary, root)
+        if binary in clazz.BINARY_PACKAGES:
+            message += ", the %s package must be installed" % (
+                clazz.BINARY_PACKAGES[binary] )
+        if binary in clazz.BINARY_OPTIONS:
+            message += " or its location given with '%s'" % (
+                clazz.BINARY_OPTIONS[binary] )
+        raise KdcBinaryNotFoundError(message)
+
+    @staticmethod
+    def runConcurrently(function, items, workers=None):
+        """Calls function(item) for each item on up to 'workers' threads
+           Returns a list of (item, result, exception, seconds) in the
+           same order as items"""
+        items = list(items)
+        if workers is None or workers <= 0:
+            workers = len(items)
+        results = [None] * len(items)
+        pending = list(enumerate(items))
+        pendingLock = threading.Lock()
+
+        def worker():
+            while True:
+                with pendingLock:
+                    if len(pending) == 0:
+                        return
+                    index, item = pending.pop(0)
+                start = time.time()
+                try:
+                    results[index] = (item, function(item), None, time.time() - start)
+                except Exception as e:
+                    results[index] = (item, None, e, time.time() - start)
+
+        threads = [ threading.Thread(target=worker) for x in range(min(workers, len(items))) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @staticmethod
+    def noSudo(options):
+        """True if the kdc's tools must not be run with sudo"""
+        return str(options.get('no-sudo')) == 'True'
+
+    @staticmethod
+    def kdcAddress(options):
+        """The address the kdc is listening on
+           An attached, leased kdc keeps the address it was started with"""
+        if options['leased'] is not None:
+            return (options['leased']['address'], options['leased']['port'])
+        return options['port'].address()
+
+    @staticmethod
+    def enctypeNumbers(options):
+        """The numbers of the kdc's enctypes, the etypes a probe asks for"""
+        return [ KdcCrypto.enctypeNumber(enctype)
+                 for enctype in options['enctypes'] ]
+
     @classmethod
-    def kdb_util_command(clazz):
-        #TODO: We may actually need this in the Config objects
-        fullkdb5util = self.configManager.shellout(
-            subprocess.check_output,
-            ['which', 'kdb5_util'] ).strip()
+    def resolveOptionBinary(clazz, binary, options):
+        override = None
+        if binary in clazz.BINARY_OPTIONS:
+            override = options.get(clazz.BINARY_OPTIONS[binary])
+        return clazz.resolveBinary(binary, options.get('chroot'), override)
 
 #Need:
 # - principal database (setting goes into kdc.conf) -d dbfile for kdb5_util
@@ -53,7 +204,7 @@ class KdcConfigurationHelper:
 #
 # Steps:
 # - create a database:
-#   kdb5_util -sf <stashfile> -d <dbfile> -k RC4-HMAC  -P <master pass> -r <realm> create -s
+#   kdb5_util -sf <stashfile> -d <dbfile> -k <first enctype>  -P <master pass> -r <realm> create -s
 #   Working Example:
 #     kdb5_util -k RC4-HMAC -P "ABS" -sf test.krbdb.stash -d test.krbdb -r AAA.YYY create -s
 #   Files:
@@ -66,7 +217,7 @@ class KdcConfigurationHelper:
 #   AAA.YYY = {
 #       database_name = /home/jpatterson/kerb_kdc_testing/test.krbdb
 #       key_stash_file = /home/jpatterson/kerb_kdc_testing/test.krbdb.stash
-#       supported_enctypes = RC4-HMAC
+#       supported_enctypes = <enctype>:normal ...
 #   }
 #   kadmin.local -r <realm> -p K/M -q "<command to do>"
 #       K/M is the default master principal
@@ -74,49 +225,165 @@ class KdcConfigurationHelper:
 #     kadmin.local -r AAA.YYY -p K/M
 class KdcClientConfig(CsmakeServiceConfig):
     CONFIG_FILE_NAME = "csmake.krb5.conf"
+    DIR_CCACHE_NAME = "client-ccaches"
+
+    #The offline profile keeps clients from looking for anything
+    #outside of the krb5.conf: no DNS lookups for realms or kdcs, no
+    #hostname canonicalization and no time sync with the kdc
+    OFFLINE_LIBDEFAULTS = [
+        ('dns_lookup_kdc', 'false'),
+        ('dns_lookup_realm', 'false'),
+        ('dns_uri_lookup', 'false'),
+        ('dns_canonicalize_hostname', 'false'),
+        ('kdc_timesync', '0'),
+        ('noaddresses', 'true') ]
+
+    PROFILES = ['standard', 'offline']
+
+    CCACHE_TYPES = ['FILE', 'MEMORY', 'KEYRING', 'DIR']
 
     def ensure(self):
         pathToConfig = os.path.join(
             self.path,
             self.CONFIG_FILE_NAME )
-        self.log.debug("Writing config to: %s", pathToConfig)
-        self._backupAndSetup(pathToConfig)
+        if self.manager.isCurrent(self.CONFIG_FILE_NAME, self.render()):
+            self.log.debug("Config is unchanged: %s", pathToConfig)
+        else:
+            self.log.debug("Writing config to: %s", pathToConfig)
+            self._backupAndSetup(pathToConfig)
 
-        CsmakeServiceConfig.ensure(self)
+            CsmakeServiceConfig.ensure(self)
+
+        if self.manager.options['ccache-type'] == 'DIR':
+            self.manager.filesystem.makedirs(self._dirCcache(True))
 
         if self.manager.options['change-env-vars']:
             os.putenv('KRB5_CONFIG', pathToConfig)
             os.environ['KRB5_CONFIG'] = pathToConfig
+            if not self.manager.options['replay-cache']:
+                os.putenv('KRB5RCACHETYPE', 'none')
+                os.environ['KRB5RCACHETYPE'] = 'none'
 
-    def writefile(self, fobj):
-        realm = self.manager.options['realm']
-        address, port = self.manager.options['port'].address()
-        fobj.write("""[libdefaults]
-    default_realm = %s
-    rdns = false
-    permitted_enctypes = RC4-HMAC
+    def _dirCcache(self, full=False):
+        path = os.path.join('/', self.manager.daemonConfigPath)
+        if full:
+            path = self.manager.fullDaemonConfigPath
+        return os.path.join(path, self.DIR_CCACHE_NAME)
 
-[realms]
-    %s = {
-        kdc = %s:%d
+    def defaultCcacheName(self):
+        """The default_ccache_name for ccache-type, None leaves the
+           kerberos library's default (a FILE in /tmp)"""
+        ccacheType = self.manager.options['ccache-type']
+        if ccacheType == 'MEMORY':
+            return 'MEMORY:csmake'
+        if ccacheType == 'KEYRING':
+            return 'KEYRING:session:csmake'
+        if ccacheType == 'DIR':
+            return 'DIR:%s' % self._dirCcache()
+        return None
+
+    def profileLibdefaults(self):
+        """The [libdefaults] the client-profile and the client tuning
+           options add to the krb5.conf"""
+        options = self.manager.options
+        settings = []
+        if options['client-profile'] == 'offline':
+            settings.extend(self.OFFLINE_LIBDEFAULTS)
+        ccacheName = self.defaultCcacheName()
+        if ccacheName is not None:
+            settings.append(('default_ccache_name', ccacheName))
+        if options['client-timeout'] is not None:
+            settings.append(('request_timeout', '%ds' % options['client-timeout']))
+        if options['udp-preference-limit'] is not None:
+            settings.append(('udp_preference_limit', str(options['udp-preference-limit'])))
+        return ''.join([ "    %s = %s\n" % setting for setting in settings ])
+
+    #How the client's kdc entry picks the transport
+    TRANSPORT_PREFIXES = {
+        'any' : '',
+        'udp' : 'udp/',
+        'tcp' : 'tcp/' }
+
+    def render(self):
+        address, port = KdcConfigurationHelper.kdcAddress(self.manager.options)
+        prefix = self.TRANSPORT_PREFIXES[self.manager.options['client-transport']]
+        realms = []
+        domains = []
+        for realm in self.manager.options['realms']:
+            realms.append("""    %s = {
+        kdc = %s%s:%d
         default_domain = %s
     }
-
+""" % (realm.upper(), prefix, address, port, realm.lower()) )
+            domains.append("    %s = %s\n" % (realm.lower(), realm.upper()))
+        capaths = ''
+        if self.manager.options['cross-realm-trust']:
+            #Every realm trusts every other realm directly
+            paths = []
+            for source in self.manager.options['realms']:
+                targets = [ "        %s = .\n" % target.upper()
+                            for target in self.manager.options['realms']
+                            if target != source ]
+                paths.append("    %s = {\n%s    }\n" % (
+                    source.upper(), ''.join(targets) ) )
+            capaths = "\n[capaths]\n%s" % ''.join(paths)
+        return """[libdefaults]
+    default_realm = %s
+    rdns = false
+    permitted_enctypes = %s
+%s
+[realms]
+%s
 [domain_realm]
-    %s = %s
-""" % (realm.upper(), realm.upper(), address, port, realm.lower(),
-       realm.lower(), realm.upper()) )
+%s%s""" % (self.manager.options['realm'].upper(),
+         ' '.join(KdcDaemonConfig.enctypeNames(self.manager.options)),
+         self.profileLibdefaults(), ''.join(realms),
+         ''.join(domains), capaths)
+
+    def writefile(self, fobj):
+        fobj.write(self.render())
+
+    def clean(self):
+        if self.manager.keepFiles():
+            return
+
+        self.manager.filesystem.remove([
+            os.path.join(
+                self.manager.fullDaemonConfigPath,
+                self.CONFIG_FILE_NAME ),
+            self._dirCcache(True) ])
 
 class KdcDaemonConfig(CsmakeServiceConfig):
     CONFIG_FILE_NAME = "csmake.kdc.conf"
     DATABASE_FILE_NAME = "csmake.kdc.db"
+    MASTER_PASSWORD = "csmake"
+    #The aes enctypes are done in hardware on most cpus, aes256 is
+    #also the master key's enctype, i.e., the first in the list
+    DEFAULT_ENCTYPES = ["aes256-cts-hmac-sha1-96", "aes128-cts-hmac-sha1-96"]
+
+    #The files each database library keeps, relative to database_name
+    DATABASE_SUFFIXES = {
+        'db2' : ['', '.ok', '.kadm5', '.kadm5.lock'],
+        'klmdb' : ['.mdb', '.mdb-lock', '.lockout.mdb', '.lockout.mdb-lock'] }
+
+    TRANSPORTS = ['udp', 'tcp']
+
+    #Where the kdc logs for each kdc-log, a stream is read from the
+    #kdc's stderr (a leased kdc's stderr is its log file)
+    LOG_DESTINATIONS = {
+        'stream' : 'STDERR',
+        'console' : 'CONSOLE' }
+
+    #The files that must be there for a database to be complete
+    #db2 writes the .ok file last, the lock files may come and go
+    DATABASE_REQUIRED_SUFFIXES = {
+        'db2' : ['', '.ok', '.kadm5'],
+        'klmdb' : ['.mdb', '.lockout.mdb'] }
 
     def ensure(self):
         pathToConfig = os.path.join(
             self.path,
             self.CONFIG_FILE_NAME )
-        self.log.debug("Writing config to: %s", pathToConfig)
-        self._backupAndSetup(pathToConfig)
 
         if self.manager.options['change-env-vars']:
             os.putenv('KRB5_KDC_PROFILE', pathToConfig)
@@ -128,66 +395,140 @@ class KdcDaemonConfig(CsmakeServiceConfig):
                 os.putenv('KRB5_TRACE', tracepath)
                 os.environ['KRB5_TRACE'] = tracepath
 
-        CsmakeServiceConfig.ensure(self)
-
+        if self.manager.isCurrent(self.CONFIG_FILE_NAME, self.render()):
+            self.log.debug("Config is unchanged: %s", pathToConfig)
+            self._ensureDatabases()
+            return
 
-    def writefile(self, fobj):
-        #For now, we're only going to support RC4-HMAC because it's fast and
-        #it's all that seems to work in windows.
+        self.log.debug("Writing config to: %s", pathToConfig)
+        self._backupAndSetup(pathToConfig)
 
-        fullkdb5util = self.manager.shellout(
-            subprocess.check_output,
-            ['which', 'kdb5_util'] ).strip()
+        CsmakeServiceConfig.ensure(self)
 
-        pathToDb = os.path.join(
-            self.path,
-            self.DATABASE_FILE_NAME )
 
-        pathToStash = os.path.join(
-            self.path,
-            self.DATABASE_FILE_NAME + ".stash" )
+    @staticmethod
+    def keysalts(options):
+        """The enctypes as key/salt pairs, the normal salt is used
+           unless the enctype already says which salt"""
+        return [ enctype if ':' in enctype else enctype + ':normal'
+                 for enctype in options['enctypes'] ]
 
-        pathToConfig = os.path.join(
-            self.path,
-            self.CONFIG_FILE_NAME )
+    @staticmethod
+    def enctypeNames(options):
+        """The enctypes without any salt"""
+        return [ enctype.split(':', 1)[0] for enctype in options['enctypes'] ]
 
-        self.manager.shellout(
-            subprocess.check_call,
-            [ fullkdb5util, "-sf", pathToStash, "-d", pathToDb,
-                   "-k", "RC4-HMAC", "-P", "csmake",
-                   "-r", self.manager.options['realm'],
-                   "create", "-s" ] )
+    @classmethod
+    def databaseFileName(clazz, realm, options):
+        """The primary realm keeps the original database name, any
+           other realm served by the kdc gets a database of its own"""
+        if realm == options['realm']:
+            return clazz.DATABASE_FILE_NAME
+        return "csmake.kdc.%s.db" % realm.lower()
 
-        filetext = """[realms]
-    %s = {
-        database_name = %s
+    def render(self):
+        options = self.manager.options
+        supported = ' '.join(self.keysalts(options))
+        #The kdc listens on the allocated port with each transport
+        #it is given, an empty list turns a transport off
+        port = KdcConfigurationHelper.kdcAddress(options)[1]
+        ports = {}
+        for transport in self.TRANSPORTS:
+            ports[transport] = ''
+            if transport in options['transports']:
+                ports[transport] = str(port)
+        realms = []
+        modules = []
+        for realm in options['realms']:
+            module = 'csmake_%s' % realm
+            realms.append("""    %s = {
+        database_module = %s
         key_stash_file = %s
-        supported_enctypes = RC4-HMAC
+        master_key_type = %s
+        supported_enctypes = %s
+        kdc_ports = %s
+        kdc_tcp_ports = %s
+    }
+""" % (realm, module, self.manager.stashFile(realm),
+       KdcDaemonConfig.enctypeNames(options)[0], supported, ports['udp'], ports['tcp']) )
+            modules.append("""    %s = {
+        db_library = %s
+        database_name = %s
     }
-[logging]
-    kdc=CONSOLE""" % (self.manager.options['realm'], pathToDb, pathToDb + '.stash' )
-        fobj.write(filetext)
-        
+""" % (module, options['db-library'],
+       self.manager.databaseFile(realm)) )
+
+        return """[kdcdefaults]
+    kdc_ports = %s
+    kdc_tcp_ports = %s
+
+[realms]
+%s[dbmodules]
+%s[logging]
+    kdc=%s""" % (ports['udp'], ports['tcp'], ''.join(realms), ''.join(modules),
+         self.LOG_DESTINATIONS[options['kdc-log']])
+
+    def writefile(self, fobj):
+        fobj.write(self.render())
+        #kdb5_util reads [dbmodules] to find out which database library
+        #to use, so the file has to be there before the database is made
+        fobj.flush()
+        self._ensureDatabases()
+
+    def _ensureDatabases(self):
+        """Creates the database for each realm unless a complete
+           database made with the same parameters is already there"""
+        options = self.manager.options
+        created = []
+        for realm in options['realms']:
+            if options['leased'] is not None:
+                self.log.devdebug("Using the leased kdc's database for %s", realm)
+                continue
+            if self.manager.databaseIsCurrent(realm):
+                self.log.devdebug("Reusing the existing database for %s", realm)
+                self.manager.databasesReused[realm] = True
+                continue
+            self.manager.removeDatabase(realm)
+            if not self.manager.fetchTemplate(realm):
+                command = [
+                    self.manager.binary('kdb5_util'),
+                    "-sf", self.manager.stashFile(realm),
+                    "-k", self.enctypeNames(options)[0], "-P", self.MASTER_PASSWORD,
+                    "-r", realm ]
+                if options['db-library'] == 'db2':
+                    command.extend(["-d", self.manager.databaseFile(realm)])
+                command.extend(["create", "-s"])
+                with options['kdc-metrics'].span('kdb5_util-create:%s' % realm):
+                    self.manager.shellout(
+                        subprocess.check_call,
+                        self.manager.kdcCommand(command, client=False) )
+                created.append(realm)
+            else:
+                self.manager.recordDatabase(realm)
+
+        #The principals-file is loaded into all the new databases at once
+        if options['principals-file'] is not None and len(created) != 0:
+            counts = self.manager.loadPrincipals(
+                entry for entry in
+                KdcServiceProvider.readPrincipalsFile(options['principals-file'])
+                if KdcServiceProvider.splitPrincipal(entry[0], options)[1] in created )
+            self.log.info(
+                "Loaded %d principals from %s",
+                sum(counts.values()),
+                options['principals-file'] )
+        for realm in created:
+            self.manager.recordDatabase(realm)
+
     def clean(self):
-        pathToDb = os.path.join(
-            self.path,
-            self.DATABASE_FILE_NAME )
+        if self.manager.keepFiles():
+            self.log.devdebug("Keeping the kdc's database")
+            return
 
-        pathToStash = os.path.join(
-            self.path,
-            self.DATABASE_FILE_NAME + ".stash" )
+        #The same files a lease removes when it is released
+        self.manager.filesystem.remove(
+            self.manager.kdcFiles() + self.manager.kdcDirectories() )
 
-        pathToConfig = os.path.join(
-            self.path,
-            self.CONFIG_FILE_NAME )
 
-        self.manager.shellout(
-            subprocess.call,
-            ['rm', '-f', pathToConfig, pathToDb, '%s.ok' % pathToDb,
-                         '%s.kadm5' % pathToDb, '%s.stash' % pathToDb,
-                         '%s.kadm5.lock' % pathToDb ] )
-        
-        
 class KdcServiceConfigManager(CsmakeServiceConfigManager):
 
     #TODO: Ensure we keep chrootability
@@ -203,58 +544,533 @@ class KdcServiceConfigManager(CsmakeServiceConfigManager):
         self.fullDaemonConfigPath = os.path.join(
             mybaseroot,
             self.daemonConfigPath)
+        #The database may be put somewhere else, e.g., on a tmpfs
+        self.databasePath = os.path.join('/', self.daemonConfigPath)
+        if options['database-path'] is not None:
+            self.databasePath = options['database-path']
+        self.fullDatabasePath = os.path.join(
+            mybaseroot,
+            self.databasePath.lstrip('/') )
+        self.filesystem = KdcFilesystem(self)
+        self.keyCache = KdcCrypto.KeyCache()
+        self.principalsDigest = None
+        self.templateHits = {}
+        self.databasesReused = {}
+        self.templateCache = None
+        if options['template-cache']:
+            self.templateCache = KdcTemplateCache(
+                self.log,
+                options['template-cache-path'],
+                options['template-cache-size'] )
+
+    def databaseFile(self, realm, full=False):
+        """The database_name for the realm, as seen inside the chroot
+           or, with full, from outside the chroot"""
+        path = self.databasePath
+        if full:
+            path = self.fullDatabasePath
+        return os.path.join(
+            path,
+            KdcDaemonConfig.databaseFileName(realm, self.options) )
+
+    def stashFile(self, realm, full=False):
+        """The stash stays with the configuration"""
+        path = os.path.join('/', self.daemonConfigPath)
+        if full:
+            path = self.fullDaemonConfigPath
+        return os.path.join(
+            path,
+            KdcDaemonConfig.databaseFileName(realm, self.options) + '.stash' )
+
+    def databaseFiles(self, realm, full=False):
+        pathToDb = self.databaseFile(realm, full)
+        files = [ pathToDb + suffix for suffix in
+            KdcDaemonConfig.DATABASE_SUFFIXES[self.options['db-library']] ]
+        files.append(self.stashFile(realm, full))
+        return files
+
+    STATE_FILE_NAME = 'csmake.kdc.state'
+
+    def keepFiles(self):
+        """The configuration and databases are left for the next kdc
+           when the kdc is leased or keep-config is given"""
+        if self.options['lease'] and not self.options['lease-release']:
+            return True
+        return self.options['keep-config']
+
+    def stateFile(self, full=False):
+        """Records the parameters each realm's database was made with"""
+        path = os.path.join('/', self.daemonConfigPath)
+        if full:
+            path = self.fullDaemonConfigPath
+        return os.path.join(path, self.STATE_FILE_NAME)
+
+    def isCurrent(self, name, content):
+        """True if the config file 'name' already holds content"""
+        try:
+            with open(os.path.join(self.fullDaemonConfigPath, name), 'rb') as config:
+                existing = hashlib.sha256(config.read()).hexdigest()
+        except (IOError, OSError):
+            return False
+        return existing == hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _readState(self):
+        try:
+            with open(self.stateFile(True)) as statefile:
+                return json.load(statefile)
+        except (IOError, OSError, ValueError):
+            return {'databases' : {}}
+
+    def _writeState(self, state):
+        path = self.stateFile(True)
+        staging = path + '.%d' % os.getpid()
+        with open(staging, 'w') as statefile:
+            json.dump(state, statefile, sort_keys=True)
+        os.rename(staging, path)
+
+    def _databaseHash(self, realm):
+        return hashlib.sha256(json.dumps({
+            'realm' : realm,
+            'enctypes' : self.options['enctypes'],
+            'master' : KdcDaemonConfig.MASTER_PASSWORD,
+            'db-library' : self.options['db-library'],
+            'database' : self.databaseFile(realm),
+            'stash' : self.stashFile(realm),
+            'principals-file' : self.principalsFileDigest() },
+            sort_keys=True ).encode('utf-8') ).hexdigest()
+
+    def principalsFileDigest(self):
+        """The sha256 of the principals-file, if any"""
+        path = self.options['principals-file']
+        if path is None:
+            return None
+        if self.principalsDigest is None:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as principals:
+                for block in iter(lambda: principals.read(65536), b''):
+                    digest.update(block)
+            self.principalsDigest = digest.hexdigest()
+        return self.principalsDigest
+
+    def loadFile(self, realm, full=False):
+        path = os.path.join('/', self.daemonConfigPath)
+        if full:
+            path = self.fullDaemonConfigPath
+        return os.path.join(path, 'csmake.kdc.%s.load' % realm.lower())
+
+    #Principals are derived in batches, so a file of any size is
+    #never read into memory all at once
+    LOAD_BATCH_SIZE = 512
+
+    def _loadBatches(self, entries):
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == self.LOAD_BATCH_SIZE:
+                yield batch
+                batch = []
+        if len(batch) != 0:
+            yield batch
+
+    def loadPrincipals(self, entries):
+        """Adds the (principal, password) entries to the realms'
+           databases with a single kdb5_util load per realm.
+           entries may be any iterable, e.g., a generator reading a file,
+           each entry is written to the realm's dump as it is read.
+           With aes enctypes the load is bounded by deriving the keys
+           (two PBKDF2 runs of 4096 rounds for each principal), that is
+           done on a thread per cpu, hashlib releases the GIL for it.
+           Returns realm -> the number of principals loaded"""
+        writers = {}
+        dumps = {}
+        counts = {}
+        pool = ThreadPool(multiprocessing.cpu_count())
+        try:
+            for batch in self._loadBatches(entries):
+                work = []
+                for principal, password in batch:
+                    name, realm = KdcServiceProvider.splitPrincipal(principal, self.options)
+                    if realm not in dumps:
+                        writers[realm] = KdcDumpWriter(
+                            realm,
+                            KdcDaemonConfig.MASTER_PASSWORD,
+                            self.options['enctypes'][0],
+                            self.options['enctypes'],
+                            self.keyCache )
+                        dumps[realm] = open(self.loadFile(realm, True), 'w')
+                        dumps[realm].write(KdcDumpWriter.HEADER)
+                        counts[realm] = 0
+                    work.append((realm, name, password))
+                lines = pool.map(
+                    lambda entry: writers[entry[0]].principal(entry[1], entry[2]),
+                    work )
+                for (realm, name, password), line in zip(work, lines):
+                    dumps[realm].write(line)
+                    counts[realm] += 1
+            for dump in dumps.values():
+                dump.close()
+            for realm in dumps:
+                command = [self.binary('kdb5_util'), '-r', realm]
+                if self.options['db-library'] == 'db2':
+                    command.extend(['-d', self.databaseFile(realm)])
+                command.extend(['load', '-update', self.loadFile(realm)])
+                with self.options['kdc-metrics'].span('kdb5_util-load:%s' % realm):
+                    self.shellout(
+                        subprocess.check_call,
+                        self.kdcCommand(command, client=False) )
+                self.log.devdebug(
+                    "Loaded %d principals into %s", counts[realm], realm )
+        finally:
+            pool.close()
+            pool.join()
+            for dump in dumps.values():
+                dump.close()
+            self.filesystem.remove(
+                [ self.loadFile(realm, True) for realm in dumps ] )
+        return counts
+
+    def databaseIsCurrent(self, realm):
+        """True if the realm's database was made with the same
+           parameters and all of its files are still there"""
+        if self._readState()['databases'].get(realm) != self._databaseHash(realm):
+            return False
+        pathToDb = self.databaseFile(realm, True)
+        required = [ pathToDb + suffix for suffix in
+            KdcDaemonConfig.DATABASE_REQUIRED_SUFFIXES[self.options['db-library']] ]
+        required.append(self.stashFile(realm, True))
+        for path in required:
+            if not os.path.exists(path):
+                self.log.info(
+                    "The database for %s is incomplete (%s is missing), creating it again",
+                    realm,
+                    path )
+                return False
+        return True
+
+    def removeDatabase(self, realm):
+        """Removes whatever is left of an old or partial database"""
+        state = self._readState()
+        if realm in state['databases']:
+            del state['databases'][realm]
+            self._writeState(state)
+        existing = [ path for path in self.databaseFiles(realm, True)
+                     if os.path.exists(path) ]
+        if len(existing) != 0:
+            self.log.devdebug("Removing the old database for %s", realm)
+            self.filesystem.remove(existing)
+
+    def recordDatabase(self, realm):
+        state = self._readState()
+        state['databases'][realm] = self._databaseHash(realm)
+        self._writeState(state)
+
+    def keytabDirectory(self, full=False):
+        """Exported keytabs are kept with the configuration"""
+        path = os.path.join('/', self.daemonConfigPath)
+        if full:
+            path = self.fullDaemonConfigPath
+        return os.path.join(path, KdcServiceProvider.KEYTAB_DIRECTORY_NAME)
+
+    def keytabFile(self, name, full=False):
+        return os.path.join(self.keytabDirectory(full), name)
+
+    def ccacheDirectory(self, full=False):
+        """Credential caches for preauth-principals are kept with the
+           configuration"""
+        path = os.path.join('/', self.daemonConfigPath)
+        if full:
+            path = self.fullDaemonConfigPath
+        return os.path.join(path, KdcServiceProvider.CCACHE_DIRECTORY_NAME)
+
+    def ccacheFile(self, principal, full=False):
+        return os.path.join(
+            self.ccacheDirectory(full),
+            '%s.ccache' % principal.replace('/', '_') )
+
+    def snapshotDirectory(self, full=False):
+        """Snapshots of the databases are kept with the configuration"""
+        path = os.path.join('/', self.daemonConfigPath)
+        if full:
+            path = self.fullDaemonConfigPath
+        return os.path.join(path, KdcServiceProvider.SNAPSHOT_DIRECTORY_NAME)
+
+    def snapshotPath(self, name, full=False):
+        return os.path.join(self.snapshotDirectory(full), name)
+
+    def snapshotManifest(self, name):
+        try:
+            with open(os.path.join(
+                self.snapshotPath(name, True),
+                self.SNAPSHOT_MANIFEST_NAME )) as manifest:
+                return json.load(manifest)
+        except (IOError, OSError, ValueError):
+            return None
+
+    SNAPSHOT_MANIFEST_NAME = 'manifest.json'
+
+    #The db2 files kept in a snapshot.  They are restored in place
+    #while holding the database's lock (on the .ok file, the same lock
+    #krb5kdc and kadmin.local take), then the .ok file's time is
+    #changed: that is what makes the kdc reopen the database.
+    #Renaming new files into place wouldn't work, the kdc would go on
+    #locking the old .ok file.
+    SNAPSHOT_DB2_SUFFIXES = ['', '.kadm5']
+    DB2_LOCK_SUFFIX = '.ok'
+
+    @contextmanager
+    def _databaseLock(self, realm):
+        """Holds the realm's db2 database lock (a POSIX lock on the .ok
+           file, as the kdb library does) for the duration.  A database
+           made under sudo can't be opened to lock it, then the kdc is
+           only kept out by being quiesced."""
+        path = self.databaseFile(realm, True) + self.DB2_LOCK_SUFFIX
+        try:
+            lockFile = open(path, 'r+')
+        except (IOError, OSError) as e:
+            if e.errno not in KdcFilesystem.PRIVILEGE_ERRORS:
+                raise
+            self.log.devdebug("The database lock %s can't be taken", path)
+            yield
+            return
+        try:
+            fcntl.lockf(lockFile, fcntl.LOCK_EX)
+            yield
+        finally:
+            #Closing the file releases the lock
+            lockFile.close()
+
+    def _snapshotDump(self, name, realm, full=False):
+        return os.path.join(
+            self.snapshotPath(name, full),
+            '%s.dump' % realm.lower() )
+
+    def takeSnapshot(self, name, quiesced):
+        """Copies the realms' databases to the snapshot 'name'.
+           db2 files are copied under the database lock while
+           quiesced() has the kdc stopped,
+           klmdb databases are dumped (a dump is a consistent read)"""
+        path = self.snapshotPath(name, True)
+        self.filesystem.remove([path])
+        self.filesystem.makedirs(path)
+        manifest = {
+            'db-library' : self.options['db-library'],
+            'realms' : {} }
+        if self.options['db-library'] == 'db2':
+            for realm in self.options['realms']:
+                pathToDb = self.databaseFile(realm, True)
+                with self._databaseLock(realm), quiesced():
+                    for suffix in self.SNAPSHOT_DB2_SUFFIXES:
+                        self.filesystem.copy(
+                            pathToDb + suffix,
+                            os.path.join(path, os.path.basename(pathToDb) + suffix) )
+                manifest['realms'][realm] = {}
+        else:
+            for realm in self.options['realms']:
+                command = [
+                    self.binary('kdb5_util'), '-r', realm,
+                    'dump', self._snapshotDump(name, realm) ]
+                self.shellout(
+                    subprocess.check_call,
+                    self.kdcCommand(command, client=False) )
+                manifest['realms'][realm] = {
+                    'principals' : self._dumpPrincipals(
+                        self._snapshotDump(name, realm, True) ) }
+        staging = os.path.join(path, self.SNAPSHOT_MANIFEST_NAME + '.tmp')
+        with open(staging, 'w') as manifestFile:
+            json.dump(manifest, manifestFile, sort_keys=True)
+        os.rename(staging, os.path.join(path, self.SNAPSHOT_MANIFEST_NAME))
+
+    @staticmethod
+    def _dumpPrincipals(path):
+        """The principal names in a kdb5_util dump"""
+        result = []
+        with open(path) as dump:
+            for line in dump:
+                if line.startswith('princ\t'):
+                    result.append(line.split('\t', 7)[6])
+        return result
+
+    def restoreSnapshot(self, name, quiesced, deletePrincipals):
+        """Puts the databases back the way they were when the snapshot
+           'name' was taken.  db2 files are written back in place under
+           the database lock while the kdc is stopped.  A klmdb dump is loaded over the database and the
+           principals that weren't in it are deleted with
+           deletePrincipals(realm, principals)"""
+        manifest = self.snapshotManifest(name)
+        if manifest is None:
+            raise ValueError("There is no kdc snapshot named '%s'" % name)
+        if manifest['db-library'] != self.options['db-library']:
+            raise ValueError("The snapshot '%s' is of a %s database" % (
+                name, manifest['db-library'] ) )
+        path = self.snapshotPath(name, True)
+        if self.options['db-library'] == 'db2':
+            for realm in manifest['realms']:
+                pathToDb = self.databaseFile(realm, True)
+                #The lock is taken before the kdc is stopped, a kdc
+                #stopped while holding it would never give it up
+                with self._databaseLock(realm), quiesced():
+                    for suffix in self.SNAPSHOT_DB2_SUFFIXES:
+                        self.filesystem.overwrite(
+                            os.path.join(path, os.path.basename(pathToDb) + suffix),
+                            pathToDb + suffix )
+                    self.filesystem.touch(pathToDb + self.DB2_LOCK_SUFFIX)
+            return
+        for realm, contents in manifest['realms'].items():
+            deletePrincipals(realm, contents['principals'])
+            command = [
+                self.binary('kdb5_util'), '-r', realm,
+                'load', '-update', self._snapshotDump(name, realm) ]
+            self.shellout(
+                subprocess.check_call,
+                self.kdcCommand(command, client=False) )
+
+    def _templateKey(self, realm):
+        return KdcTemplateCache.key(
+            realm,
+            self.options['enctypes'],
+            KdcDaemonConfig.MASTER_PASSWORD,
+            KdcServiceProvider.initialPrincipals(self.options)[realm],
+            self.options['db-library'],
+            self.principalsFileDigest() )
+
+    def _templateFiles(self, realm):
+        pathToDb = self.databaseFile(realm, True)
+        files = [ ('db' + suffix, pathToDb + suffix, False) for suffix in
+            KdcDaemonConfig.DATABASE_SUFFIXES[self.options['db-library']] ]
+        files.append(('stash', self.stashFile(realm, True), True))
+        return files
+
+    def fetchTemplate(self, realm):
+        cache = self.templateCache
+        if cache is None:
+            return False
+        try:
+            with cache.lock(), self.options['kdc-metrics'].span(
+                'template-fetch:%s' % realm ):
+                self.templateHits[realm] = cache.fetch(
+                    self._templateKey(realm),
+                    self._templateFiles(realm) )
+        except Exception as e:
+            self.log.info(
+                "The kdc database template could not be used: %s: %s",
+                e.__class__.__name__,
+                str(e) )
+            self.templateHits[realm] = False
+        return self.templateHits[realm]
+
+    def storeTemplate(self, realm):
+        cache = self.templateCache
+        if cache is None or self.templateHits.get(realm):
+            return
+        try:
+            with cache.lock():
+                cache.store(self._templateKey(realm), self._templateFiles(realm))
+        except Exception as e:
+            self.log.warning(
+                "The kdc database template could not be saved: %s: %s",
+                e.__class__.__name__,
+                str(e) )
+
+    def binary(self, binary):
+        override = None
+        if binary in KdcConfigurationHelper.BINARY_OPTIONS:
+            override = self.options.get(
+                KdcConfigurationHelper.BINARY_OPTIONS[binary] )
+        return KdcConfigurationHelper.resolveBinary(
+            binary,
+            self.chroot,
+            override )
+
+    def kdcFiles(self):
+        """All the files the kdc creates, as paths outside the chroot"""
+        files = [ os.path.join(self.fullDaemonConfigPath, name) for name in [
+            KdcDaemonConfig.CONFIG_FILE_NAME,
+            KdcClientConfig.CONFIG_FILE_NAME,
+            KdcServiceDaemon.LOG_FILE_NAME,
+            self.STATE_FILE_NAME ] ]
+        for realm in self.options['realms']:
+            files.extend(self.databaseFiles(realm, True))
+        return files
+
+    def kdcDirectories(self):
+        """All the directories the kdc's users create,
+           as paths outside the chroot"""
+        return [
+            self.keytabDirectory(True),
+            self.ccacheDirectory(True),
+            self.snapshotDirectory(True) ]
 
     def getKdcDaemonConfigFile(self):
         return os.path.join(
             self.daemonConfigPath,
             KdcDaemonConfig.CONFIG_FILE_NAME )
 
-    def ensure(self):
+    def getKdcClientConfigFile(self):
+        return os.path.join(
+            self.daemonConfigPath,
+            KdcClientConfig.CONFIG_FILE_NAME )
+
+    def kdcCommand(self, command, client=True):
+        """Prefixes command so that it uses this kdc's configuration
+           no matter what the environment says.  Several kdcs may be
+           started at once so the environment can't be relied on."""
+        result = [
+            self.binary('env'),
+            'KRB5_KDC_PROFILE=%s' % os.path.join(
+                '/', self.getKdcDaemonConfigFile() ) ]
+        if client:
+            result.append(
+                'KRB5_CONFIG=%s' % os.path.join(
+                    '/', self.getKdcClientConfigFile() ) )
+        return result + command
+
+    def shellout(self, *args, **kwargs):
+        self.options['kdc-metrics'].count('subprocesses')
+        return CsmakeServiceConfigManager.shellout(self, *args, **kwargs)
+
+    def _ensureDirectory(self, path, description):
         try:
-            try:
-                self.shellout(
-                    subprocess.check_output,
-                    ['stat', '-c', '', self.fullDaemonConfigPath],
-                    in_chroot=False,
-                    quiet_check=True )
-                result=0
-            except:
-                result=1
-            if result == 0:
-                self.log.devdebug("The kdc config directory already exists")
+            if self.filesystem.makedirs(path):
+                self.log.devdebug("The kdc %s directory did not exist, created", description)
             else:
-                self.log.devdebug("The kdc config directory does not exist, creating")
-                self.shellout(
-                    subprocess.check_call,
-                    ['mkdir', '-p', self.fullDaemonConfigPath],
-                    in_chroot=False)
+                self.log.devdebug("The kdc %s directory already exists", description)
         except:
-            self.log.exception("Attempt to create kdc config directory '%s' failed", self.fullDaemonConfigPath )
+            self.log.exception("Attempt to create kdc %s directory '%s' failed", description, path )
             self.log.warning("The kdc will not have the appropriate configuration")
 
-        CsmakeServiceConfigManager.ensure(self)
+    def ensure(self):
+        with self.options['kdc-metrics'].span('ensure'):
+            self._ensureDirectory(self.fullDaemonConfigPath, 'config')
+            if self.fullDatabasePath != self.fullDaemonConfigPath:
+                self._ensureDirectory(self.fullDatabasePath, 'database')
+
+            CsmakeServiceConfigManager.ensure(self)
 
     def clean(self):
         CsmakeServiceConfigManager.clean(self)
-        if os.path.exists(self.fullDaemonConfigPath):
-            try:
-                self.shellout(
-                    subprocess.check_output,
-                    ['rmdir', '-p', self.fullDaemonConfigPath],
-                    in_chroot = False,
-                    quiet_check=True )
-            except Exception as e:
-                self.log.devdebug(
-                    "The kdc config could not be deleted '%s': %s: %s",
-                    self.fullDaemonConfigPath,
-                    e.__class__.__name__,
-                    str(e) )
+        if self.fullDatabasePath != self.fullDaemonConfigPath \
+            and not self.filesystem.removeDirectory(self.fullDatabasePath):
+            self.log.devdebug(
+                "The kdc database directory could not be deleted '%s'",
+                self.fullDatabasePath )
+        if not self.filesystem.removeDirectory(self.fullDaemonConfigPath, True):
+            self.log.devdebug(
+                "The kdc config could not be deleted '%s'",
+                self.fullDaemonConfigPath )
 
 class KdcServiceDaemon(CsmakeServiceDaemon):
+    #Where a leased kdc logs, the csmake log will be gone
+    #long before the kdc is
+    LOG_FILE_NAME = 'csmake.kdc.log'
+
     def __init__(self, module, provider, options):
         CsmakeServiceDaemon.__init__(self, module, provider, options)
         self.configManagerClass = KdcServiceConfigManager
         self.process = None
+        self.processGroup = None
+        self.kdcGroups = []
+        self.readyTime = None
+        self.logReader = None
 
     def _setupConfigs(self):
         prefix = ''
@@ -275,10 +1091,43 @@ class KdcServiceDaemon(CsmakeServiceDaemon):
 
         CsmakeServiceDaemon._setupConfigs(self)
 
+    def _attach(self):
+        lease = self.options['leased']
+        self.processGroup = lease['pgid']
+        self.kdcGroups = lease.get('kdc-pgids', [])
+        self.readyTime = 0.0
+        #The leased kdc already has the port, as on the spawn path
+        self.options['port'].unbind()
+        self.log.info(
+            "Attached to the leased kdc (pid %d) on port %d",
+            lease['pid'],
+            lease['port'] )
+
+    def _writeLease(self):
+        address, port = KdcConfigurationHelper.kdcAddress(self.options)
+        lease = KdcLease(self.configManager.fullDaemonConfigPath)
+        lease.write({
+            'pid' : self.process.pid,
+            'pgid' : self.processGroup,
+            'kdc-pgids' : self.kdcGroups,
+            'sudo' : not KdcConfigurationHelper.noSudo(self.options),
+            'address' : address,
+            'port' : port,
+            'hash' : self.options['lease-hash'],
+            'timeout' : self.options['lease-timeout'],
+            'expiry' : time.time() + self.options['lease-timeout'],
+            'files' : self.configManager.kdcFiles(),
+            'directories' : self.configManager.kdcDirectories() })
+        lease.startWatcher()
+        self.log.info(
+            "The kdc is leased for %s seconds after its last use",
+            str(self.options['lease-timeout']) )
+
     def _startListening(self):
-        fullkdc = self.configManager.shellout(
-            subprocess.check_output,
-            ['which', 'krb5kdc'] ).strip()
+        if self.options['leased'] is not None:
+            self._attach()
+            return
+        fullkdc = self.configManager.binary('krb5kdc')
         #TODO: Figure out command and environment for kdc
         #      Thoughts may include
         #      KRB5_CONFIG (multiple files with colon) for the client
@@ -287,78 +1136,378 @@ class KdcServiceDaemon(CsmakeServiceDaemon):
         port = self.options['port']
         port.lock()
         command = [
-          fullkdc.strip(), '-n', '-p', str(port.address()[1]), '-r', self.options['realm']
+          fullkdc, '-n', '-p', str(port.address()[1])
         ]
+        if self.options['workers'] > 1:
+            command.extend(['-w', str(self.options['workers'])])
+        for realm in self.options['realms']:
+            command.extend(['-r', realm])
         self.log.debug("Calling Popen with: %s", ' '.join(command))
         port.unbind()
         #time.sleep(360)
         try:
-            self.process = self.configManager.shellout(
-                subprocess.Popen,
-                command,
-                with_user_env=True )
+            #The kdc gets its own session (and process group) so that
+            #everything it starts can be stopped with a signal to the group
+            extra = {}
+            if self.options['lease']:
+                extra['stdout'] = open(os.path.join(
+                    self.configManager.fullDaemonConfigPath,
+                    self.LOG_FILE_NAME ), 'a')
+                extra['stderr'] = subprocess.STDOUT
+            elif self.options['kdc-log'] == 'stream':
+                extra['stdout'] = subprocess.PIPE
+                extra['stderr'] = subprocess.STDOUT
+            try:
+                with self.options['kdc-metrics'].span('spawn'):
+                    self.process = self.configManager.shellout(
+                        subprocess.Popen,
+                        self.configManager.kdcCommand(command),
+                        with_user_env=True,
+                        preexec_fn=os.setsid,
+                        **extra )
+            finally:
+                #The kdc has its own copy of the lease's log file
+                if extra.get('stdout') not in (None, subprocess.PIPE):
+                    extra['stdout'].close()
+            self.processGroup = self.process.pid
+            if self.process.stdout is not None:
+                self.logReader = KdcLogReader(
+                    self.process.stdout,
+                    self.log,
+                    self.options['kdc-log-buffer'],
+                    self.options['kdc-log-interval'] )
+                self.logReader.start()
             if self.process.poll() is not None:
+                self._logRecentLines()
                 raise Exception("Process is not running")
-            address = port.address()
-            #Wait for 5 seconds to see the process come about
-            for x in range(0,50):
-                try:
-                    subprocess.check_call(
-                        ['nc', '-u', '-z', address[0], str(address[1])] )
-                    #Process is listening - probably
-                    if self.process.poll() is not None:
-                        raise Exception("Process is not running")
-                    break
-                except:
-                    #Process is not listening yet wait .1 sec and try again
-                    time.sleep(.1)
-                    if self.process.poll() is not None:
-                        raise Exception("Process is not running")
-            else:
+            started = time.time()
+            probe = KdcProbe(
+                KdcConfigurationHelper.kdcAddress(self.options),
+                self.options['realm'],
+                KdcConfigurationHelper.enctypeNumbers(self.options) )
+            try:
+                with self.options['kdc-metrics'].span('ready'):
+                    self.readyTime = probe.waitUntilReady(
+                        self.options['ready-timeout'],
+                        self.options['transports'],
+                        alive=lambda: self.process.poll() is None )
+                    if self.options['workers'] > 1:
+                        self._waitForWorkers(
+                            self.options['ready-timeout'] - self.readyTime )
+                        self.readyTime = time.time() - started
+            except KdcNotReadyError as e:
+                self._logRecentLines()
                 if self.process.poll() is not None:
                     raise Exception("Process never started")
-                else:
-                    raise Exception("Process didn't listen after 5 seconds")
+                raise Exception(str(e))
+            self.kdcGroups = self._findKdcGroups()
+            self.log.info("The kdc was ready in %0.3f seconds", self.readyTime)
+            if self.options['lease']:
+                self._writeLease()
         finally:
             port.unlock()
 
-    def _cleanup(self):
+    def _logRecentLines(self):
+        """Logs what the kdc wrote last, e.g., why it didn't start"""
+        if self.logReader is None:
+            return
+        self.logReader.join(.1)
+        for line in self.logReader.recentLines()[-20:]:
+            self.log.info("krb5kdc: %s", line)
+
+    def _finishLog(self):
+        if self.logReader is None:
+            return
+        self.logReader.join(1.0)
+        stats = self.logReader.stats()
+        self.options['kdc-metrics'].count('kdc-requests', stats['requests'])
+        self.options['kdc-metrics'].count('kdc-request-errors', stats['errors'])
+
+    @contextmanager
+    def quiesced(self):
+        """Stops the kdc (SIGSTOP) for the duration, so its database can
+           be copied or replaced without it reading a partial file"""
+        stopped = False
+        if self.processGroup is not None:
+            stopped = self._signalGroup(signal.SIGSTOP)
         try:
+            yield
+        finally:
+            if stopped:
+                self._signalGroup(signal.SIGCONT)
+
+    @staticmethod
+    def _processTable():
+        """pid -> (parent pid, process group, command name)"""
+        result = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % pid) as statfile:
+                    stat = statfile.read()
+            except (IOError, OSError):
+                continue
+            #pid (comm) state ppid pgrp ...
+            comm = stat[stat.index('(')+1:stat.rindex(')')]
+            fields = stat[stat.rindex(')')+2:].split()
+            result[int(pid)] = (int(fields[1]), int(fields[2]), comm)
+        return result
+
+    def _kdcProcesses(self):
+        """(pid, parent pid, process group) of the krb5kdc processes started for
+           this kdc, i.e., descended from the process that was spawned.
+           Under sudo (with use_pty, the default since sudo 1.9.14) the
+           kdc isn't in the spawned process's group."""
+        table = self._processTable()
+        children = {}
+        for pid, (ppid, pgrp, comm) in table.items():
+            children.setdefault(ppid, []).append(pid)
+        result = []
+        pending = [self.process.pid]
+        while len(pending) != 0:
+            pid = pending.pop()
+            if pid in table and table[pid][2] == 'krb5kdc':
+                result.append((pid, table[pid][0], table[pid][1]))
+            pending.extend(children.get(pid, []))
+        return result
+
+    def _findKdcGroups(self):
+        """The process groups, other than processGroup, that krb5kdc
+           is running in.  They are signalled with processGroup."""
+        return sorted(set([ pgrp for pid, ppid, pgrp in self._kdcProcesses()
+                            if pgrp != self.processGroup ]))
+
+    def _kdcWorkers(self):
+        """The pids of the krb5kdc workers, the krb5kdc processes
+           started by the krb5kdc supervisor"""
+        processes = self._kdcProcesses()
+        kdcs = set([ pid for pid, ppid, pgrp in processes ])
+        return set([ pid for pid, ppid, pgrp in processes if ppid in kdcs ])
+
+    def _probeWorkers(self, probe, count):
+        """Sends count probes at once, spread over the transports, so
+           that the requests are taken by different workers"""
+        transports = self.options['transports']
+        KdcConfigurationHelper.runConcurrently(
+            lambda index: probe.probe(transports[index % len(transports)], .25),
+            range(count),
+            count )
+
+    def _waitForWorkers(self, timeout):
+        """With -w, krb5kdc forks the workers that actually serve requests
+           The kdc is ready once every worker has answered a probe, a
+           worker's pid is in the kdc's log line for each request it
+           answers.  Without the log (kdc-log=console or a leased kdc)
+           the kdc is ready once all the workers are running."""
+        expected = self.options['workers']
+        deadline = time.time() + timeout
+        probe = KdcProbe(
+            KdcConfigurationHelper.kdcAddress(self.options),
+            self.options['realm'],
+            KdcConfigurationHelper.enctypeNumbers(self.options) )
+        delay = .005
+        while True:
+            workers = self._kdcWorkers()
+            served = set()
+            if len(workers) >= expected:
+                if self.logReader is None:
+                    return
+                served = self.logReader.probedProcesses() & workers
+                if len(served) >= expected:
+                    return
+                self._probeWorkers(probe, 2 * expected)
+            if self.process.poll() is not None:
+                raise KdcNotReadyError("The kdc is not running")
+            now = time.time()
+            if now >= deadline:
+                if len(workers) < expected:
+                    raise KdcNotReadyError(
+                        "Only %d of %d kdc workers started" % (
+                            len(workers), expected ) )
+                raise KdcNotReadyError(
+                    "Only %d of %d kdc workers answered requests" % (
+                        len(served), expected ) )
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, .1)
+
+    def _groups(self):
+        #krb5kdc's own groups first: a SIGSTOP sent only to sudo
+        #wouldn't reach the kdc
+        return self.kdcGroups + [self.processGroup]
+
+    def _signalGroup(self, signum):
+        """Sends signum to the kdc's process groups
+           Returns False if there is nothing left in any of them"""
+        signalled = False
+        for group in self._groups():
             try:
-                processes = self.configManager.shellout(
-                    subprocess.check_output,
-                    [ 'ps', '-o', 'pid', '--ppid', str(self.process.pid), '--noheaders' ] )
-                processes = processes.split()
-                for process in processes:
-                    self.configManager.shellout(
-                        subprocess.call,
-                        [ 'kill', '-9', process ] )
-            except:
-                self.log.exception("Could not stop kdc using standard procedure, attempting to use sudo calls exclusively")
-                subprocess.call("""set -eux
-                    for x in `sudo ps -o pid --ppid %d --noheaders`
-                    do
-                        sudo kill -9 $x
-                    done
-                    """ % self.process.pid,
-                    shell=True,
-                    stdout=self.log.out(),
-                    stderr=self.log.err() )
-                subprocess.call(
-                    ['sudo', 'kill', str(self.process.pid)],
-                    stdout=self.log.out(),
-                    stderr=self.log.err())
+                os.killpg(group, signum)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    continue
+                if e.errno != errno.EPERM:
+                    raise
+                #The kdc is running as another user (i.e., under sudo)
+                self.configManager.shellout(
+                    subprocess.call,
+                    ['kill', '-s', str(signum), '--', '-%d' % group],
+                    in_chroot=False )
+            signalled = True
+        return signalled
+
+    def _groupExists(self):
+        for group in self._groups():
+            try:
+                os.killpg(group, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    continue
+            return True
+        return False
+
+    def _processExited(self):
+        if self.process is None:
+            return True
+        return self.process.poll() is not None
+
+    def _waitForGroup(self, timeout):
+        deadline = time.time() + timeout
+        delay = .005
+        while True:
+            if self._processExited() and not self._groupExists():
+                return True
+            now = time.time()
+            if now >= deadline:
+                return False
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, .1)
+
+    def _cleanup(self):
+        with self.options['kdc-metrics'].span('cleanup'):
+            self._stopKdc()
+
+    def _stopKdc(self):
+        if self.options['lease']:
+            lease = KdcLease(self.configManager.fullDaemonConfigPath)
+            if not self.options['lease-release']:
+                if lease.extend() is not None:
+                    self.log.info("The kdc lease was extended")
+                return
+            lease.remove()
+        if self.processGroup is None:
+            return
+        start = time.time()
+        try:
+            killed = False
+            if self._signalGroup(signal.SIGTERM):
+                if not self._waitForGroup(self.options['stop-timeout']):
+                    self.log.warning(
+                        "The kdc did not stop after %s seconds, killing it",
+                        str(self.options['stop-timeout']) )
+                    killed = True
+                    self._signalGroup(signal.SIGKILL)
+                    self._waitForGroup(self.options['stop-timeout'])
+            status = None
+            if self.process is not None:
+                status = self.process.poll()
+            self.log.info(
+                "The kdc %s with status %s in %0.3f seconds",
+                'was killed' if killed else 'stopped',
+                str(status),
+                time.time() - start )
+            self._finishLog()
         except:
             self.log.exception("Couldn't terminate process cleanly")
 
+#The kdc for backend=python, see KdcPython
+#Only the client configuration is written, the principals are kept
+#in memory and the kdc is a pair of threads in this process.
+class KdcPythonDaemon(KdcServiceDaemon):
+
+    def __init__(self, module, provider, options):
+        KdcServiceDaemon.__init__(self, module, provider, options)
+        self.store = None
+        self.server = None
+
+    def _setupConfigs(self):
+        prefix = ''
+        if self.options['config-path'] is not None:
+            prefix = [self.options['config-path']]
+
+        self.configManager.register(
+            KdcClientConfig,
+            prefix,
+            ensure=False )
+
+        CsmakeServiceDaemon._setupConfigs(self)
+
+    def _startListening(self):
+        started = time.time()
+        self.store = KdcPrincipalStore(
+            self.options['realms'],
+            KdcDaemonConfig.enctypeNames(self.options) )
+        self.logReader = KdcLogReader(
+            None,
+            self.log,
+            self.options['kdc-log-buffer'],
+            self.options['kdc-log-interval'] )
+        port = self.options['port']
+        port.lock()
+        try:
+            port.unbind()
+            with self.options['kdc-metrics'].span('spawn'):
+                self.server = KdcPythonServer(
+                    self.store,
+                    KdcConfigurationHelper.kdcAddress(self.options),
+                    self.options['transports'],
+                    self.logReader.record,
+                    self.log )
+                self.server.start()
+        finally:
+            port.unlock()
+        self.readyTime = time.time() - started
+        self.log.info("The python kdc was ready in %0.3f seconds", self.readyTime)
+
+    def _cleanup(self):
+        with self.options['kdc-metrics'].span('cleanup'):
+            if self.server is not None:
+                self.server.shutdown()
+                self.server = None
+                self.log.info("The python kdc stopped")
+                self._finishLog()
+            if not self.configManager.keepFiles():
+                self.configManager.filesystem.remove([
+                    self.configManager.keytabDirectory(True),
+                    self.configManager.ccacheDirectory(True) ])
+
 class KdcServiceProvider(CsmakeServiceProvider):
 
     serviceProviders = {}
 
+    KEYTAB_DIRECTORY_NAME = 'keytabs'
+    KEYTAB_KVNO_SUFFIX = '.kvno'
+    CCACHE_DIRECTORY_NAME = 'ccaches'
+    SNAPSHOT_DIRECTORY_NAME = 'snapshots'
+    SNAPSHOT_NAME = re.compile(r'^[\w.-]+$')
+    BACKENDS = ['mit', 'python']
+
     def __init__(self, module, tag, **options):
         CsmakeServiceProvider.__init__(self, module, tag, **options)
         self.serviceClass = KdcServiceDaemon
+        if self.options.get('backend') == 'python':
+            self.serviceClass = KdcPythonDaemon
         self.fullkadminlocal = None
+        self.adminSessions = {}
+        self.keytabLock = threading.Lock()
+        self.principalIndex = {}
+        self.principalIndexLock = threading.Lock()
+        self.ccacheLocks = {}
+        self.ccacheLocksLock = threading.Lock()
+        self.metrics = KdcMetrics(tag)
+        self.options['kdc-metrics'] = self.metrics
+        self.readiness = KdcReadiness()
+        self.startThread = None
 
     def _processOptions(self):
         CsmakeServiceProvider._processOptions(self)
@@ -366,6 +1515,17 @@ class KdcServiceProvider(CsmakeServiceProvider):
             self.options['config-path'] = tempfile.mkdtemp(prefix='csmake-kerberos-')
         if 'realm' not in self.options:
             self.options['realm'] = 'CSMAKE.DOMAIN'
+        #The first realm is the default realm for the kdc
+        self.options['realms'] = self.module._parseCommaAndNewlineList(
+            self.options['realm'] )
+        self.options['realm'] = self.options['realms'][0]
+
+        if 'cross-realm-trust' not in self.options:
+            self.options['cross-realm-trust'] = False
+        else:
+            self.options['cross-realm-trust'] = self.options['cross-realm-trust'] == 'True'
+        if 'cross-realm-password' not in self.options:
+            self.options['cross-realm-password'] = 'csmake'
 
         if 'change-env-vars' not in self.options:
             self.options['change-env-vars'] = True
@@ -375,37 +1535,824 @@ class KdcServiceProvider(CsmakeServiceProvider):
         if 'config-dir-env' in self.options:
             self.module.env.env[self.options['config-dir-env']] = self.options['config-path']
 
+        if 'workers' not in self.options:
+            self.options['workers'] = 1
+        elif self.options['workers'] == 'auto':
+            self.options['workers'] = multiprocessing.cpu_count()
+        else:
+            self.options['workers'] = int(self.options['workers'])
+
+        if 'enctypes' not in self.options:
+            self.options['enctypes'] = list(KdcDaemonConfig.DEFAULT_ENCTYPES)
+        else:
+            self.options['enctypes'] = self.module._parseCommaAndNewlineList(
+                self.options['enctypes'] )
+        if len(self.options['enctypes']) == 0:
+            raise ValueError("The kdc needs at least one enctype")
+
+        if 'transports' not in self.options:
+            self.options['transports'] = list(KdcDaemonConfig.TRANSPORTS)
+        else:
+            self.options['transports'] = [ transport.lower() for transport in
+                self.module._parseCommaAndNewlineList(self.options['transports']) ]
+        for transport in self.options['transports']:
+            if transport not in KdcDaemonConfig.TRANSPORTS:
+                raise ValueError("transports may only have: %s" % ', '.join(
+                    KdcDaemonConfig.TRANSPORTS ) )
+        if len(self.options['transports']) == 0:
+            raise ValueError("The kdc needs at least one of the transports")
+        if 'client-transport' not in self.options:
+            self.options['client-transport'] = 'any'
+        if self.options['client-transport'] not in KdcClientConfig.TRANSPORT_PREFIXES:
+            raise ValueError("client-transport must be one of: %s" % ', '.join(
+                sorted(KdcClientConfig.TRANSPORT_PREFIXES.keys()) ) )
+        if 'udp-preference-limit' not in self.options:
+            self.options['udp-preference-limit'] = None
+        else:
+            self.options['udp-preference-limit'] = int(self.options['udp-preference-limit'])
+
+        if 'client-profile' not in self.options:
+            self.options['client-profile'] = 'standard'
+        if self.options['client-profile'] not in KdcClientConfig.PROFILES:
+            raise ValueError("client-profile must be one of: %s" % ', '.join(
+                KdcClientConfig.PROFILES ) )
+        if 'ccache-type' not in self.options:
+            self.options['ccache-type'] = 'FILE'
+        self.options['ccache-type'] = self.options['ccache-type'].upper()
+        if self.options['ccache-type'] not in KdcClientConfig.CCACHE_TYPES:
+            raise ValueError("ccache-type must be one of: %s" % ', '.join(
+                KdcClientConfig.CCACHE_TYPES ) )
+        if 'replay-cache' not in self.options:
+            self.options['replay-cache'] = True
+        else:
+            self.options['replay-cache'] = self.options['replay-cache'] == 'True'
+        if 'client-timeout' not in self.options:
+            self.options['client-timeout'] = None
+        else:
+            self.options['client-timeout'] = int(self.options['client-timeout'])
+
+        if 'kdc-log' not in self.options:
+            self.options['kdc-log'] = 'stream'
+        if self.options['kdc-log'] not in KdcDaemonConfig.LOG_DESTINATIONS:
+            raise ValueError("kdc-log must be one of: %s" % ', '.join(
+                sorted(KdcDaemonConfig.LOG_DESTINATIONS.keys()) ) )
+        if 'kdc-log-buffer' not in self.options:
+            self.options['kdc-log-buffer'] = 1000
+        else:
+            self.options['kdc-log-buffer'] = int(self.options['kdc-log-buffer'])
+        if 'kdc-log-interval' not in self.options:
+            self.options['kdc-log-interval'] = 10.0
+        else:
+            self.options['kdc-log-interval'] = float(self.options['kdc-log-interval'])
+
+        if 'ready-timeout' not in self.options:
+            self.options['ready-timeout'] = 5.0
+        else:
+            self.options['ready-timeout'] = float(self.options['ready-timeout'])
+
+        if 'stop-timeout' not in self.options:
+            self.options['stop-timeout'] = 2.0
+        else:
+            self.options['stop-timeout'] = float(self.options['stop-timeout'])
+
+        #The templates hold the master key's stash, so keeping them
+        #outside the build is asked for, never assumed
+        if 'template-cache' not in self.options:
+            self.options['template-cache'] = False
+        else:
+            self.options['template-cache'] = self.options['template-cache'] == 'True'
+        if 'template-cache-path' not in self.options:
+            self.options['template-cache-path'] = None
+        if 'template-cache-size' not in self.options:
+            self.options['template-cache-size'] = 16
+        else:
+            self.options['template-cache-size'] = int(self.options['template-cache-size'])
+
+        if 'database-path' not in self.options:
+            self.options['database-path'] = None
+        if 'db-library' not in self.options:
+            self.options['db-library'] = 'db2'
+        if self.options['db-library'] not in KdcDaemonConfig.DATABASE_SUFFIXES:
+            raise ValueError("db-library must be one of: %s" % ', '.join(
+                KdcDaemonConfig.DATABASE_SUFFIXES.keys() ) )
+
+        if 'start-async' not in self.options:
+            self.options['start-async'] = False
+        else:
+            self.options['start-async'] = self.options['start-async'] == 'True'
+
+        if 'keep-config' not in self.options:
+            self.options['keep-config'] = False
+        else:
+            self.options['keep-config'] = self.options['keep-config'] == 'True'
+
+        if 'lease' not in self.options:
+            self.options['lease'] = False
+        else:
+            self.options['lease'] = self.options['lease'] == 'True'
+        if 'lease-timeout' not in self.options:
+            self.options['lease-timeout'] = 600.0
+        else:
+            self.options['lease-timeout'] = float(self.options['lease-timeout'])
+        self.options['lease-release'] = False
+        self.options['lease-hash'] = self.leaseHash(self.options)
+        self.options['leased'] = None
+
+        if 'metrics' not in self.options:
+            self.options['write-metrics'] = False
+        else:
+            self.options['write-metrics'] = self.options['metrics'] == 'True'
+        if 'metrics-hook' not in self.options:
+            self.options['metrics-hook'] = None
+
+        if 'principals-file' not in self.options:
+            self.options['principals-file'] = None
+
         if 'principals' not in self.options or self.options['principals'] is None:
             self.options['principals'] = []
         else:
             self.options['principals'] = self.module._parseCommaAndNewlineList(self.options['principals'])
 
+        if 'preauth-principals' not in self.options:
+            self.options['preauth-principals'] = []
+        else:
+            self.options['preauth-principals'] = self.parsePrincipals(
+                self.module._parseCommaAndNewlineList(
+                    self.options['preauth-principals'] ),
+                dict(self.parsePrincipals(self.options['principals'])) )
+        if 'preauth-env' not in self.options:
+            self.options['preauth-env'] = 'KRB5CCNAME_'
+        if 'preauth-workers' not in self.options:
+            self.options['preauth-workers'] = 8
+        else:
+            self.options['preauth-workers'] = int(self.options['preauth-workers'])
+        if 'preauth-renew-margin' not in self.options:
+            self.options['preauth-renew-margin'] = 300.0
+        else:
+            self.options['preauth-renew-margin'] = float(self.options['preauth-renew-margin'])
+
+        if 'backend' not in self.options:
+            self.options['backend'] = 'mit'
+        if self.options['backend'] not in self.BACKENDS:
+            raise ValueError("backend must be one of: %s" % ', '.join(
+                self.BACKENDS ) )
+        if self.options['backend'] == 'python':
+            if self.options['lease']:
+                raise ValueError("A kdc with backend=python can't be leased")
+            for enctype in self.options['enctypes']:
+                try:
+                    KdcCrypto.enctypeNumber(enctype)
+                except KdcCrypto.KdcCryptoError as e:
+                    raise ValueError("backend=python: %s" % str(e))
+            #There is no database to keep a template of
+            self.options['template-cache'] = False
+
+        if self.options['lease']:
+            self.options['leased'] = self._findLease()
+
+    @staticmethod
+    def parsePrincipals(entries, passwords={}):
+        """Turns principal[:password] entries into (principal, password)
+           A principal without a password gets its password from
+           passwords, or 'csmake'"""
+        result = []
+        for entry in entries:
+            if ':' in entry:
+                principal, password = entry.split(':',1)
+                result.append((principal, password))
+            else:
+                result.append((entry, passwords.get(entry, 'csmake')))
+        return result
+
+    @classmethod
+    def readPrincipalsFile(clazz, path):
+        """Yields (principal, password) for each principal[:password]
+           line in the file, blank lines and # comments are skipped"""
+        with open(path) as principals:
+            for line in principals:
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+                yield clazz.parsePrincipals([line])[0]
+
+    @staticmethod
+    def splitPrincipal(principal, options):
+        """Returns (name, realm) for the principal
+           A principal's realm is only kept if the kdc serves it,
+           otherwise the principal is in the kdc's default realm"""
+        if '@' in principal:
+            name, realm = principal.split('@', 1)
+            if realm in options['realms']:
+                return name, realm
+            return name, options['realm']
+        return principal, options['realm']
+
+    @staticmethod
+    def crossRealmPrincipals(options):
+        """Returns realm -> [trust principal, ...]
+           Each realm's database gets the krbtgt principals that
+           any realm would use to get to it, or that it would use to get
+           to any other realm.  The keys are the same in both databases."""
+        result = {}
+        for realm in options['realms']:
+            result[realm] = []
+        if not options['cross-realm-trust']:
+            return result
+        for source in options['realms']:
+            for target in options['realms']:
+                if source == target:
+                    continue
+                trust = 'krbtgt/%s@%s' % (target, source)
+                result[source].append(trust)
+                result[target].append(trust)
+        return result
+
+    @classmethod
+    def initialPrincipals(clazz, options):
+        """Returns realm -> [(principal, password), ...] for the principals
+           that are created when the kdc starts"""
+        result = {}
+        for realm in options['realms']:
+            result[realm] = []
+        for principal, password in clazz.parsePrincipals(options['principals']):
+            name, realm = clazz.splitPrincipal(principal, options)
+            result[realm].append((name, password))
+        for realm, trusts in clazz.crossRealmPrincipals(options).items():
+            for trust in trusts:
+                result[realm].append((trust, options['cross-realm-password']))
+        return result
+
+    @staticmethod
+    def leaseHash(options):
+        """Hash of everything that has to match to reuse a leased kdc:
+           everything rendered into kdc.conf or onto the krb5kdc command
+           line.  The principals aren't part of it, they are reconciled"""
+        configuration = {
+            'realms' : options['realms'],
+            'cross-realm-trust' : options['cross-realm-trust'],
+            'cross-realm-password' : options['cross-realm-password'],
+            'enctypes' : options['enctypes'],
+            'master' : KdcDaemonConfig.MASTER_PASSWORD,
+            'database-path' : options['database-path'],
+            'db-library' : options['db-library'],
+            'transports' : options['transports'],
+            'workers' : options['workers'],
+            'kdc-log' : options['kdc-log'],
+            'chroot' : options.get('chroot') }
+        for option in KdcConfigurationHelper.BINARY_OPTIONS.values():
+            configuration[option] = options.get(option)
+        return hashlib.sha256(
+            json.dumps(configuration, sort_keys=True).encode('utf-8') ).hexdigest()
+
+    def _hostConfigPath(self):
+        """config-path as seen from outside the chroot"""
+        root = self.options.get('chroot')
+        if root is None or len(root) == 0:
+            root = '/'
+        return os.path.join(root, self.options['config-path'].lstrip('/'))
+
+    def _findLease(self):
+        lease = KdcLease(self._hostConfigPath()).valid(
+            self.options['lease-hash'] )
+        if lease is None:
+            return None
+        try:
+            KdcProbe(
+                (lease['address'], lease['port']),
+                self.options['realm'],
+                KdcConfigurationHelper.enctypeNumbers(self.options) ).waitUntilReady(
+                    min(self.options['ready-timeout'], .5),
+                    self.options['transports'] )
+        except KdcNotReadyError:
+            self.module.log.info("The leased kdc isn't answering, starting a new kdc")
+            return None
+        return lease
+
+    def releaseLease(self):
+        """The kdc will be stopped when the service is stopped
+           even though it is leased"""
+        self.options['lease-release'] = True
+
     def startService(self):
+        #Fail before anything is set up if the kdc tools aren't there
+        for binary in KdcConfigurationHelper.BINARY_PACKAGES:
+            if self.options['backend'] == 'python' \
+                and binary not in KdcConfigurationHelper.PYTHON_BINARIES:
+                continue
+            if binary in KdcConfigurationHelper.OPTIONAL_BINARIES \
+                and not self.options[KdcConfigurationHelper.OPTIONAL_BINARIES[binary]]:
+                continue
+            KdcConfigurationHelper.resolveOptionBinary(binary, self.options)
+
+        if not self.options['start-async']:
+            self._startAndSignal()
+            return
+        self.startThread = threading.Thread(
+            target=self._startAndSignal,
+            name='kdc-start-%s' % self.metrics.tag )
+        self.startThread.daemon = True
+        self.startThread.start()
+
+    def _startAndSignal(self):
+        try:
+            with self.metrics.span('start'):
+                self._startService()
+        except Exception as e:
+            self.readiness.setException(e)
+            if not self.options['start-async']:
+                raise
+            self.module.log.exception("The kdc could not be started")
+        else:
+            self.readiness.setResult(self)
+
+    def waitForService(self, timeout=None):
+        """Blocks until the kdc has started, raises whatever kept it
+           from starting"""
+        if self.startThread is None and not self.readiness.done():
+            #startService hasn't been called, there's nothing to wait for
+            timeout = 0
+        return self.readiness.result(timeout)
+
+    def _waitForStart(self, timeout=None):
+        if self.startThread is not None:
+            self.readiness.wait(timeout)
+
+    @classmethod
+    def getServiceProvider(clazz, tag, timeout=None):
+        """The provider once its kdc has finished starting (or failed to,
+           see waitForService) or timeout seconds have passed"""
+        provider = super(KdcServiceProvider, clazz).getServiceProvider(tag)
+        if provider is not None:
+            provider._waitForStart(timeout)
+        return provider
+
+    def _startService(self):
         self.service = CsmakeServiceProvider.startService(self)
 
-        self.fullkadminlocal = self.service.configManager.shellout(
-            subprocess.check_output,
-            ['which', 'kadmin.local'] ).strip()
-        for principal in self.options['principals']:
-            if ':' in principal:
-                principal, password = principal.split(':',1)
-                self.addPrincipal(principal, password)
+        manager = self.service.configManager
+        if self.options['backend'] != 'python':
+            self.fullkadminlocal = manager.binary('kadmin.local')
+        self._openAdminSessions()
+        initial = self.initialPrincipals(self.options)
+        for realm in self.options['realms']:
+            if self.options['leased'] is not None \
+                or manager.databasesReused.get(realm):
+                with self.metrics.span('reconcile-principals:%s' % realm):
+                    self._reconcileRealmPrincipals(realm, initial[realm])
+            elif manager.templateHits.get(realm):
+                self.module.log.devdebug(
+                    "Principals for %s were provided by the database template",
+                    realm )
             else:
-                self.addPrincipal(principal)
-        
+                with self.metrics.span('seed-principals:%s' % realm):
+                    self._addRealmPrincipals(realm, initial[realm])
+                with self.metrics.span('template-store:%s' % realm):
+                    manager.storeTemplate(realm)
+        if self.options['backend'] == 'python' \
+            and self.options['principals-file'] is not None:
+            counts = self.loadPrincipalsFile(self.options['principals-file'])
+            self.module.log.info(
+                "Loaded %d principals from %s",
+                sum(counts.values()),
+                self.options['principals-file'] )
+        if len(self.options['preauth-principals']) != 0:
+            with self.metrics.span('preauth'):
+                self._preauthenticate()
+
+    def _openAdminSessions(self):
+        manager = self.service.configManager
+        for realm in self.options['realms']:
+            if self.options['backend'] == 'python':
+                self.adminSessions[realm] = KdcPythonAdminSession(
+                    self.service.store,
+                    realm,
+                    manager.chroot )
+                continue
+            self.adminSessions[realm] = KdcAdminSession(
+                manager,
+                self.fullkadminlocal,
+                realm,
+                manager.binary('stdbuf') )
+
+    def _closeAdminSessions(self):
+        for session in self.adminSessions.values():
+            session.close()
+        self.adminSessions = {}
+
+    def stopService(self):
+        #A kdc that is still starting is stopped once it's up
+        self._waitForStart()
+        try:
+            with self.metrics.span('stop'):
+                self._closeAdminSessions()
+                self._invalidateIndex()
+                return CsmakeServiceProvider.stopService(self)
+        finally:
+            self._reportMetrics()
+
+    def _logReader(self):
+        service = getattr(self, 'service', None)
+        if service is None:
+            return None
+        return service.logReader
+
+    def stats(self):
+        """The requests the kdc has logged: counts and error rates in
+           total and for each client principal, None when the kdc's log
+           isn't read (kdc-log=console or a leased kdc)"""
+        reader = self._logReader()
+        if reader is None:
+            return None
+        return reader.stats()
+
+    def recentRequests(self):
+        """The last kdc-log-buffer requests the kdc logged"""
+        reader = self._logReader()
+        if reader is None:
+            return []
+        return reader.recentEvents()
+
+    def metricsPath(self):
+        """The metrics are kept next to config-path, which is removed
+           when the kdc stops, so they are only written when asked for
+           with metrics=True"""
+        return self._hostConfigPath().rstrip('/') + '.metrics.json'
+
+    def _reportMetrics(self):
+        self.module.log.info("%s", self.metrics.summary())
+        if self.options['write-metrics']:
+            try:
+                self.metrics.write(self.metricsPath())
+                self.module.log.devdebug(
+                    "kdc metrics written to %s", self.metricsPath() )
+            except Exception as e:
+                self.module.log.info(
+                    "The kdc metrics could not be written: %s: %s",
+                    e.__class__.__name__,
+                    str(e) )
+        if self.options['metrics-hook'] is not None:
+            try:
+                self.metrics.forward(self.options['metrics-hook'])
+            except Exception as e:
+                self.module.log.info(
+                    "The kdc metrics could not be given to '%s': %s: %s",
+                    self.options['metrics-hook'],
+                    e.__class__.__name__,
+                    str(e) )
+
+    def _realmIndex(self, realm):
+        """The set of principal@realm in the realm's database
+           It is read with list_principals the first time it's needed
+           and kept up to date by every add and delete after that"""
+        with self.principalIndexLock:
+            index = self.principalIndex.get(realm)
+            if index is None:
+                index = set(self.adminSessions[realm].request('list_principals'))
+                self.principalIndex[realm] = index
+            return index
+
+    def _invalidateIndex(self, realms=None):
+        """Forgets the index for changes made outside of kadmin"""
+        with self.principalIndexLock:
+            if realms is None:
+                self.principalIndex = {}
+            else:
+                for realm in realms:
+                    self.principalIndex.pop(realm, None)
+
+    @staticmethod
+    def _realmPrincipal(principal, realm):
+        #The cross realm principals already have their realm
+        if '@' in principal:
+            return principal
+        return '%s@%s' % (principal, realm)
+
+    def _addRealmPrincipals(self, realm, principals):
+        session = self.adminSessions[realm]
+        index = self._realmIndex(realm)
+        for principal, password in principals:
+            fullname = self._realmPrincipal(principal, realm)
+            if fullname in index:
+                self.module.log.devdebug("%s already exists", fullname)
+                continue
+            try:
+                session.request(
+                    'add_principal -pw %s -e %s %s' % (
+                        password,
+                        ','.join(KdcDaemonConfig.keysalts(self.options)),
+                        principal ) )
+            except KdcAdminError as e:
+                if 'already exists' not in str(e):
+                    raise
+            index.add(fullname)
+
+    def _reconcileRealmPrincipals(self, realm, principals):
+        #Only the missing principals are added
+        self._addRealmPrincipals(realm, principals)
+
+    def _byRealm(self, principals):
+        result = {}
+        for principal, value in principals:
+            name, realm = self.splitPrincipal(principal, self.options)
+            result.setdefault(realm, []).append((name, value))
+        return result
+
+    def addPrincipals(self, principals):
+        """principals is a list of (principal, password) pairs
+           A principal may be given an @realm to choose one of the realms
+           served by the kdc"""
+        for realm, realmPrincipals in self._byRealm(principals).items():
+            self._addRealmPrincipals(realm, realmPrincipals)
+
+    def deletePrincipals(self, principals):
+        """Deletes the principals, a principal that doesn't exist
+           is skipped"""
+        byRealm = self._byRealm([ (principal, None) for principal in principals ])
+        for realm, realmPrincipals in byRealm.items():
+            session = self.adminSessions[realm]
+            index = self._realmIndex(realm)
+            for principal, unused in realmPrincipals:
+                fullname = self._realmPrincipal(principal, realm)
+                if fullname not in index:
+                    self.module.log.devdebug("%s does not exist", fullname)
+                    continue
+                try:
+                    session.request(
+                        'delete_principal -force %s' % principal )
+                except KdcAdminError as e:
+                    if 'does not exist' not in str(e):
+                        raise
+                index.discard(fullname)
+        #A principal added again starts over at the same kvno
+        self._invalidateKeytabs()
+
+    def hasPrincipal(self, principal):
+        """True if the principal is in the kdc (an @realm picks the realm)"""
+        name, realm = self.splitPrincipal(principal, self.options)
+        return '%s@%s' % (name, realm) in self._realmIndex(realm)
+
+    def listPrincipals(self, realm=None):
+        """The principals (as principal@realm) in the realm, or all
+           the kdc's realms"""
+        realms = self.options['realms']
+        if realm is not None:
+            realms = [realm]
+        result = []
+        for realm in realms:
+            result.extend(self._realmIndex(realm))
+        return sorted(result)
+
+    def loadPrincipals(self, principals):
+        """Adds many principals at once with kdb5_util load
+           principals is any iterable of (principal, password) pairs,
+           it is only read once, so it may be a generator.
+           Returns realm -> the number of principals loaded"""
+        with self.metrics.span('load-principals'):
+            try:
+                if self.options['backend'] == 'python':
+                    return self._storePrincipals(principals)
+                return self.service.configManager.loadPrincipals(principals)
+            finally:
+                self._invalidateIndex()
+                self._invalidateKeytabs()
+
+    def _storePrincipals(self, principals):
+        """loadPrincipals for backend=python, straight into the store"""
+        store = self.service.store
+        counts = {}
+        for principal, password in principals:
+            name, realm = self.splitPrincipal(principal, self.options)
+            counts.setdefault(realm, 0)
+            if store.add(realm, self._realmPrincipal(name, realm), password):
+                counts[realm] += 1
+        return counts
+
+    def loadPrincipalsFile(self, path):
+        """Adds the principal[:password] lines of a file, see loadPrincipals"""
+        return self.loadPrincipals(self.readPrincipalsFile(path))
+
     def addPrincipal(self, principal, password='csmake'):
-        principal = principal.split('@')[0]
-        self.service.configManager.shellout(
-            subprocess.check_call,
-            [self.fullkadminlocal, '-r', self.options['realm'],
-               '-p', "K/M", '-q', 'add_principal -pw %s -e RC4-HMAC %s' % (
-                                   password, principal ) ],
-            with_user_env=True )
+        self.addPrincipals([(principal, password)])
 
     def deletePrincipal(self, principal):
-        principal = principal.split('@')[0]
-        self.service.configManager.shellout(
-            subprocess.check_call,
-            [self.fullkadminlocal, '-r', self.options['realm'],
-                '-p', 'K/M', '-q', 'delete_principal --force %s' % principal],
-            with_user_env=True )
+        self.deletePrincipals([principal])
+
+    def _fullPrincipal(self, principal):
+        return '%s@%s' % self.splitPrincipal(principal, self.options)
+
+    def principalKvno(self, principal):
+        """The key version number of the principal's current keys"""
+        name, realm = self.splitPrincipal(principal, self.options)
+        kvno = None
+        for line in self.adminSessions[realm].request('get_principal %s' % name):
+            match = re.match(r'^Key: vno (\d+),', line)
+            if match is not None:
+                kvno = max(kvno or 0, int(match.group(1)))
+        if kvno is None:
+            raise KdcAdminError("'%s' has no keys to export" % principal)
+        return kvno
+
+    @staticmethod
+    def keytabName(principals):
+        """The keytab name used when the caller doesn't give one"""
+        return 'csmake.%s.keytab' % hashlib.sha256(
+            '\0'.join(sorted(principals)).encode('utf-8') ).hexdigest()[:16]
+
+    def _invalidateKeytabs(self):
+        """Forgets the kvnos the exported keytabs were made with, the
+           keys may have changed without a new kvno, e.g., by a delete
+           and add or a restore.  Each keytab is made again when it is
+           next exported"""
+        directory = self.service.configManager.keytabDirectory(True)
+        with self.keytabLock:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                return
+            self.service.configManager.filesystem.remove([
+                os.path.join(directory, name) for name in names
+                if name.endswith(self.KEYTAB_KVNO_SUFFIX) ])
+
+    def exportKeytab(self, principals, name=None):
+        """Puts the current keys of the principals into a single keytab
+           without changing the keys (ktadd -norandkey), so a client may
+           still use the password too.  The keytab is kept in
+           <config-path>/keytabs and only made again when one of the
+           principal's kvno changes, or after a principal is deleted,
+           loaded or restored.
+           Returns the path to the keytab (as seen inside the chroot)"""
+        principals = [ self._fullPrincipal(principal) for principal in principals ]
+        if name is None:
+            name = self.keytabName(principals)
+        manager = self.service.configManager
+        path = manager.keytabFile(name)
+        fullpath = manager.keytabFile(name, True)
+        kvnoPath = fullpath + self.KEYTAB_KVNO_SUFFIX
+        with self.keytabLock:
+            kvnos = dict([ (principal, self.principalKvno(principal))
+                           for principal in principals ])
+            try:
+                with open(kvnoPath) as kvnofile:
+                    cached = json.load(kvnofile)
+            except (IOError, OSError, ValueError):
+                cached = None
+            if cached == kvnos and os.path.exists(fullpath):
+                self.module.log.devdebug("Using the cached keytab %s", path)
+                return path
+
+            manager._ensureDirectory(manager.keytabDirectory(True), 'keytab')
+            #ktadd adds to an existing keytab, the old keys have to go
+            manager.filesystem.remove([fullpath, kvnoPath])
+            exported = set()
+            for realm, realmPrincipals in self._byRealm(
+                [ (principal, None) for principal in principals ] ).items():
+                lines = self.adminSessions[realm].request(
+                    'ktadd -k %s -norandkey %s' % (
+                        path,
+                        ' '.join([ principal for principal, unused in realmPrincipals ]) ) )
+                for line in lines:
+                    match = re.match(r'^Entry for principal (\S+) with kvno', line)
+                    if match is not None:
+                        exported.add('%s@%s' % (
+                            match.group(1).split('@', 1)[0], realm ) )
+            missing = [ principal for principal in principals
+                        if principal not in exported ]
+            if len(missing) != 0:
+                raise KdcAdminError(
+                    "Keys for %s could not be exported to %s" % (
+                        ', '.join(missing), path ) )
+            with open(kvnoPath, 'w') as kvnofile:
+                json.dump(kvnos, kvnofile)
+            self.module.log.devdebug(
+                "Exported %d principals to %s", len(principals), path )
+        return path
+
+    def exportKeytabs(self, principals):
+        """Exports each principal to a keytab of its own, named
+           <principal>.keytab.  Returns principal -> keytab path"""
+        result = {}
+        for principal in principals:
+            result[principal] = self.exportKeytab(
+                [principal],
+                '%s.keytab' % self._fullPrincipal(principal).replace('/', '_') )
+        return result
+
+    def _checkSnapshotName(self, name):
+        if self.SNAPSHOT_NAME.match(name) is None:
+            raise ValueError("'%s' can't be used as a snapshot name" % name)
+
+    def snapshot(self, name='default'):
+        """Checkpoints the principal databases as the snapshot 'name'
+           (replacing any snapshot of the same name).  The kdc keeps
+           running, a db2 database is copied while it is briefly stopped"""
+        self._checkSnapshotName(name)
+        with self.metrics.span('snapshot:%s' % name):
+            if self.options['backend'] == 'python':
+                self.service.store.snapshot(name)
+                return
+            self.service.configManager.takeSnapshot(name, self.service.quiesced)
+
+    def restore(self, name='default'):
+        """Rolls the principal databases back to the snapshot 'name'
+           without restarting the kdc"""
+        self._checkSnapshotName(name)
+        with self.metrics.span('restore:%s' % name):
+            if self.options['backend'] == 'python':
+                try:
+                    self.service.store.restore(name)
+                finally:
+                    self._invalidateIndex()
+                    self._invalidateKeytabs()
+                return
+            db2 = self.options['db-library'] == 'db2'
+            if db2:
+                #kadmin.local has the old database files open
+                self._closeAdminSessions()
+            try:
+                self.service.configManager.restoreSnapshot(
+                    name,
+                    self.service.quiesced,
+                    self._deleteOtherPrincipals )
+            finally:
+                self._invalidateIndex()
+                self._invalidateKeytabs()
+                if db2:
+                    self._openAdminSessions()
+
+    def _deleteOtherPrincipals(self, realm, principals):
+        """Deletes the realm's principals that aren't in principals"""
+        keep = set(principals)
+        self._invalidateIndex([realm])
+        self.deletePrincipals([ principal for principal in self._realmIndex(realm)
+                                if principal not in keep ])
+
+    def snapshots(self):
+        """The names of the snapshots that can be restored"""
+        if self.options['backend'] == 'python':
+            return self.service.store.snapshotNames()
+        manager = self.service.configManager
+        try:
+            names = os.listdir(manager.snapshotDirectory(True))
+        except OSError:
+            return []
+        return sorted([ name for name in names
+                        if manager.snapshotManifest(name) is not None ])
+
+    @staticmethod
+    def ccacheEnvName(prefix, principal):
+        """The csmake environment name for the principal's credential cache
+           e.g., KRB5CCNAME_HOST_MYHOST for host/myhost"""
+        return prefix + re.sub(r'[^A-Za-z0-9]', '_', principal).upper()
+
+    def _ccacheLock(self, principal):
+        with self.ccacheLocksLock:
+            if principal not in self.ccacheLocks:
+                self.ccacheLocks[principal] = threading.Lock()
+            return self.ccacheLocks[principal]
+
+    def credentialCache(self, principal, password='csmake'):
+        """Returns the path (as seen inside the chroot) to a FILE
+           credential cache holding a TGT for the principal.
+           The TGT is reused until it is within preauth-renew-margin
+           seconds of expiring, then kinit is used again."""
+        fullPrincipal = self._fullPrincipal(principal)
+        manager = self.service.configManager
+        path = manager.ccacheFile(fullPrincipal)
+        fullpath = manager.ccacheFile(fullPrincipal, True)
+        with self._ccacheLock(fullPrincipal):
+            expiry = KdcCcache.tgtExpiry(fullpath, fullPrincipal)
+            if expiry is not None \
+                and expiry - time.time() > self.options['preauth-renew-margin']:
+                self.module.log.devdebug("Reusing the TGT for %s", fullPrincipal)
+                return path
+            process = manager.shellout(
+                subprocess.Popen,
+                manager.kdcCommand([
+                    manager.binary('kinit'), '-c', 'FILE:%s' % path,
+                    fullPrincipal ]),
+                with_user_env=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True )
+            output = process.communicate(password + '\n')[0]
+            if process.returncode != 0:
+                raise KdcAdminError("kinit for %s failed: %s" % (
+                    fullPrincipal, output.strip() ) )
+        return path
+
+    def _preauthenticate(self):
+        manager = self.service.configManager
+        manager._ensureDirectory(manager.ccacheDirectory(True), 'credential cache')
+        results = KdcConfigurationHelper.runConcurrently(
+            lambda entry: self.credentialCache(*entry),
+            self.options['preauth-principals'],
+            self.options['preauth-workers'] )
+        for (principal, password), path, exception, seconds in results:
+            if exception is not None:
+                raise exception
+            self.module.env.env[self.ccacheEnvName(
+                self.options['preauth-env'],
+                principal )] = path
+        self.module.log.info(
+            "Got TGTs for %d principals", len(results) )
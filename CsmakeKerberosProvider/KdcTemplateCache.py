@@ -0,0 +1,133 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import fcntl
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+#Holds copies of freshly created (and seeded) kdc databases so that
+#a kdc with the same realm, enctypes, master key and principals
+#can be stood up by copying files instead of running kdb5_util.
+#
+#Each template is a directory named by the template key containing
+#the database files under the names the caller gives them, e.g.:
+#   <cache>/<key>/db, <cache>/<key>/db.kadm5, ...
+#Templates are written to a temporary directory and renamed into place
+#so a reader never sees a partial template.  All access happens
+#under an flock on <cache>/.lock so concurrent builds stay consistent.
+#The templates include the master key's stash file, so the cache
+#directory is only readable by its owner.
+class KdcTemplateCache:
+    DEFAULT_PATH = os.path.join(
+        os.environ.get(
+            'XDG_CACHE_HOME',
+            os.path.join(os.path.expanduser('~'), '.cache') ),
+        'csmake-kerberos-provider',
+        'templates' )
+
+    LOCK_FILE_NAME = '.lock'
+
+    def __init__(self, log, path=None, maxEntries=16):
+        self.log = log
+        self.path = path
+        if self.path is None:
+            self.path = self.DEFAULT_PATH
+        self.maxEntries = maxEntries
+
+    @staticmethod
+    def key(realm, enctypes, masterKey, principals, dbLibrary='db2', principalsDigest=None):
+        keyhash = hashlib.sha256()
+        values = [realm, ' '.join(enctypes), masterKey, dbLibrary]
+        if principalsDigest is not None:
+            values.append(principalsDigest)
+        for principal, password in sorted(principals):
+            values.extend([principal, password])
+        for value in values:
+            keyhash.update((u'%s\0' % value).encode('utf-8'))
+        return keyhash.hexdigest()
+
+    @contextmanager
+    def lock(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, 0o700)
+        with open(os.path.join(self.path, self.LOCK_FILE_NAME), 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+    def fetch(self, key, files):
+        """Puts the template's files in place
+           files is a list of (name, path, linkable), a linkable file is
+           never modified after the database is created so it may be
+           hardlinked instead of copied.
+           Returns True if the template existed and was put in place.
+           The caller must hold the lock."""
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            return False
+        for name, target, linkable in files:
+            source = os.path.join(entry, name)
+            if os.path.exists(target):
+                os.remove(target)
+            if linkable:
+                try:
+                    os.link(source, target)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(source, target)
+        #Mark the template as recently used for eviction
+        os.utime(entry, None)
+        self.log.devdebug("Used kdc database template %s", key)
+        return True
+
+    def store(self, key, files):
+        """Saves the files as the template for key, see fetch
+           The caller must hold the lock."""
+        entry = os.path.join(self.path, key)
+        if os.path.isdir(entry):
+            os.utime(entry, None)
+            return
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.path)
+        try:
+            for name, source, linkable in files:
+                shutil.copy2(source, os.path.join(staging, name))
+            os.rename(staging, entry)
+        except:
+            shutil.rmtree(staging, True)
+            raise
+        self.log.devdebug("Stored kdc database template %s", key)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            entry = os.path.join(self.path, name)
+            if os.path.isdir(entry):
+                entries.append((os.path.getmtime(entry), entry))
+        entries.sort()
+        while len(entries) > self.maxEntries:
+            mtime, entry = entries.pop(0)
+            self.log.devdebug("Evicting kdc database template %s", entry)
+            shutil.rmtree(entry, True)
@@ -24,9 +24,11 @@ class KdcAddPrincipal(CsmakeModule):
                      Default is the default kdc
               principals - Principals to add to the realm of csmake's kdc
                   * The principals are comma or newline delimited.
-                  * Any @realm are ignored.
+                  * An @realm picks one of the kdc's realms, any other
+                    @realm is ignored.
                   * A password may be provided using a colon to separate the
                     principal's name from their password (the default is csmake)
+                  * A principal that already exists is left as it is
        Phases: build, test
     """
 
@@ -37,13 +39,9 @@ class KdcAddPrincipal(CsmakeModule):
         if 'tag' in options:
             self.tag = options['tag']
         service = KdcServiceProvider.getServiceProvider(self.tag)
+        service.waitForService()
         principals = self._parseCommaAndNewlineList(options['principals'])
-        for principal in principals:
-            if ':' in principal:
-                principal, password = principal.split(':',1)
-                service.addPrincipal(principal, password)
-            else:
-                service.addPrincipal(principal)
+        service.addPrincipals(service.parsePrincipals(principals))
         self.log.passed()
         return True
 
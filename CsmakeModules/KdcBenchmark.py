@@ -0,0 +1,129 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import json
+import os
+import time
+from Csmake.CsmakeModule import CsmakeModule
+from CsmakeKerberosProvider.KdcServiceProvider import KdcServiceProvider
+from CsmakeKerberosProvider.KdcServiceProvider import KdcConfigurationHelper
+from CsmakeKerberosProvider.KdcServiceProvider import KdcDaemonConfig
+from CsmakeKerberosProvider.KdcBenchmark import AsReqLoad
+from CsmakeKerberosProvider.KdcBenchmark import enctypeNumbers
+
+class KdcBenchmark(CsmakeModule):
+    """Purpose: Measure how long each phase of a kdc's life takes,
+                how quickly principals can be added and deleted, and
+                how many AS-REQs the kdc can answer.
+                The kdc is started and stopped by this section.
+       Flags: tag - (OPTIONAL) The tag to give the benchmarked kdc
+                     Default: kdc-benchmark
+              sizes - (OPTIONAL) The numbers of principals to add and
+                     delete (comma or newline delimited)
+                     Default: 10, 1000, 10000
+              concurrency - (OPTIONAL) Number of threads sending AS-REQs
+                     Default: 8
+              duration - (OPTIONAL) Number of seconds to send AS-REQs
+                     Default: 5
+              output - (OPTIONAL) The file to write the JSON results to
+                     Default: $KDC_BENCHMARK_OUTPUT or kdc-benchmark.json
+              Any other options are given to the kdc, see KdcService
+       Phases: build, test
+    """
+
+    BENCHMARK_OPTIONS = ['tag', 'sizes', 'concurrency', 'duration', 'output']
+
+    def _timed(self, results, phase, function, *args):
+        start = time.time()
+        result = function(*args)
+        results[phase] = time.time() - start
+        return result
+
+    def _churn(self, provider, size):
+        principals = [ ('csmake-bench-%d-%d' % (size, index), 'csmake')
+                       for index in range(size) ]
+        results = {}
+        self._timed(results, 'add_seconds', provider.addPrincipals, principals)
+        self._timed(
+            results,
+            'delete_seconds',
+            provider.deletePrincipals,
+            [ principal for principal, password in principals ] )
+        results['adds_per_second'] = size / results['add_seconds']
+        results['deletes_per_second'] = size / results['delete_seconds']
+        return results
+
+    def build(self, options):
+        tag = options.get('tag', 'kdc-benchmark')
+        sizes = [10, 1000, 10000]
+        if 'sizes' in options:
+            sizes = [ int(size) for size in
+                      self._parseCommaAndNewlineList(options['sizes']) ]
+        concurrency = int(options.get('concurrency', 8))
+        duration = float(options.get('duration', 5))
+        output = options.get(
+            'output',
+            os.environ.get('KDC_BENCHMARK_OUTPUT', 'kdc-benchmark.json') )
+        kdcOptions = dict([ (key, value) for key, value in options.items()
+                            if key not in self.BENCHMARK_OPTIONS ])
+
+        self._dontValidateFiles()
+        results = { 'phases' : {}, 'churn' : {} }
+        phases = results['phases']
+        provider = self._timed(
+            phases,
+            'create',
+            KdcServiceProvider.createServiceProvider,
+            tag,
+            self,
+            **kdcOptions )
+        try:
+            self._timed(phases, 'start', provider.startService)
+            phases['ready'] = provider.service.readyTime
+            for size in sizes:
+                results['churn'][str(size)] = self._churn(provider, size)
+            provider.addPrincipal('csmake-bench-client')
+            results['asreq'] = AsReqLoad(
+                KdcConfigurationHelper.kdcAddress(provider.options),
+                provider.options['realm'],
+                'csmake-bench-client',
+                enctypeNumbers(KdcDaemonConfig.enctypeNames(provider.options))
+                ).run(concurrency, duration)
+        finally:
+            self._timed(
+                phases,
+                'stop',
+                KdcServiceProvider.disposeServiceProvider,
+                tag )
+        results['metrics'] = provider.metrics.asDict()
+        results['requests'] = provider.stats()
+
+        with open(output, 'w') as outputFile:
+            json.dump(results, outputFile, sort_keys=True, indent=4)
+        self.log.info(
+            "kdc start %0.3fs (ready %0.3fs), stop %0.3fs, %0.0f AS-REQ/s (p50 %0.2fms, p99 %0.2fms), results in %s",
+            phases['start'],
+            phases['ready'],
+            phases['stop'],
+            results['asreq']['requests_per_second'],
+            (results['asreq']['p50_seconds'] or 0) * 1000,
+            (results['asreq']['p99_seconds'] or 0) * 1000,
+            output )
+        self.log.passed()
+        return True
+
+    def test(self, options):
+        return self.build(options)
@@ -23,6 +23,7 @@ class KdcDeletePrincipal(CsmakeModule):
        Flags: tag - (OPTIONAL) The tag of the kdc service to modify
                      Default is the default kdc
               principals - Principals to delete from the realm of csmake's kdc
+                  * A principal that doesn't exist is skipped
        Phases: build, test
     """
 
@@ -32,10 +33,10 @@ class KdcDeletePrincipal(CsmakeModule):
         self.tag = '_'
         if 'tag' in options:
             self.tag = options['tag']
-        service = KdcProvider.getServiceProvider(self.tag)
+        service = KdcServiceProvider.getServiceProvider(self.tag)
+        service.waitForService()
         principals = self._parseCommaAndNewlineList(options['principals'])
-        for principal in principals:
-            service.deletePrincipal(principal)
+        service.deletePrincipals(principals)
         self.log.passed()
         return True
 
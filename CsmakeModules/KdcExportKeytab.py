@@ -0,0 +1,70 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+from CsmakeKerberosProvider.KdcServiceProvider import KdcServiceProvider
+from Csmake.CsmakeModule import CsmakeModule
+
+class KdcExportKeytab(CsmakeModule):
+    """Purpose: A module to export the keys of principals in the given kdc
+               (by the tag provided) to keytabs.  The principals' keys
+               are not changed, so their passwords still work.
+               Keytabs are kept in the kdc's config-path (under keytabs)
+               and are only exported again if a principal's keys change.
+       Flags: tag - (OPTIONAL) The tag of the kdc service to use
+                     Default is the default kdc
+              principals - Principals to export
+                  * The principals are comma or newline delimited.
+                  * An @realm picks one of the kdc's realms, any other
+                    @realm is ignored.
+              keytab - (OPTIONAL) The name of the keytab to export all
+                     the principals to
+                     Default: A name made from the principals
+              per-principal - (OPTIONAL) 'True' exports each principal to
+                     a keytab of its own, <principal>@<realm>.keytab
+                     (a / in the principal is changed to _)
+                     'keytab' is ignored when this is used
+                     Default: False
+              keytab-env - (OPTIONAL) Set the given csmake environment name
+                     to the keytab's path (or, with per-principal,
+                     the directory the keytabs are in)
+                     Default: csmake's environment does not change.
+       Phases: build, test
+    """
+
+    REQUIRED_OPTIONS=['principals']
+
+    def build(self, options):
+        self.tag = '_'
+        if 'tag' in options:
+            self.tag = options['tag']
+        service = KdcServiceProvider.getServiceProvider(self.tag)
+        service.waitForService()
+        principals = self._parseCommaAndNewlineList(options['principals'])
+        if 'per-principal' in options and options['per-principal'] == 'True':
+            keytabs = service.exportKeytabs(principals)
+            for principal, keytab in keytabs.items():
+                self.log.info("Exported %s to %s", principal, keytab)
+            path = service.service.configManager.keytabDirectory()
+        else:
+            path = service.exportKeytab(principals, options.get('keytab'))
+            self.log.info("Exported %s to %s", ', '.join(principals), path)
+        if 'keytab-env' in options:
+            self.env.env[options['keytab-env']] = path
+        self.log.passed()
+        return True
+
+    def test(self, options):
+        return self.build(options)
@@ -0,0 +1,44 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+from CsmakeKerberosProvider.KdcServiceProvider import KdcServiceProvider
+from Csmake.CsmakeModule import CsmakeModule
+
+class KdcRestore(CsmakeModule):
+    """Purpose: Roll the principal databases of the given kdc
+               (by the tag provided) back to a KdcSnapshot
+       Flags: tag - (OPTIONAL) The tag of the kdc service to roll back
+                     Default is the default kdc
+              name - (OPTIONAL) The name of the snapshot to restore
+                     Default: default
+       Notes: The kdc isn't restarted and keeps its port.  Principals
+              added since the snapshot are removed, deleted principals
+              come back and passwords and kvnos are put back.
+       Phases: build, test
+    """
+
+    def build(self, options):
+        self.tag = '_'
+        if 'tag' in options:
+            self.tag = options['tag']
+        service = KdcServiceProvider.getServiceProvider(self.tag)
+        service.waitForService()
+        service.restore(options.get('name', 'default'))
+        self.log.passed()
+        return True
+
+    def test(self, options):
+        return self.build(options)
@@ -42,6 +42,15 @@ class KdcService(CsmakeAspect):
                                   when the service ends, the path will also
                                   be removed.
                        Default: A temporary directory will be used
+         keep-config - (OPTIONAL) 'True' leaves the configuration and
+                 databases in 'config-path' when the service ends.
+                 A later kdc using the same 'config-path' only rewrites
+                 the configs that differ, and reuses a realm's database
+                 if it was made with the same parameters and is complete
+                 (only missing 'principals' are added).  The same reuse
+                 happens for anything left in 'config-path' by a run
+                 that didn't finish.
+                 Default: False
          change-env-vars - (OPTIONAL) 'True' allows the setup to change the
                  current csmake and child execution environment variables.
                  Specifically: KRB_KDC_PROFILE, KRB5_TRACE, KRB5_CONFIG
@@ -56,8 +65,190 @@ class KdcService(CsmakeAspect):
                  Default: No principals (other than K/M) are created.
                  KdcAddPrincipal and KdcDeletePrincipal can be used
                  to manipulate the principals while it is active.
+         principals-file - (OPTIONAL) A file with a principal[:password]
+                 on each line (blank lines and lines starting with # are
+                 ignored) to add to the kdc when its database is created.
+                 The principals are written to a kdb5_util dump and
+                 loaded all at once, so this is meant for large numbers
+                 of principals.  The file is read as it is written to
+                 the dump, so it may be any size.
+                 With aes enctypes the time taken is mostly deriving
+                 the keys (4096 PBKDF2 rounds for each enctype of each
+                 principal, a few milliseconds), which is done on a
+                 thread per cpu.
+                 Default: No principals are loaded from a file
+         preauth-principals - (OPTIONAL) Gets a TGT for each of the given
+                 principals (newline or comma delimited) when the kdc starts,
+                 using several kinits at once.  Each TGT is put in a
+                 credential cache of its own in config-path and the cache's
+                 path is put in the csmake environment as
+                 <preauth-env><PRINCIPAL>, where PRINCIPAL is the principal
+                 in upper case with anything other than a letter or digit
+                 changed to _, e.g., %(KRB5CCNAME_BOB)s.
+                 A password may be given with a colon, otherwise the
+                 password given in 'principals' (or 'csmake') is used.
+                 Requires kinit (krb5-user)
+                 Default: No TGTs are obtained
+         preauth-env - (OPTIONAL) The prefix for the csmake environment
+                 names of the preauth-principals credential caches
+                 Default: KRB5CCNAME_
+         preauth-workers - (OPTIONAL) The most kinits to run at once
+                 Default: 8
+         preauth-renew-margin - (OPTIONAL) A TGT that is already in a
+                 credential cache is reused unless it expires within
+                 this many seconds (e.g., with a leased kdc)
+                 Default: 300
          realm - (OPTIONAL) Specifies the realm to establish with the kdc
+                 Several realms may be given (newline or comma delimited),
+                 each realm gets its own database and all are served by
+                 the same kdc.  The first realm is the default realm.
+                 A principal may be put in a specific realm with
+                 an @realm, e.g., myprinc@OTHER.DOMAIN:<password>
                  Default: CSMAKE.DOMAIN
+         cross-realm-trust - (OPTIONAL) 'True' will create the krbtgt
+                 principals needed for every realm to trust every other realm
+                 Default: False
+         cross-realm-password - (OPTIONAL) The password used for the
+                 cross realm krbtgt principals
+                 Default: csmake
+         kdb5-util-path, krb5kdc-path, kadmin-local-path - (OPTIONAL)
+                 The location of the kdb5_util, krb5kdc and kadmin.local
+                 binaries (inside the chroot, if any)
+                 Default: The binaries are found on the PATH or in the
+                          standard bin and sbin directories
+         database-path - (OPTIONAL) Directory to hold the principal
+                 databases and their lock files, e.g., a directory on a
+                 tmpfs like /dev/shm/csmake-kdc.  The configuration and
+                 stash files stay in 'config-path'.
+                 Default: The databases are kept in 'config-path'
+         db-library - (OPTIONAL) The kdc database library to use,
+                 db2 or klmdb
+                 Default: db2
+         backend - (OPTIONAL) What serves the kdc's realms:
+                 mit - krb5kdc, with databases made by kdb5_util and
+                     principals managed with kadmin.local
+                 python - a kdc in the csmake process (see KdcPython)
+                     with its principals in memory, for tests that
+                     only need kinit and service tickets.  It starts in
+                     milliseconds and needs none of the kdc tools (kinit
+                     is still needed for preauth-principals).  It doesn't
+                     do preauthentication, renewable or forwardable
+                     tickets, and can't be leased.  The enctypes may be
+                     aes256-cts, aes128-cts and rc4-hmac, always with
+                     the normal salt.
+                 Default: mit
+         lease - (OPTIONAL) 'True' leaves the kdc running after the
+                 csmake run ends.  A later run with the same 'config-path'
+                 and configuration attaches to the running kdc and only adds
+                 any missing 'principals'.  'config-path' should be given,
+                 otherwise every run uses a new temporary directory.
+                 KdcStopService with release=True stops a leased kdc.
+                 Default: False
+         lease-timeout - (OPTIONAL) Number of seconds a leased kdc is
+                 kept running after the last run that used it
+                 Default: 600
+         workers - (OPTIONAL) The number of krb5kdc worker processes
+                 to serve requests with (krb5kdc -w), or 'auto' to use
+                 one worker per cpu.  The workers are found by their
+                 parent, so they are waited for and stopped even when
+                 sudo runs the kdc in a process group of its own
+                 (use_pty).  The kdc is ready once every worker has
+                 answered a probe in the kdc-log (with kdc-log=console,
+                 once every worker is running).
+                 Default: 1 (a single krb5kdc process)
+         enctypes - (OPTIONAL) The enctypes of the kdc (comma or newline
+                 delimited), used for the master key (the first one),
+                 the realms' supported_enctypes, the clients'
+                 permitted_enctypes and the keys of every principal.
+                 An enctype may name its salt, e.g., aes128-cts:normal
+                 The aes enctypes use the cpu's AES instructions.
+                 Default: aes256-cts-hmac-sha1-96, aes128-cts-hmac-sha1-96
+         transports - (OPTIONAL) The transports the kdc listens on
+                 (udp and/or tcp, comma or newline delimited), both use
+                 the kdc's port.  The kdc isn't ready until it answers
+                 on every one of them.
+                 Default: udp, tcp
+         client-transport - (OPTIONAL) The transport the krb5.conf tells
+                 clients to use to reach the kdc: any, udp or tcp.
+                 tcp avoids the UDP request, RESPONSE_TOO_BIG, TCP retry
+                 round trips that large tickets cause.
+                 Default: any (the client decides)
+         udp-preference-limit - (OPTIONAL) The udp_preference_limit for
+                 clients, messages larger than this many bytes are sent
+                 over TCP first (1 always uses TCP)
+                 Default: The kerberos library's default (1465)
+         client-profile - (OPTIONAL) The krb5.conf written for clients:
+                 standard - the realms, kdcs and enctypes only
+                 offline - also turns off everything that looks outside
+                     the krb5.conf (DNS realm/kdc/URI lookups, hostname
+                     canonicalization, time sync, addresses in tickets)
+                 Default: standard
+         ccache-type - (OPTIONAL) The clients' default credential cache:
+                 FILE, MEMORY, KEYRING or DIR (a directory in
+                 'config-path').  MEMORY caches don't outlive the
+                 process that made them.
+                 Default: FILE (the kerberos library's default)
+         replay-cache - (OPTIONAL) 'False' turns off the replay cache
+                 (KRB5RCACHETYPE=none, with change-env-vars), saving a
+                 file write and fsync for every authentication
+                 Default: True
+         client-timeout - (OPTIONAL) Number of seconds a client keeps
+                 trying the kdc (request_timeout, MIT 1.20 and later)
+                 Default: The kerberos library's default
+         start-async - (OPTIONAL) 'True' starts the kdc on a background
+                 thread so the section (and the sections after a regular
+                 KdcService section) carry on while the kdc comes up.
+                 KdcAddPrincipal, KdcDeletePrincipal, KdcExportKeytab and
+                 KdcWaitService wait for the kdc to be ready.  Use
+                 KdcWaitService before anything else that needs the kdc,
+                 e.g., a Shell using KRB5_CONFIG.
+                 Default: False
+         kdc-log - (OPTIONAL) What happens to the kdc's log:
+                 stream - the kdc logs to its stderr, which is read on a
+                     thread of its own, each request is counted (see
+                     KdcServiceProvider.stats(), the readiness probes
+                     are counted separately) and only a summary is
+                     logged, the last lines are logged if the kdc fails
+                 console - the kdc logs to the console, as it used to
+                 A leased kdc always logs to csmake.kdc.log
+                 Default: stream
+         kdc-log-buffer - (OPTIONAL) Number of the kdc's last requests
+                 and log lines that are kept
+                 Default: 1000
+         kdc-log-interval - (OPTIONAL) Number of seconds between the
+                 summaries of the kdc's requests in the log
+                 Default: 10
+         ready-timeout - (OPTIONAL) Number of seconds to wait for the
+                 kdc to start answering kerberos requests
+                 Default: 5
+         stop-timeout - (OPTIONAL) Number of seconds to wait for the
+                 kdc to exit after it is asked to stop before it is killed
+                 Default: 2
+         template-cache - (OPTIONAL) 'True' will keep a copy of newly
+                 created kdc databases (including the initial 'principals')
+                 and will copy the database into place for a later
+                 kdc with the same realm and principals instead of
+                 creating the database again.  The templates include
+                 the master key's stash file and are kept in a
+                 directory only the user can read.
+                 Default: False
+         template-cache-path - (OPTIONAL) Directory to hold the database
+                 templates
+                 Default: ~/.cache/csmake-kerberos-provider/templates
+         template-cache-size - (OPTIONAL) The number of database templates
+                 to keep.  The least recently used are removed first.
+                 Default: 16
+         metrics - (OPTIONAL) 'True' writes how long each step of the
+                 kdc's life took (config, kdb5_util create, spawn, readiness,
+                 principal seeding, cleanup) and how many subprocesses were
+                 launched to <config-path>.metrics.json when the kdc stops.
+                 The file outlives config-path, it is left for the caller.
+                 A summary is always logged.
+                 Default: False
+         metrics-hook - (OPTIONAL) A python function, e.g.,
+                 mypackage.mymodule.send, that is called with the metrics
+                 (as a dictionary) when the kdc stops
+                 Default: The metrics are not sent anywhere
          port - (OPTIONAL) Will stand up the sshd on the given port
                  Default: a currently open port in 'port-range'
          port-range - (OPTIONAL) Will stand up the sshd in a given range
@@ -86,6 +277,11 @@ class KdcService(CsmakeAspect):
             self,
             **options)
         self.provider.startService()
+        if self.provider.options['start-async']:
+            #Anything that needs the kdc waits for it, see KdcWaitService
+            self.log.info("The kdc is starting in the background")
+            self.log.passed()
+            return None
         if self.provider is not None and self.provider.isServiceExecuting():
             self.log.passed()
         else:
@@ -0,0 +1,161 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+from Csmake.CsmakeAspect import CsmakeAspect
+from CsmakeKerberosProvider.KdcServiceProvider import KdcServiceProvider
+from CsmakeKerberosProvider.KdcServiceProvider import KdcConfigurationHelper
+
+class KdcServiceGroup(CsmakeAspect):
+    """Purpose: Stand up several tagged kdcs at the same time
+                Each kdc's database creation, startup and principals are
+                handled concurrently with the other kdcs in the group.
+     Options:
+         tags - The tags of the kdcs to stand up (newline or comma delimited)
+                Each tag may be used with KdcAddPrincipal, KdcStopService,
+                etc. just like a tag given to KdcService.
+         workers - (OPTIONAL) The most kdcs to stand up at the same time
+                Default: All the kdcs are stood up at the same time
+         <tag>.<option> - (OPTIONAL) Gives the option only to the kdc
+                with the given tag, e.g., alpha.realm=ALPHA.DOMAIN
+         Any other options are given to every kdc in the group, see
+         KdcService for the available options.
+         NOTE: change-env-vars only applies to the first tag unless
+               it is given for a specific tag.
+     Phases/JoinPoints:
+         build, test - will stand the services up in the build phase
+                 When used as a regular section, StopKdcService must be used
+                 for each tag (or the services end with the build)
+         start__build, start__test
+                     - will stand up the services at the start of the
+                        decorated regular section
+         end__build, end__test
+                     - will tear down the services at the end of the section
+    """
+
+    REQUIRED_OPTIONS=['tags']
+
+    def _tagOptions(self, options):
+        result = {}
+        for tag in self.tags:
+            result[tag] = {}
+        shared = {}
+        for key, value in options.items():
+            if '.' in key:
+                tag, option = key.split('.', 1)
+                if tag in result:
+                    result[tag][option] = value
+                    continue
+            shared[key] = value
+        for index, tag in enumerate(self.tags):
+            tagOptions = dict(shared)
+            if index != 0:
+                tagOptions['change-env-vars'] = 'False'
+            tagOptions.update(result[tag])
+            result[tag] = tagOptions
+        return result
+
+    def _startServices(self, options):
+        for tag in self.tags:
+            if KdcServiceProvider.hasServiceProvider(tag):
+                self.log.error("kdc with service tag '%s' already executing", tag)
+                self.log.failed()
+                self._unregisterOnExitCallback("_stopServices")
+                return None
+
+        #Providers are created one at a time so that port allocation
+        #and option processing happen in order, only the expensive
+        #startup is done concurrently
+        providers = []
+        tagOptions = self._tagOptions(options)
+        for tag in self.tags:
+            providers.append(KdcServiceProvider.createServiceProvider(
+                tag,
+                self,
+                **tagOptions[tag]))
+
+        results = KdcConfigurationHelper.runConcurrently(
+            lambda provider: provider.startService(),
+            providers,
+            self.workers )
+
+        failed = False
+        for tag, (provider, result, exception, seconds) in zip(self.tags, results):
+            if exception is None:
+                #With start-async the kdc is still coming up
+                try:
+                    provider.waitForService()
+                except Exception as e:
+                    exception = e
+            if exception is not None:
+                self.log.error(
+                    "kdc '%s' failed to start: %s: %s",
+                    tag,
+                    exception.__class__.__name__,
+                    str(exception) )
+                failed = True
+            elif not provider.isServiceExecuting():
+                self.log.error("kdc '%s' is not running", tag)
+                failed = True
+            else:
+                self.log.info(
+                    "kdc '%s' started in %0.3f seconds (ready in %0.3f seconds)",
+                    tag,
+                    seconds,
+                    provider.service.readyTime )
+        if failed:
+            self.log.error("The kdc services could not be started")
+            self._disposeServices()
+            self.log.failed()
+            return None
+        self.log.passed()
+        return None
+
+    def _disposeServices(self):
+        for tag in self.tags:
+            if KdcServiceProvider.hasServiceProvider(tag):
+                KdcServiceProvider.disposeServiceProvider(tag)
+        self._unregisterOnExitCallback("_stopServices")
+
+    def _stopServices(self):
+        self._disposeServices()
+        self.log.passed()
+
+    def build(self, options):
+        options = dict(options)
+        self.tags = self._parseCommaAndNewlineList(options['tags'])
+        del options['tags']
+        self.workers = None
+        if 'workers' in options:
+            self.workers = int(options['workers'])
+            del options['workers']
+        self._dontValidateFiles()
+        self._registerOnExitCallback("_stopServices")
+        return self._startServices(options)
+
+    def test(self, options):
+        return self.build(options)
+
+    def start__build(self, phase, options, step, stepoptions):
+        return self.build(options)
+
+    def end__build(self, phase, options, step, stepoptions):
+        self._stopServices()
+
+    def start__test(self, phase, options, step, stepoptions):
+        return self.start__build(phase, options, step, stepoptions)
+
+    def end__test(self, phase, options, step, stepoptions):
+        return self.end__build(phase, options, step, stepoptions)
@@ -0,0 +1,46 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+from CsmakeKerberosProvider.KdcServiceProvider import KdcServiceProvider
+from Csmake.CsmakeModule import CsmakeModule
+
+class KdcSnapshot(CsmakeModule):
+    """Purpose: Checkpoint the principal databases of the given kdc
+               (by the tag provided) so KdcRestore can roll them back
+       Flags: tag - (OPTIONAL) The tag of the kdc service to checkpoint
+                     Default is the default kdc
+              name - (OPTIONAL) The name of the snapshot, a snapshot
+                     with the same name is replaced
+                     Default: default
+       Notes: The snapshot is kept in the kdc's 'config-path'.
+              The kdc keeps running and keeps its port, a db2 database
+              is copied while the kdc is stopped for a moment, a klmdb
+              database is dumped.
+       Phases: build, test
+    """
+
+    def build(self, options):
+        self.tag = '_'
+        if 'tag' in options:
+            self.tag = options['tag']
+        service = KdcServiceProvider.getServiceProvider(self.tag)
+        service.waitForService()
+        service.snapshot(options.get('name', 'default'))
+        self.log.passed()
+        return True
+
+    def test(self, options):
+        return self.build(options)
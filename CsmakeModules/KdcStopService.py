@@ -14,7 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
+import os.path
 from CsmakeKerberosProvider.KdcServiceProvider import KdcServiceProvider
+from CsmakeKerberosProvider.KdcServiceProvider import KdcConfigurationHelper
+from CsmakeKerberosProvider.KdcLease import KdcLease
 from Csmake.CsmakeAspect import CsmakeAspect
 
 class KdcStopService(CsmakeAspect):
@@ -24,12 +27,29 @@ class KdcStopService(CsmakeAspect):
        Options:
            tag - (OPTIONAL) Must match the tag given to KdcService that
                    this section is ending
+           release - (OPTIONAL) 'True' will stop a leased kdc instead of
+                   leaving it running for the next csmake run
+                   Default: False
+           config-path - (OPTIONAL) With release, stops the kdc leased
+                   in the given config-path even when no KdcService
+                   section is executing in this run.
+           chroot - (OPTIONAL) The chroot config-path is in
+                   Default: /
+           no-sudo - (OPTIONAL) 'True' never uses sudo to stop the kdc
+                   leased in config-path
+                   Default: sudo is used unless the kdc was started
+                            with no-sudo
        Phases/JoinPoints:
            build, test - end execution of KdcService
            end__build, end__test - end execution of KdcService at the conclusion of the
                         decorated regular section"""
 
-    def _stopService(self, tag):
+    def _stopService(self, tag, release=False, configPath=None, sudo=None):
+        if release:
+            if KdcServiceProvider.hasServiceProvider(tag):
+                KdcServiceProvider.getServiceProvider(tag).releaseLease()
+            elif configPath is not None:
+                KdcLease(configPath).release(sudo=sudo)
         try:
             self._unregisterOtherClassOnExitCallback(
                 "KdcService",
@@ -39,10 +59,20 @@ class KdcStopService(CsmakeAspect):
         KdcServiceProvider.disposeServiceProvider(tag)
 
     def build(self, options):
-        tag = ''
+        tag = '_'
         if 'tag' in options:
             tag = options['tag']
-        self._stopService()
+        release = 'release' in options and options['release'] == 'True'
+        configPath = None
+        if 'config-path' in options:
+            configPath = options['config-path']
+            chroot = options.get('chroot')
+            if chroot is not None and len(chroot) != 0:
+                configPath = os.path.join(chroot, configPath.lstrip('/'))
+        sudo = None
+        if KdcConfigurationHelper.noSudo(options):
+            sudo = False
+        self._stopService(tag, release, configPath, sudo)
         self.log.passed()
         return None
 
@@ -0,0 +1,60 @@
+# <copyright>
+# (c) Copyright 2017 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+from CsmakeKerberosProvider.KdcServiceProvider import KdcServiceProvider
+from Csmake.CsmakeAspect import CsmakeAspect
+
+class KdcWaitService(CsmakeAspect):
+    """Purpose: Wait for a kdc started with start-async to be ready
+                May be used as an aspect on a section that needs the kdc,
+                    e.g., a Shell section using KRB5_CONFIG
+       Options:
+           tag - (OPTIONAL) Must match the tag given to KdcService
+           timeout - (OPTIONAL) Number of seconds to wait for the kdc
+                   Default: Wait until the kdc has started or failed to
+       Phases/JoinPoints:
+           build, test - wait for the kdc
+           start__build, start__test - wait for the kdc before the
+                        decorated regular section executes"""
+
+    def build(self, options):
+        tag = '_'
+        if 'tag' in options:
+            tag = options['tag']
+        timeout = None
+        if 'timeout' in options:
+            timeout = float(options['timeout'])
+        if not KdcServiceProvider.hasServiceProvider(tag):
+            self.log.error("No kdc with service tag '%s' is executing", tag)
+            self.log.failed()
+            return None
+        try:
+            KdcServiceProvider.getServiceProvider(tag, timeout).waitForService(0)
+        except Exception as e:
+            self.log.error("The kdc '%s' is not ready: %s", tag, str(e))
+            self.log.failed()
+            return None
+        self.log.passed()
+        return None
+
+    def start__build(self, phase, options, step, stepoptions):
+        return self.build(options)
+
+    def test(self, options):
+        return self.build(options)
+
+    def start__test(self, phase, options, step, stepoptions):
+        return self.start__build(phase, options, step, stepoptions)